@@ -0,0 +1,265 @@
+"""
+Side index of the chunks of a Chroma db, by source file and content hash.
+
+add_to_db looks up which hashes and sources of a batch are already stored,
+and which chunk ids to delete when a file is replaced, without pulling the
+whole collection into memory. The index lives in an SQLite file next to the
+Chroma files. It is rebuilt from the collection if it is missing, or if a
+previous update of the collection did not finish.
+
+Benchmark of the deduplication step of ingestion, old and new:
+
+  python chroma_index.py --num_chunks 100000 --batch_size 1000
+"""
+import argparse
+import contextlib
+import os
+import sqlite3
+import time
+
+INDEX_FILE_NAME = "source_index.sqlite"
+
+# Stays below SQLite's limit on the number of bound parameters.
+_MAX_PARAMS = 900
+
+
+def _batches(items):
+    items = list(items)
+    for i in range(0, len(items), _MAX_PARAMS):
+        yield items[i : i + _MAX_PARAMS]
+
+
+class ChromaSourceIndex:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "id TEXT PRIMARY KEY, source TEXT, hashid TEXT)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS chunks_source ON chunks(source)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS chunks_hashid ON chunks(hashid)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "key TEXT PRIMARY KEY, value INTEGER)"
+            )
+
+    def close(self):
+        self.conn.close()
+
+    def _get_state(self, key):
+        row = self.conn.execute(
+            "SELECT value FROM state WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def _set_state(self, key, value):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+            (key, value),
+        )
+
+    def is_in_sync(self, collection_count):
+        # Dirty while an update of the collection is under way.
+        return (
+            self._get_state("dirty") == 0
+            and self._get_state("count") == collection_count
+        )
+
+    def rebuild(self, ids, metadatas):
+        with self.conn:
+            self.conn.execute("DELETE FROM chunks")
+            self.conn.executemany(
+                "INSERT INTO chunks (id, source, hashid) VALUES (?, ?, ?)",
+                _rows(ids, metadatas),
+            )
+            self._set_state("count", len(ids))
+            self._set_state("dirty", 0)
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def _lookup(self, column, select, values):
+        found = set()
+        for batch in _batches(set(values)):
+            found.update(
+                row[0]
+                for row in self.conn.execute(
+                    f"SELECT DISTINCT {select} FROM chunks WHERE {column} IN "
+                    f"({','.join('?' * len(batch))})",
+                    batch,
+                )
+            )
+        return found
+
+    def known_hashids(self, hashids):
+        return self._lookup("hashid", "hashid", hashids)
+
+    def known_sources(self, sources):
+        return self._lookup("source", "source", sources)
+
+    def ids_for_sources(self, sources):
+        return self._lookup("source", "id", sources)
+
+    @contextlib.contextmanager
+    def update(self, get_collection_count):
+        """
+        Wraps an update of the collection. The index is marked dirty before
+        it, and the chunks deleted and added through the yielded
+        IndexUpdate are committed together with the new collection count
+        only once it succeeded.
+        """
+        with self.conn:
+            self._set_state("dirty", 1)
+        update = IndexUpdate()
+        yield update
+        with self.conn:
+            for batch in _batches(update.deleted_ids):
+                self.conn.execute(
+                    "DELETE FROM chunks WHERE id IN "
+                    f"({','.join('?' * len(batch))})",
+                    batch,
+                )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO chunks (id, source, hashid) "
+                "VALUES (?, ?, ?)",
+                _rows(update.added_ids, update.added_metadatas),
+            )
+            self._set_state("count", get_collection_count())
+            self._set_state("dirty", 0)
+
+
+class IndexUpdate:
+    def __init__(self):
+        self.deleted_ids = []
+        self.added_ids = []
+        self.added_metadatas = []
+
+    def delete(self, ids):
+        self.deleted_ids.extend(ids)
+
+    def add(self, ids, metadatas):
+        self.added_ids.extend(ids)
+        self.added_metadatas.extend(metadatas)
+
+
+def _rows(ids, metadatas):
+    for id_, metadata in zip(ids, metadatas):
+        metadata = metadata or {}
+        hashid = metadata.get("hashid")
+        if hashid == "None":
+            hashid = None
+        yield id_, metadata.get("source"), hashid
+
+
+def get_source_index(db):
+    """
+    Returns the side index of the Chroma `db`, rebuilding it from the
+    collection when it is not in sync.
+    """
+    index = getattr(db, "_source_index", None)
+    if index is None:
+        index = ChromaSourceIndex(
+            os.path.join(db._persist_directory, INDEX_FILE_NAME)
+        )
+        db._source_index = index
+    if not index.is_in_sync(db._collection.count()):
+        print("Rebuilding source index of %s" % db._persist_directory)
+        collection = db._collection.get(include=["metadatas"])
+        index.rebuild(collection["ids"], collection["metadatas"])
+    return index
+
+
+def _synthetic_chunks(start, count, num_sources):
+    from langchain.docstore.document import Document
+
+    return [
+        Document(
+            page_content="chunk %d" % i,
+            metadata=dict(
+                source="doc%d.txt" % (i % num_sources), hashid=str(i)
+            ),
+        )
+        for i in range(start, start + count)
+    ]
+
+
+def benchmark(num_chunks, batch_size, num_sources, persist_directory):
+    """
+    Fills a Chroma db with `num_chunks` chunks, then times finding the
+    duplicates and the chunks to replace of a batch, half of it already
+    stored, by reading the whole collection and by the side index.
+    """
+    import uuid
+
+    from langchain.embeddings import FakeEmbeddings
+    from langchain.vectorstores import Chroma
+
+    db = Chroma(
+        collection_name="benchmark",
+        embedding_function=FakeEmbeddings(size=32),
+        persist_directory=persist_directory,
+    )
+    begin = time.perf_counter()
+    for start in range(0, num_chunks, batch_size):
+        chunks = _synthetic_chunks(start, batch_size, num_sources)
+        db.add_documents(chunks, ids=[str(uuid.uuid4()) for _ in chunks])
+    print(
+        "Added %d chunks in %.1fs" % (num_chunks, time.perf_counter() - begin)
+    )
+
+    batch = _synthetic_chunks(
+        num_chunks - batch_size // 2, batch_size, num_sources
+    )
+    hashids = [x.metadata["hashid"] for x in batch]
+    sources = set(x.metadata["source"] for x in batch)
+
+    begin = time.perf_counter()
+    metadatas = db.get()["metadatas"]
+    known = set(x["hashid"] for x in metadatas if "hashid" in x)
+    new = [x for x in batch if x.metadata["hashid"] not in known]
+    dup_files = set(x["source"] for x in metadatas) & sources
+    scan_s = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    index = get_source_index(db)
+    rebuild_s = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    known = index.known_hashids(hashids)
+    indexed_new = [x for x in batch if x.metadata["hashid"] not in known]
+    delete_ids = index.ids_for_sources(index.known_sources(sources))
+    index_s = time.perf_counter() - begin
+
+    assert len(new) == len(indexed_new)
+    print("Batch of %d chunks, %d new:" % (batch_size, len(new)))
+    print("  collection scan: %8.1f ms" % (scan_s * 1000))
+    print("  side index:      %8.1f ms" % (index_s * 1000))
+    print("  (one time index build: %.1f s)" % rebuild_s)
+    print(
+        "  %d chunks of %d replaced files to delete"
+        % (len(delete_ids), len(dup_files))
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks deduplicating a batch against a Chroma db."
+    )
+    parser.add_argument("--num_chunks", type=int, default=100000)
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--num_sources", type=int, default=1000)
+    parser.add_argument("--persist_directory", default="db_dir_benchmark")
+    args = parser.parse_args()
+    benchmark(
+        args.num_chunks,
+        args.batch_size,
+        args.num_sources,
+        args.persist_directory,
+    )
@@ -53,6 +53,7 @@ from utils import (
     FakeTokenizer,
 )
 from utils_langchain import StreamingGradioCallbackHandler
+from chroma_index import get_source_index
 
 import_matplotlib()
 
@@ -228,27 +229,19 @@ def add_to_db(
             return db, num_new_sources, []
         db.add_documents(documents=sources)
     elif db_type == "chroma":
-        collection = get_documents(db)
-        # files we already have:
-        metadata_files = set([x["source"] for x in collection["metadatas"]])
+        index = get_source_index(db)
         if avoid_dup_by_file:
             # Too weak in case file changed content, assume parent shouldn't pass true for this for now
             raise RuntimeError("Not desired code path")
-            sources = [
-                x
-                for x in sources
-                if x.metadata["source"] not in metadata_files
-            ]
+        dup_ids = set()
         if avoid_dup_by_content:
             # look at hash, instead of page_content
             # migration: If no hash previously, avoid updating,
             #  since don't know if need to update and may be expensive to redo all unhashed files
-            metadata_hash_ids = set(
-                [
-                    x["hashid"]
-                    for x in collection["metadatas"]
-                    if "hashid" in x and x["hashid"] not in ["None", None]
-                ]
+            metadata_hash_ids = index.known_hashids(
+                x.metadata["hashid"]
+                for x in sources
+                if x.metadata.get("hashid") not in ["None", None]
             )
             # avoid sources with same hash
             sources = [
@@ -266,33 +259,26 @@ def add_to_db(
                 flush=True,
             )
             # get new file names that match existing file names.  delete existing files we are overridding
-            dup_metadata_files = set(
-                [
-                    x.metadata["source"]
-                    for x in sources
-                    if x.metadata["source"] in metadata_files
-                ]
+            dup_metadata_files = index.known_sources(
+                x.metadata["source"] for x in sources
             )
             print(
                 "Removing %s duplicate files from db because ingesting those as new documents"
                 % len(dup_metadata_files),
                 flush=True,
             )
-            client_collection = db._client.get_collection(
-                name=db._collection.name,
-                embedding_function=db._collection._embedding_function,
-            )
-            for dup_file in dup_metadata_files:
-                dup_file_meta = dict(source=dup_file)
-                try:
-                    client_collection.delete(where=dup_file_meta)
-                except KeyError:
-                    pass
+            dup_ids = index.ids_for_sources(dup_metadata_files)
         num_new_sources = len(sources)
         if num_new_sources == 0:
             return db, num_new_sources, []
-        db.add_documents(documents=sources)
-        db.persist()
+        ids = [str(uuid.uuid4()) for _ in sources]
+        with index.update(db._collection.count) as update:
+            if dup_ids:
+                db._collection.delete(ids=list(dup_ids))
+                update.delete(dup_ids)
+            db.add_documents(documents=sources, ids=ids)
+            update.add(ids, [x.metadata for x in sources])
+            db.persist()
         clear_embedding(db)
         save_embed(db, use_openai_embedding, hf_embedding_model)
     else:
@@ -355,6 +341,16 @@ def create_or_update_db(
     return db
 
 
+def get_embedding_backend(use_openai_embedding, hf_embedding_model):
+    # which library get_embedding computes the embeddings with
+    if use_openai_embedding:
+        return "openai"
+    if args.shark_embedding and "instructor" not in hf_embedding_model:
+        # instructor models prepend instructions, so stay on HF for them
+        return "shark"
+    return "hf"
+
+
 def get_embedding(
     use_openai_embedding,
     hf_embedding_model="sentence-transformers/all-MiniLM-L6-v2",
@@ -373,7 +369,17 @@ def get_embedding(
 
         torch_dtype, context_class = get_dtype()
         model_kwargs = dict(device=args.device)
-        if "instructor" in hf_embedding_model:
+        backend = get_embedding_backend(
+            use_openai_embedding, hf_embedding_model
+        )
+        if backend == "shark":
+            from shark_embeddings import SharkEmbeddings
+
+            embedding = SharkEmbeddings(
+                model_name=hf_embedding_model,
+                num_workers=args.shark_embedding_workers,
+            )
+        elif "instructor" in hf_embedding_model:
             encode_kwargs = {"normalize_embeddings": True}
             embedding = HuggingFaceInstructEmbeddings(
                 model_name=hf_embedding_model,
@@ -1882,7 +1888,11 @@ def check_update_chroma_embedding(
     db, use_openai_embedding, hf_embedding_model, langchain_mode
 ):
     changed_db = False
-    if load_embed(db) != (use_openai_embedding, hf_embedding_model):
+    if load_embed(db) != (
+        use_openai_embedding,
+        hf_embedding_model,
+        get_embedding_backend(use_openai_embedding, hf_embedding_model),
+    ):
         print(
             "Detected new embedding, updating db: %s" % langchain_mode,
             flush=True,
@@ -2021,8 +2031,15 @@ def make_db(**langchain_kwargs):
 def save_embed(db, use_openai_embedding, hf_embedding_model):
     if db is not None:
         embed_info_file = os.path.join(db._persist_directory, "embed_info")
-        with open(embed_info_file, "wb") as f:
-            pickle.dump((use_openai_embedding, hf_embedding_model), f)
+        embed_info = (
+            use_openai_embedding,
+            hf_embedding_model,
+            get_embedding_backend(use_openai_embedding, hf_embedding_model),
+        )
+        # unchanged on every addition to the db, so skip rewriting it
+        if not os.path.isfile(embed_info_file) or load_embed(db) != embed_info:
+            with open(embed_info_file, "wb") as f:
+                pickle.dump(embed_info, f)
     return use_openai_embedding, hf_embedding_model
 
 
@@ -2030,14 +2047,21 @@ def load_embed(db):
     embed_info_file = os.path.join(db._persist_directory, "embed_info")
     if os.path.isfile(embed_info_file):
         with open(embed_info_file, "rb") as f:
-            use_openai_embedding, hf_embedding_model = pickle.load(f)
+            embed_info = pickle.load(f)
+        use_openai_embedding, hf_embedding_model = embed_info[:2]
+        if len(embed_info) > 2:
+            backend = embed_info[2]
+        else:
+            # migration, saved before the backend was recorded
+            backend = "openai" if use_openai_embedding else "hf"
     else:
         # migration, assume defaults
-        use_openai_embedding, hf_embedding_model = (
+        use_openai_embedding, hf_embedding_model, backend = (
             False,
             "sentence-transformers/all-MiniLM-L6-v2",
+            "hf",
         )
-    return use_openai_embedding, hf_embedding_model
+    return use_openai_embedding, hf_embedding_model, backend
 
 
 def get_persist_directory(langchain_mode):
@@ -1,6 +1,9 @@
 """Load Data from a MediaWiki dump xml."""
+import array
 import ast
+import functools
 import glob
+import hashlib
 import pickle
 import uuid
 from typing import List, Optional
@@ -115,30 +118,87 @@ class MWDumpDirectLoader(MWDumpLoader):
         return docs
 
 
+def title_hash(title):
+    return int.from_bytes(
+        hashlib.blake2b(title, digest_size=8).digest(), "little"
+    )
+
+
+def get_offset_index_filenames(index_filename):
+    return {
+        name: "%s.%s.npy" % (index_filename, name)
+        for name in ["offsets", "title_hashes", "title_streams"]
+    }
+
+
+def build_offset_index(index_filename):
+    """
+    Converts the multistream index, lines of start_byte:page_id:title, into
+    the sorted unique start bytes of the streams, and the 64 bit hashes of
+    the titles sorted for binary search, each with the number of its stream.
+    """
+    offsets = array.array("q")
+    hashes = array.array("Q")
+    streams = array.array("I")
+    with open(index_filename, "rb") as index_file:
+        for line in index_file:
+            # titles may contain ":"
+            start_byte, _, title = line.rstrip(b"\n").split(b":", 2)
+            start_byte = int(start_byte)
+            if not offsets or start_byte != offsets[-1]:
+                offsets.append(start_byte)
+            hashes.append(title_hash(title))
+            streams.append(len(offsets) - 1)
+    hashes = np.frombuffer(hashes, dtype=np.uint64)
+    order = np.argsort(hashes, kind="stable")
+    arrays = dict(
+        offsets=np.frombuffer(offsets, dtype=np.int64),
+        title_hashes=hashes[order],
+        title_streams=np.frombuffer(streams, dtype=np.uint32)[order],
+    )
+    for name, filename in get_offset_index_filenames(index_filename).items():
+        # written aside first, so an interrupted build is never loaded
+        with open(filename + ".tmp", "wb") as f:
+            np.save(f, arrays[name])
+        os.replace(filename + ".tmp", filename)
+
+
+@functools.lru_cache()
+def load_offset_index(index_filename):
+    filenames = get_offset_index_filenames(index_filename)
+    if not all(
+        os.path.isfile(x)
+        and os.path.getmtime(x) >= os.path.getmtime(index_filename)
+        for x in filenames.values()
+    ):
+        print("Building offset index of %s" % index_filename, flush=True)
+        build_offset_index(index_filename)
+    return {
+        name: np.load(filename, mmap_mode="r")
+        for name, filename in filenames.items()
+    }
+
+
 def search_index(search_term, index_filename):
-    byte_flag = False
-    data_length = start_byte = 0
-    index_file = open(index_filename, "r")
-    csv_reader = csv.reader(index_file, delimiter=":")
-    for line in csv_reader:
-        if not byte_flag and search_term == line[2]:
-            start_byte = int(line[0])
-            byte_flag = True
-        elif byte_flag and int(line[0]) != start_byte:
-            data_length = int(line[0]) - start_byte
-            break
-    index_file.close()
+    offset_index = load_offset_index(index_filename)
+    offsets = offset_index["offsets"]
+    hashes = offset_index["title_hashes"]
+    key = np.uint64(title_hash(search_term.encode("utf-8")))
+    i = np.searchsorted(hashes, key)
+    if i == len(hashes) or hashes[i] != key:
+        return 0, 0
+    stream = offset_index["title_streams"][i]
+    start_byte = int(offsets[stream])
+    if stream + 1 < len(offsets):
+        data_length = int(offsets[stream + 1]) - start_byte
+    else:
+        # the last stream runs to the end of the dump
+        data_length = -1
     return start_byte, data_length
 
 
 def get_start_bytes(index_filename):
-    index_file = open(index_filename, "r")
-    csv_reader = csv.reader(index_file, delimiter=":")
-    start_bytes = set()
-    for line in csv_reader:
-        start_bytes.add(int(line[0]))
-    index_file.close()
-    return sorted(start_bytes)
+    return load_offset_index(index_filename)["offsets"]
 
 
 def get_wiki_filenames():
@@ -221,8 +281,8 @@ def get_all_documents(small_test=2, n_jobs=None, use_views=True):
     documents = Parallel(n_jobs=n_jobs, verbose=10, backend="multiprocessing")(
         delayed(get_one_chunk)(
             wiki_filename,
-            start_byte,
-            end_byte,
+            int(start_byte),
+            int(end_byte),
             return_file=return_file,
             use_views=use_views,
         )
@@ -263,6 +323,21 @@ def test_start_bytes():
     assert len(get_start_bytes(index_filename)) == 227850
 
 
+def test_offset_index(tmp_path):
+    index_filename = str(tmp_path / "multistream-index.txt")
+    with open(index_filename, "w") as f:
+        f.write("600:10:AccessibleComputing\n")
+        f.write("600:12:Anarchism\n")
+        f.write("1200:25:Autism\n")
+        f.write("1200:39:Albedo: a review\n")
+        f.write("2000:290:A\n")
+    assert search_index("Anarchism", index_filename) == (600, 600)
+    assert search_index("Albedo: a review", index_filename) == (1200, 800)
+    assert search_index("A", index_filename) == (2000, -1)
+    assert search_index("Missing", index_filename) == (0, 0)
+    assert list(get_start_bytes(index_filename)) == [600, 1200, 2000]
+
+
 def test_get_all_documents():
     small_test = 20  # 227850
     n_jobs = os.cpu_count() // 4
@@ -0,0 +1,356 @@
+"""
+Sentence embeddings computed by SHARK compiled sentence-transformers.
+
+The model is compiled once for every (batch size, sequence length) bucket,
+since the modules have static shapes. Texts are sorted by token count and
+grouped into the smallest bucket that holds them, so a batch of short
+chunks is not padded to the longest chunk of the document set. Batches run
+on a pool of workers, each with its own loaded copy of the modules.
+
+Pooling, normalization and the maximum sequence length come from the
+sentence-transformers config of the model, so the embeddings match those
+of HuggingFaceEmbeddings for the same model.
+"""
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import torch
+from huggingface_hub import hf_hub_download
+from huggingface_hub.utils import EntryNotFoundError, LocalEntryNotFoundError
+from langchain.embeddings.base import Embeddings
+from transformers import AutoConfig, AutoModel, AutoTokenizer
+
+from apps.stable_diffusion.src import args
+from shark.shark_importer import import_with_fx
+from shark.shark_inference import SharkInference
+
+BATCH_SIZES = (1, 32)
+SEQ_LENS = (32, 64, 128, 256)
+
+# sentence-transformers Pooling config keys of the supported pooling modes.
+POOLING_MODES = {
+    "pooling_mode_cls_token": "cls",
+    "pooling_mode_max_tokens": "max",
+    "pooling_mode_mean_tokens": "mean",
+    "pooling_mode_mean_sqrt_len_tokens": "mean_sqrt_len",
+}
+
+
+def _read_model_json(model_name, filename):
+    if os.path.isdir(model_name):
+        path = os.path.join(model_name, filename)
+        if not os.path.isfile(path):
+            return None
+    else:
+        try:
+            path = hf_hub_download(model_name, filename)
+        except (EntryNotFoundError, LocalEntryNotFoundError):
+            return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_sentence_config(model_name):
+    """
+    Returns the pooling mode, whether embeddings are normalized and the
+    maximum sequence length (None if unset) sentence-transformers uses for
+    `model_name`. Models without a sentence-transformers config are mean
+    pooled and not normalized, as SentenceTransformer does for them.
+    """
+    config = dict(pooling="mean", normalize=False, max_seq_length=None)
+    for module in _read_model_json(model_name, "modules.json") or []:
+        module_type = module["type"].rsplit(".", 1)[-1]
+        if module_type == "Pooling":
+            pooling_config = _read_model_json(
+                model_name, module["path"] + "/config.json"
+            )
+            config["pooling"] = get_pooling_mode(pooling_config or {})
+        elif module_type == "Normalize":
+            config["normalize"] = True
+    bert_config = _read_model_json(model_name, "sentence_bert_config.json")
+    if bert_config is not None:
+        config["max_seq_length"] = bert_config.get("max_seq_length")
+    return config
+
+
+def get_pooling_mode(pooling_config):
+    modes = [
+        mode
+        for key, mode in POOLING_MODES.items()
+        if pooling_config.get(key, False)
+    ]
+    other_modes = [
+        key
+        for key, value in pooling_config.items()
+        if key.startswith("pooling_mode_")
+        and key not in POOLING_MODES
+        and value
+    ]
+    if len(modes) != 1 or other_modes:
+        raise ValueError(
+            "Unsupported sentence-transformers pooling: %s" % pooling_config
+        )
+    return modes[0]
+
+
+class SentenceEmbeddingModel(torch.nn.Module):
+    def __init__(self, model_name, pooling, normalize):
+        super().__init__()
+        self.model = AutoModel.from_pretrained(model_name)
+        self.model.eval()
+        self.pooling = pooling
+        self.normalize = normalize
+
+    def forward(self, input_ids, attention_mask):
+        hidden = self.model(
+            input_ids=input_ids, attention_mask=attention_mask
+        )[0]
+        # Pooling over the tokens that are not padding, as
+        # sentence_transformers.models.Pooling does.
+        mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+        if self.pooling == "cls":
+            embeddings = hidden[:, 0]
+        elif self.pooling == "max":
+            embeddings = hidden.masked_fill(mask == 0, -1e9).max(1).values
+        else:
+            embeddings = (hidden * mask).sum(1)
+            num_tokens = mask.sum(1).clamp(min=1e-9)
+            if self.pooling == "mean_sqrt_len":
+                embeddings = embeddings / torch.sqrt(num_tokens)
+            else:
+                embeddings = embeddings / num_tokens
+        if self.normalize:
+            embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+        return embeddings
+
+
+def get_buckets(max_seq_length):
+    seq_lens = [x for x in SEQ_LENS if x < max_seq_length]
+    return BATCH_SIZES, seq_lens + [max_seq_length]
+
+
+def plan_batches(lengths, batch_sizes, seq_lens):
+    """
+    Groups the indices of texts of token counts `lengths` into batches of
+    at most max(batch_sizes) texts, each as (batch size, sequence length,
+    indices) of the smallest bucket holding it.
+    """
+    order = np.argsort(lengths, kind="stable")
+    max_batch = max(batch_sizes)
+    batches = []
+    start = 0
+    while start < len(order):
+        # The shortest remaining text decides the bucket of the batch, so
+        # no text is padded past the next sequence length up.
+        seq_len = _smallest_fitting(lengths[order[start]], seq_lens)
+        end = start
+        while (
+            end < len(order)
+            and end - start < max_batch
+            and lengths[order[end]] <= seq_len
+        ):
+            end += 1
+        indices = order[start:end].tolist()
+        batch_size = _smallest_fitting(len(indices), batch_sizes)
+        batches.append((batch_size, seq_len, indices))
+        start = end
+    return batches
+
+
+def _smallest_fitting(n, sizes):
+    for size in sorted(sizes):
+        if n <= size:
+            return size
+    return max(sizes)
+
+
+class SharkEmbeddings(Embeddings):
+    """
+    `pooling`, `normalize` and `max_seq_length` default to the
+    sentence-transformers config of `model_name`.
+    """
+
+    def __init__(
+        self,
+        model_name="sentence-transformers/all-MiniLM-L6-v2",
+        device=None,
+        max_seq_length=None,
+        normalize=None,
+        pooling=None,
+        num_workers=2,
+        vmfb_dir="shark_embeddings",
+    ):
+        self.model_name = model_name
+        self.device = device or args.device
+        sentence_config = load_sentence_config(model_name)
+        self.pooling = pooling or sentence_config["pooling"]
+        self.normalize = (
+            sentence_config["normalize"] if normalize is None else normalize
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        if max_seq_length is None:
+            max_seq_length = sentence_config["max_seq_length"]
+        if max_seq_length is None:
+            max_seq_length = AutoConfig.from_pretrained(
+                model_name
+            ).max_position_embeddings
+        self.max_seq_length = min(
+            max_seq_length, self.tokenizer.model_max_length
+        )
+        self.batch_sizes, self.seq_lens = get_buckets(self.max_seq_length)
+        self.num_workers = num_workers
+        self.vmfb_dir = Path(vmfb_dir)
+        self.vmfb_dir.mkdir(parents=True, exist_ok=True)
+        self.pool = ThreadPoolExecutor(
+            num_workers, thread_name_prefix="shark_embed"
+        )
+        self.compile_lock = threading.Lock()
+        self.worker_modules = threading.local()
+        self.model = None
+
+    def get_vmfb_path(self, batch_size, seq_len):
+        name = "%s_%s%s_%dx%d_%s" % (
+            self.model_name.split("/")[-1],
+            self.pooling,
+            "_norm" if self.normalize else "",
+            batch_size,
+            seq_len,
+            self.device,
+        )
+        return self.vmfb_dir / (name + ".vmfb")
+
+    def compile_bucket(self, batch_size, seq_len):
+        """
+        Returns the vmfb of the bucket, compiling it first if it does not
+        exist. The vmfb is written under a temporary name and renamed, so
+        other workers and processes never load a partial file.
+        """
+        vmfb_path = self.get_vmfb_path(batch_size, seq_len)
+        with self.compile_lock:
+            if vmfb_path.exists():
+                return vmfb_path
+            if self.model is None:
+                self.model = SentenceEmbeddingModel(
+                    self.model_name, self.pooling, self.normalize
+                )
+            compile_inputs = (
+                torch.zeros([batch_size, seq_len], dtype=torch.int64),
+                torch.ones([batch_size, seq_len], dtype=torch.int64),
+            )
+            print(
+                f"[DEBUG] compiling {self.model_name} for batch "
+                f"{batch_size} x {seq_len} tokens"
+            )
+            mlir_module, _ = import_with_fx(
+                self.model, compile_inputs, f16_input_mask=[False, False]
+            )
+            shark_module = SharkInference(
+                mlir_module=mlir_module,
+                device=self.device,
+                mlir_dialect="linalg",
+            )
+            tmp_path = shark_module.save_module(
+                str(self.vmfb_dir),
+                "%s.%d.tmp" % (vmfb_path.stem, os.getpid()),
+                debug=False,
+            )
+            os.replace(tmp_path, vmfb_path)
+        return vmfb_path
+
+    def get_module(self, batch_size, seq_len):
+        modules = getattr(self.worker_modules, "modules", None)
+        if modules is None:
+            modules = self.worker_modules.modules = {}
+        key = (batch_size, seq_len)
+        if key not in modules:
+            vmfb_path = self.compile_bucket(batch_size, seq_len)
+            shark_module = SharkInference(
+                None, device=self.device, mlir_dialect="linalg"
+            )
+            shark_module.load_module(str(vmfb_path))
+            modules[key] = shark_module
+        return modules[key]
+
+    def run_batch(self, batch_size, seq_len, token_ids):
+        input_ids = np.zeros([batch_size, seq_len], dtype=np.int64)
+        attention_mask = np.zeros([batch_size, seq_len], dtype=np.int64)
+        for row, ids in enumerate(token_ids):
+            input_ids[row, : len(ids)] = ids
+            attention_mask[row, : len(ids)] = 1
+        if len(token_ids) < batch_size:
+            # Rows only filling up the batch attend to a single token.
+            attention_mask[len(token_ids) :, 0] = 1
+        shark_module = self.get_module(batch_size, seq_len)
+        embeddings = shark_module("forward", (input_ids, attention_mask))
+        return np.asarray(embeddings)[: len(token_ids)]
+
+    def embed(self, texts):
+        if not texts:
+            return []
+        token_ids = self.tokenizer(
+            [x.replace("\n", " ") for x in texts],
+            truncation=True,
+            max_length=self.max_seq_length,
+        )["input_ids"]
+        batches = plan_batches(
+            np.array([len(x) for x in token_ids]),
+            self.batch_sizes,
+            self.seq_lens,
+        )
+        futures = [
+            (
+                indices,
+                self.pool.submit(
+                    self.run_batch,
+                    batch_size,
+                    seq_len,
+                    [token_ids[i] for i in indices],
+                ),
+            )
+            for batch_size, seq_len, indices in batches
+        ]
+        embeddings = [None] * len(texts)
+        for indices, future in futures:
+            for i, embedding in zip(indices, future.result()):
+                embeddings[i] = embedding.tolist()
+        return embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed([text])[0]
+
+
+def test_plan_batches():
+    lengths = np.array([200, 10, 30, 70, 33, 5, 256])
+    batches = plan_batches(lengths, (1, 32), (32, 64, 128, 256))
+    # Every text is in exactly one batch, in a bucket that holds it.
+    indices = [i for _, _, batch in batches for i in batch]
+    assert sorted(indices) == list(range(len(lengths)))
+    for batch_size, seq_len, batch in batches:
+        assert len(batch) <= batch_size
+        assert all(lengths[i] <= seq_len for i in batch)
+    # Short texts are not padded to the longest one.
+    assert batches == [
+        (32, 32, [5, 1, 2]),
+        (1, 64, [4]),
+        (1, 128, [3]),
+        (32, 256, [0, 6]),
+    ]
+
+
+def test_plan_batches_splits_at_max_batch_size():
+    batches = plan_batches(np.full(70, 20), (1, 32), (32, 64))
+    assert [(x[0], x[1], len(x[2])) for x in batches] == [
+        (32, 32, 32),
+        (32, 32, 32),
+        (32, 32, 6),
+    ]
+    assert plan_batches(np.array([3]), (1, 32), (32,)) == [(1, 32, [0])]
+    assert plan_batches(np.array([], dtype=int), (1, 32), (32,)) == []
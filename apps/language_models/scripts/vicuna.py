@@ -1,4 +1,5 @@
 import argparse
+import functools
 import json
 import re
 import gc
@@ -10,10 +11,11 @@ from typing import List, Tuple
 import subprocess
 import sys
 import time
-from dataclasses import dataclass
-from os import environ
-from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from os import environ
+import threading
 
 import torch
 import torch_mlir
@@ -26,6 +28,10 @@ from apps.language_models.src.model_wrappers.vicuna_sharded_model import (
     FirstVicunaLayer,
     SecondVicunaLayer,
     CompiledVicunaLayer,
+    KVSlotWriter,
+    PipelineStage,
+    RingKVCache,
+    RingKVCacheManager,
     ShardedVicunaModel,
     LMHead,
     LMHeadCompiled,
@@ -34,6 +40,9 @@ from apps.language_models.src.model_wrappers.vicuna_sharded_model import (
     VicunaNorm,
     VicunaNormCompiled,
 )
+from apps.language_models.src.model_wrappers.prefix_kv_cache import (
+    PrefixKVCache,
+)
 from apps.language_models.src.model_wrappers.vicuna4 import (
     LlamaModel,
     EightLayerLayerSV,
@@ -61,6 +70,7 @@ from shark.shark_downloader import download_public_file
 from shark.shark_importer import get_f16_inputs
 from shark.shark_importer import import_with_fx, save_mlir
 from shark.shark_inference import SharkInference
+from shark.sharded_build import LayerBuild, ShardedBuilder
 
 
 parser = argparse.ArgumentParser(
@@ -112,7 +122,7 @@ parser.add_argument(
 )
 
 parser.add_argument(
-    "--n_devices", type=int, default=None, help="Number of GPUs to use"
+    "--n_devices", type=int, default=None, help="Number of GPUs to use. Contiguous ranges of layers are placed on each device and run as pipeline stages. With cpu, each device is its own instance of the cpu device"
 )
 
 parser.add_argument(
@@ -190,6 +200,42 @@ parser.add_argument(
     default="Hi",
     help="Specify the user prompt. This is only used with `--enable_microbenchmark`",
 )
+parser.add_argument(
+    "--kv_cache_capacity",
+    type=int,
+    default=None,
+    help="Number of tokens of kv cache per layer and sequence, kept on the device, for the sharded model. Older tokens are evicted once it is full. Default: grow the cache with the context.",
+)
+parser.add_argument(
+    "--kv_cache_sink_tokens",
+    type=int,
+    default=0,
+    help="Number of leading tokens that are never evicted from the kv cache (see --kv_cache_capacity). Default: 0.",
+)
+parser.add_argument(
+    "--build_workers",
+    type=int,
+    default=4,
+    help="Number of processes compiling the layers of the sharded model in parallel. Default: 4.",
+)
+parser.add_argument(
+    "--build_memory_limit_gb",
+    type=float,
+    default=None,
+    help="Memory limit in GB of each process compiling a layer of the sharded model. Default: unlimited.",
+)
+parser.add_argument(
+    "--prefix_cache_gb",
+    type=float,
+    default=None,
+    help="Memory budget in GB for keeping the kv cache of the conversation between turns of the unsharded model, so each turn only prefills the new tokens. Default: disabled.",
+)
+parser.add_argument(
+    "--microbenchmark_interleave",
+    type=int,
+    default=1,
+    help="Number of microbenchmark iterations interleaved token by token by the VicunaInterleavedScheduler. The compiled modules are batch 1, so every step still runs them once per sequence. Default: 1.",
+)
 
 # fmt: off
 def quant〇matmul_rhs_group_quant〡shape(lhs: List[int], rhs: List[int], rhs_scale: List[int], rhs_zero_point: List[int], rhs_bit_width: int, rhs_group_size: int) -> List[int]:
@@ -510,8 +556,16 @@ class ShardedVicuna(VicunaBase):
         extra_args_cmd=[],
         debug=False,
         n_devices=None,
+        kv_cache_capacity=None,
+        kv_cache_sink_tokens=0,
+        build_workers=4,
+        build_memory_limit_gb=None,
     ) -> None:
         self.hf_auth_token = hf_auth_token
+        self.kv_cache_capacity = kv_cache_capacity
+        self.build_workers = build_workers
+        self.build_memory_limit_gb = build_memory_limit_gb
+        self.kv_cache_sink_tokens = kv_cache_sink_tokens
         self.hidden_state_size_dict = {"vicuna": 4096, "llama2_7b": 4096, "llama2_13b" : 5120, "llama2_70b" : 8192}
         self.n_layers_dict = {"vicuna": 32, "llama2_7b": 32, "llama2_13b" : 40, "llama2_70b" : 80}
         super().__init__(
@@ -1031,202 +1085,24 @@ class ShardedVicuna(VicunaBase):
                 inpt.to(torch.float16) if inpt.dtype == torch.float32 else inpt
                 for inpt in inputs1
             )
-        mlirs, modules = [], []
         assert len(layers0) == len(layers1)
-        for layer0, layer1, idx in zip(layers0, layers1, range(len(layers0))):
-            mlir_path = Path(f"{self.dir_name}/{idx}_full.mlir")
-            vmfb_path = Path(f"{self.dir_name}/{idx}_full.vmfb")
-            # if vmfb_path.exists():
-            #    continue
-            if mlir_path.exists():
-                f_ = open(mlir_path, "rb")
-                bytecode = f_.read()
-                f_.close()
-                mlirs.append(bytecode)
-            else:
-                hidden_states_placeholder0 = TensorPlaceholder.like(
-                    inputs0[0], dynamic_axes=[1]
-                )
-                attention_mask_placeholder0 = TensorPlaceholder.like(
-                    inputs0[1], dynamic_axes=[3]
-                )
-                position_ids_placeholder0 = TensorPlaceholder.like(
-                    inputs0[2], dynamic_axes=[1]
-                )
-                hidden_states_placeholder1 = TensorPlaceholder.like(
-                    inputs1[0], dynamic_axes=[1]
-                )
-                attention_mask_placeholder1 = TensorPlaceholder.like(
-                    inputs1[1], dynamic_axes=[3]
-                )
-                position_ids_placeholder1 = TensorPlaceholder.like(
-                    inputs1[2], dynamic_axes=[1]
-                )
-                pkv0_placeholder = TensorPlaceholder.like(
-                    inputs1[3], dynamic_axes=[2]
-                )
-                pkv1_placeholder = TensorPlaceholder.like(
-                    inputs1[4], dynamic_axes=[2]
-                )
-
-                print(f"Compiling layer {idx} mlir")
-                ts_g = self.compile_vicuna_layer(
-                    layer0, inputs0[0], inputs0[1], inputs0[2]
-                )
-                if self.precision in ["int4", "int8"]:
-                    from brevitas_examples.common.generative.quantize import (
-                        quantize_model,
-                    )
-                    from brevitas_examples.llm.llm_quant.run_utils import (
-                        get_model_impl,
-                    )
-
-                    hidden_states_placeholder0 = TensorPlaceholder.like(
-                        inputs0[0], dynamic_axes=[1]
-                    )
-                    attention_mask_placeholder0 = TensorPlaceholder.like(
-                        inputs0[1], dynamic_axes=[3]
-                    )
-                    position_ids_placeholder0 = TensorPlaceholder.like(
-                        inputs0[2], dynamic_axes=[1]
-                    )
-                    hidden_states_placeholder1 = TensorPlaceholder.like(
-                        inputs1[0], dynamic_axes=[1]
-                    )
-                    attention_mask_placeholder1 = TensorPlaceholder.like(
-                        inputs1[1], dynamic_axes=[3]
-                    )
-                    position_ids_placeholder1 = TensorPlaceholder.like(
-                        inputs1[2], dynamic_axes=[1]
-                    )
-                    pkv0_placeholder = TensorPlaceholder.like(
-                        inputs1[3], dynamic_axes=[2]
-                    )
-                    pkv1_placeholder = TensorPlaceholder.like(
-                        inputs1[4], dynamic_axes=[2]
-                    )
-
-                    module0 = torch_mlir.compile(
-                        ts_g,
-                        (
-                            hidden_states_placeholder0,
-                            inputs0[1],
-                            inputs0[2],
-                        ),
-                        output_type="torch",
-                        backend_legal_ops=["quant.matmul_rhs_group_quant"],
-                        extra_library=brevitas_matmul_rhs_group_quant_library,
-                        use_tracing=False,
-                        verbose=False,
-                    )
-
-                    print(f"[DEBUG] converting torch to linalg")
-                    run_pipeline_with_repro_report(
-                        module0,
-                        "builtin.module(func.func(torch-unpack-quant-tensor),func.func(torch-convert-custom-quant-op),torch-backend-to-linalg-on-tensors-backend-pipeline)",
-                        description="Lowering Torch Backend IR -> Linalg-on-Tensors Backend IR",
-                    )
-                else:
-                    module0 = torch_mlir.compile(
-                        ts_g,
-                        (
-                            hidden_states_placeholder0,
-                            inputs0[1],
-                            inputs0[2],
-                        ),
-                        torch_mlir.OutputType.LINALG_ON_TENSORS,
-                        use_tracing=False,
-                        verbose=False,
-                    )
-                module0 = self.write_in_dynamic_inputs0(str(module0), 137)
-
-                ts_g = self.compile_vicuna_layer(
-                    layer1,
-                    inputs1[0],
-                    inputs1[1],
-                    inputs1[2],
-                    inputs1[3],
-                    inputs1[4],
-                )
-                if self.precision in ["int4", "int8"]:
-                    module1 = torch_mlir.compile(
-                        ts_g,
-                        (
-                            inputs1[0],
-                            attention_mask_placeholder1,
-                            inputs1[2],
-                            pkv0_placeholder,
-                            pkv1_placeholder,
-                        ),
-                        output_type="torch",
-                        backend_legal_ops=["quant.matmul_rhs_group_quant"],
-                        extra_library=brevitas_matmul_rhs_group_quant_library,
-                        use_tracing=False,
-                        verbose=False,
-                    )
-                    print(f"[DEBUG] converting torch to linalg")
-                    run_pipeline_with_repro_report(
-                        module1,
-                        "builtin.module(func.func(torch-unpack-quant-tensor),func.func(torch-convert-custom-quant-op),torch-backend-to-linalg-on-tensors-backend-pipeline)",
-                        description="Lowering Torch Backend IR -> Linalg-on-Tensors Backend IR",
-                    )
-                else:
-                    module1 = torch_mlir.compile(
-                        ts_g,
-                        (
-                            inputs1[0],
-                            attention_mask_placeholder1,
-                            inputs1[2],
-                            pkv0_placeholder,
-                            pkv1_placeholder,
-                        ),
-                        torch_mlir.OutputType.LINALG_ON_TENSORS,
-                        use_tracing=False,
-                        verbose=False,
-                    )
-                module1 = self.write_in_dynamic_inputs1(str(module1), 138)
-
-                module_combined = self.combine_mlir_scripts(
-                    module0, module1, f"{self.dir_name}/{idx}_full.mlir"
-                )
-                mlirs.append(module_combined)
-
-            if vmfb_path.exists():
-                device_idx = self.get_device_index(
-                    f"first_vicuna.model.model.layers.{idx}[\s.$]"
-                )
-                if device_idx is None:
-                    if self.n_devices is not None:
-                        device_idx = (idx * self.n_devices) // self.n_layers_dict[self.model_name]
-                    else:
-                        device_idx = None
-                module = SharkInference(
-                    None,
+        builds = []
+        for idx, (layer0, layer1) in enumerate(zip(layers0, layers1)):
+            builds.append(
+                LayerBuild(
+                    f"layer{idx}",
+                    f"{self.dir_name}/{idx}_full.mlir",
+                    f"{self.dir_name}/{idx}_full.vmfb",
+                    import_fn=functools.partial(
+                        self.import_vicuna_layer,
+                        idx,
+                        layer0,
+                        inputs0,
+                        layer1,
+                        inputs1,
+                    ),
                     device=device,
-                    device_idx=device_idx,
                     mlir_dialect="tm_tensor",
-                    mmap=True,
-                )
-                module.load_module(vmfb_path)
-            else:
-                print(f"Compiling layer {idx} vmfb")
-                device_idx = self.get_device_index(
-                    f"first_vicuna.model.model.layers.{idx}[\s.$]"
-                )
-                if device_idx is None:
-                    if self.n_devices is not None:
-                        device_idx = (idx * self.n_devices) // self.n_layers_dict[self.model_name]
-                    else:
-                        device_idx = None
-                module = SharkInference(
-                    mlirs[idx],
-                    device=device,
-                    device_idx=device_idx,
-                    mlir_dialect="tm_tensor",
-                    mmap=True,
-                )
-                module.save_module(
-                    module_name=f"{self.dir_name}/{idx}_full",
                     extra_args=[
                         "--iree-vm-target-truncate-unsupported-floats",
                         "--iree-codegen-check-ir-before-llvm-conversion=false",
@@ -1235,9 +1111,183 @@ class ShardedVicuna(VicunaBase):
                     + self.extra_args,
                     debug=self.debug,
                 )
-                module.load_module(vmfb_path)
+            )
+        # Layers are imported here while earlier ones compile in parallel.
+        ShardedBuilder(
+            self.dir_name,
+            num_workers=self.build_workers,
+            memory_limit_gb=self.build_memory_limit_gb,
+        ).build(builds)
+
+        modules = []
+        for idx, build in enumerate(builds):
+            device_idx = self.get_device_index(
+                f"first_vicuna.model.model.layers.{idx}[\s.$]"
+            )
+            if device_idx is None:
+                if self.n_devices is not None:
+                    device_idx = (idx * self.n_devices) // self.n_layers_dict[self.model_name]
+                else:
+                    device_idx = None
+            module = SharkInference(
+                None,
+                device=device,
+                device_idx=device_idx,
+                mlir_dialect="tm_tensor",
+                mmap=True,
+            )
+            module.load_module(build.vmfb_path)
             modules.append(module)
-        return mlirs, modules
+        return [build.mlir_path for build in builds], modules
+
+    def import_vicuna_layer(
+        self, idx, layer0, inputs0, layer1, inputs1, path
+    ):
+        # Imports the first and second vicuna of a layer and writes them,
+        # combined, to `path`.
+        hidden_states_placeholder0 = TensorPlaceholder.like(
+            inputs0[0], dynamic_axes=[1]
+        )
+        attention_mask_placeholder0 = TensorPlaceholder.like(
+            inputs0[1], dynamic_axes=[3]
+        )
+        position_ids_placeholder0 = TensorPlaceholder.like(
+            inputs0[2], dynamic_axes=[1]
+        )
+        hidden_states_placeholder1 = TensorPlaceholder.like(
+            inputs1[0], dynamic_axes=[1]
+        )
+        attention_mask_placeholder1 = TensorPlaceholder.like(
+            inputs1[1], dynamic_axes=[3]
+        )
+        position_ids_placeholder1 = TensorPlaceholder.like(
+            inputs1[2], dynamic_axes=[1]
+        )
+        pkv0_placeholder = TensorPlaceholder.like(
+            inputs1[3], dynamic_axes=[2]
+        )
+        pkv1_placeholder = TensorPlaceholder.like(
+            inputs1[4], dynamic_axes=[2]
+        )
+
+        print(f"Compiling layer {idx} mlir")
+        ts_g = self.compile_vicuna_layer(
+            layer0, inputs0[0], inputs0[1], inputs0[2]
+        )
+        if self.precision in ["int4", "int8"]:
+            from brevitas_examples.common.generative.quantize import (
+                quantize_model,
+            )
+            from brevitas_examples.llm.llm_quant.run_utils import (
+                get_model_impl,
+            )
+
+            hidden_states_placeholder0 = TensorPlaceholder.like(
+                inputs0[0], dynamic_axes=[1]
+            )
+            attention_mask_placeholder0 = TensorPlaceholder.like(
+                inputs0[1], dynamic_axes=[3]
+            )
+            position_ids_placeholder0 = TensorPlaceholder.like(
+                inputs0[2], dynamic_axes=[1]
+            )
+            hidden_states_placeholder1 = TensorPlaceholder.like(
+                inputs1[0], dynamic_axes=[1]
+            )
+            attention_mask_placeholder1 = TensorPlaceholder.like(
+                inputs1[1], dynamic_axes=[3]
+            )
+            position_ids_placeholder1 = TensorPlaceholder.like(
+                inputs1[2], dynamic_axes=[1]
+            )
+            pkv0_placeholder = TensorPlaceholder.like(
+                inputs1[3], dynamic_axes=[2]
+            )
+            pkv1_placeholder = TensorPlaceholder.like(
+                inputs1[4], dynamic_axes=[2]
+            )
+
+            module0 = torch_mlir.compile(
+                ts_g,
+                (
+                    hidden_states_placeholder0,
+                    inputs0[1],
+                    inputs0[2],
+                ),
+                output_type="torch",
+                backend_legal_ops=["quant.matmul_rhs_group_quant"],
+                extra_library=brevitas_matmul_rhs_group_quant_library,
+                use_tracing=False,
+                verbose=False,
+            )
+
+            print(f"[DEBUG] converting torch to linalg")
+            run_pipeline_with_repro_report(
+                module0,
+                "builtin.module(func.func(torch-unpack-quant-tensor),func.func(torch-convert-custom-quant-op),torch-backend-to-linalg-on-tensors-backend-pipeline)",
+                description="Lowering Torch Backend IR -> Linalg-on-Tensors Backend IR",
+            )
+        else:
+            module0 = torch_mlir.compile(
+                ts_g,
+                (
+                    hidden_states_placeholder0,
+                    inputs0[1],
+                    inputs0[2],
+                ),
+                torch_mlir.OutputType.LINALG_ON_TENSORS,
+                use_tracing=False,
+                verbose=False,
+            )
+        module0 = self.write_in_dynamic_inputs0(str(module0), 137)
+
+        ts_g = self.compile_vicuna_layer(
+            layer1,
+            inputs1[0],
+            inputs1[1],
+            inputs1[2],
+            inputs1[3],
+            inputs1[4],
+        )
+        if self.precision in ["int4", "int8"]:
+            module1 = torch_mlir.compile(
+                ts_g,
+                (
+                    inputs1[0],
+                    attention_mask_placeholder1,
+                    inputs1[2],
+                    pkv0_placeholder,
+                    pkv1_placeholder,
+                ),
+                output_type="torch",
+                backend_legal_ops=["quant.matmul_rhs_group_quant"],
+                extra_library=brevitas_matmul_rhs_group_quant_library,
+                use_tracing=False,
+                verbose=False,
+            )
+            print(f"[DEBUG] converting torch to linalg")
+            run_pipeline_with_repro_report(
+                module1,
+                "builtin.module(func.func(torch-unpack-quant-tensor),func.func(torch-convert-custom-quant-op),torch-backend-to-linalg-on-tensors-backend-pipeline)",
+                description="Lowering Torch Backend IR -> Linalg-on-Tensors Backend IR",
+            )
+        else:
+            module1 = torch_mlir.compile(
+                ts_g,
+                (
+                    inputs1[0],
+                    attention_mask_placeholder1,
+                    inputs1[2],
+                    pkv0_placeholder,
+                    pkv1_placeholder,
+                ),
+                torch_mlir.OutputType.LINALG_ON_TENSORS,
+                use_tracing=False,
+                verbose=False,
+            )
+        module1 = self.write_in_dynamic_inputs1(str(module1), 138)
+
+        self.combine_mlir_scripts(module0, module1, path)
 
     def compile_to_vmfb_one_model4(
         self, inputs0, layers0, inputs1, layers1, device="cpu"
@@ -1394,8 +1444,8 @@ class ShardedVicuna(VicunaBase):
         device_idx = self.get_device_index(
             r"vicuna\.model\.model\.norm(?:\.|\s|$)"
         )
-        # HC device_idx for non-layer vmfbs
-        device_idx = 0
+        if device_idx is None:
+            device_idx = self.get_last_device_index()
         norm = self.compile_norm(
             norm,
             torch.zeros([1, SAMPLE_INPUT_LEN, self.hidden_state_size_dict[self.model_name]]),
@@ -1407,8 +1457,8 @@ class ShardedVicuna(VicunaBase):
         device_idx = self.get_device_index(
             r"vicuna\.model\.model\.embed_tokens(?:\.|\s|$)"
         )
-        # HC device_idx for non-layer vmfbs
-        device_idx = 0
+        if device_idx is None:
+            device_idx = 0
         embeddings = self.compile_embedding(
             embeddings,
             (torch.zeros([1, SAMPLE_INPUT_LEN], dtype=torch.int64)),
@@ -1420,8 +1470,8 @@ class ShardedVicuna(VicunaBase):
         device_idx = self.get_device_index(
             r"vicuna\.model\.lm_head(?:\.|\s|$)"
         )
-        # HC device_idx for non-layer vmfbs
-        device_idx = 0
+        if device_idx is None:
+            device_idx = self.get_last_device_index()
         lmhead = self.compile_lmhead(
             lmhead,
             torch.zeros([1, SAMPLE_INPUT_LEN, self.hidden_state_size_dict[self.model_name]]),
@@ -1457,13 +1507,19 @@ class ShardedVicuna(VicunaBase):
             device=device,
         )
 
+        pipeline_stages = []
         if not compressed:
             if self.n_devices is None:
                 breakpoints = None
             else:
-                breakpoints = [x for x in range(0,len(modules),(self.n_devices % 2) + (len(modules)//(self.n_devices)))][1:] + [len(modules)]
-            shark_layers = [CompiledVicunaLayer(m, i, breakpoints) for (i, m) in enumerate(modules)]
+                # Outputs are only pulled to host where the next layer runs on
+                # another device, i.e. at the end of each pipeline stage.
+                breakpoints = [i + 1 for i in range(len(modules) - 1) if modules[i].device_idx != modules[i + 1].device_idx] + [len(modules)]
+                pipeline_stages, modules = self.get_pipeline_stages(embeddings, modules, norm, lmhead)
+            kv_cache = self.get_kv_cache(vicuna_model.config, modules, device)
+            shark_layers = [CompiledVicunaLayer(m, i, breakpoints, kv_cache) for (i, m) in enumerate(modules)]
         else:
+            kv_cache = None
             shark_layers = [CompiledEightLayerLayer(m) for m in modules]
             vicuna_model.model.compressedlayers = shark_layers
 
@@ -1473,9 +1529,84 @@ class ShardedVicuna(VicunaBase):
             lmhead,
             embeddings,
             norm,
+            kv_cache=kv_cache,
+            pipeline_stages=pipeline_stages,
         )
         return sharded_model
 
+    def get_last_device_index(self):
+        return 0 if self.n_devices is None else self.n_devices - 1
+
+    def get_pipeline_stages(self, embeddings, layer_modules, norm, lmhead):
+        # Groups the compiled modules by device into pipeline stages, in the
+        # order they run. Returns the stages and the stage bound layer modules.
+        stages = {}
+
+        def bind(shark_module, name):
+            if shark_module.device_idx not in stages:
+                stages[shark_module.device_idx] = PipelineStage(shark_module.device_idx)
+            return stages[shark_module.device_idx].bind(shark_module, name)
+
+        embeddings.model = bind(embeddings.model, "embedding")
+        layer_modules = [bind(m, f"layer{idx}") for idx, m in enumerate(layer_modules)]
+        norm.model = bind(norm.model, "norm")
+        lmhead.model = bind(lmhead.model, "lmhead")
+        for stage in stages.values():
+            print(f"[DEBUG] pipeline stage on device {stage.device_idx}: {stage.module_names}")
+        return list(stages.values()), layer_modules
+
+    def get_kv_cache(self, model_config, modules, device):
+        # Creates the fixed-capacity key/value buffers of each sequence, see
+        # RingKVCache. The layer vmfbs take dynamically sized caches, so no
+        # recompilation is needed.
+        if self.kv_cache_capacity is None:
+            return None
+        num_heads = getattr(model_config, "num_key_value_heads", None) or model_config.num_attention_heads
+        kv_cache = RingKVCacheManager(
+            num_layers=self.n_layers_dict[self.model_name],
+            num_heads=num_heads,
+            head_dim=model_config.hidden_size // model_config.num_attention_heads,
+            capacity=self.kv_cache_capacity,
+            num_sink_tokens=self.kv_cache_sink_tokens,
+            dtype=torch.float32 if self.precision == "fp32" else torch.float16,
+        )
+        if "cpu" not in device:
+            # Device local buffers are not host mappable, new entries are
+            # written into their slot on the device.
+            for device_idx in sorted({m.device_idx for m in modules}, key=str):
+                kv_cache.slot_writers[device_idx] = self.compile_kv_slot_writer(kv_cache, device, device_idx)
+        print(f"[DEBUG] kv cache: {kv_cache.bytes_per_sequence()} bytes per sequence")
+        return kv_cache
+
+    def compile_kv_slot_writer(self, kv_cache, device, device_idx):
+        name = f"kv_slot_writer_{kv_cache.capacity}_{self.precision}_{device_idx}"
+        mlir_path = Path(f"{self.dir_name}/{name}.mlir")
+        vmfb_path = Path(f"{self.dir_name}/{name}.vmfb")
+        if not mlir_path.exists():
+            cache = torch.zeros(kv_cache.shape, dtype=kv_cache.dtype)
+            appended = torch.zeros(kv_cache.shape[:2] + [kv_cache.capacity + 1] + kv_cache.shape[3:], dtype=kv_cache.dtype)
+            slot_mask = torch.zeros([1, 1, kv_cache.capacity, 1], dtype=torch.int64)
+            module = torch_mlir.compile(
+                KVSlotWriter(),
+                (cache, appended, slot_mask),
+                torch_mlir.OutputType.LINALG_ON_TENSORS,
+                use_tracing=False,
+                verbose=False,
+            )
+            with open(mlir_path, "w+") as f_:
+                f_.write(str(module))
+        shark_module = SharkInference(
+            mlir_path,
+            device=device,
+            mlir_dialect="tm_tensor",
+            device_idx=device_idx,
+            mmap=True,
+        )
+        if not vmfb_path.exists():
+            shark_module.save_module(module_name=f"{self.dir_name}/{name}", debug=self.debug)
+        shark_module.load_module(vmfb_path)
+        return shark_module
+
     def compile(self, device="cpu"):
         return self.get_sharded_model(
             device=device, compressed=self.compressed
@@ -1518,6 +1649,8 @@ class ShardedVicuna(VicunaBase):
         for i in range(len(tokens_generated)):
             if type(tokens_generated[i]) != int:
                 tokens_generated[i] = int(tokens_generated[i][0])
+        if isinstance(_past_key_values, RingKVCache):
+            print(f"kv cache: {_past_key_values.get_memory_info()}")
         result_output = self.tokenizer.decode(tokens_generated)
         yield result_output, "formatted", None
 
@@ -1547,6 +1680,7 @@ class UnshardedVicuna(VicunaBase):
         cache_vicunas=False,
         extra_args_cmd=[],
         debug=False,
+        prefix_cache_gb=None,
     ) -> None:
         super().__init__(
             model_name,
@@ -1555,6 +1689,10 @@ class UnshardedVicuna(VicunaBase):
             extra_args_cmd=extra_args_cmd,
         )
         self.hf_auth_token = hf_auth_token
+        # Keys/values of the conversation so far, per chat session.
+        self.prefix_cache = None
+        if prefix_cache_gb:
+            self.prefix_cache = PrefixKVCache(int(prefix_cache_gb * (1 << 30)))
         if self.model_name == "llama2_7b":
             self.hf_model_path = "meta-llama/Llama-2-7b-chat-hf"
         elif self.model_name == "llama2_13b":
@@ -2100,18 +2238,54 @@ class UnshardedVicuna(VicunaBase):
         res_str = self.tokenizer.decode(res_tokens, skip_special_tokens=False)
         return res_str
 
-    def generate(self, prompt, cli):
+    def extend_past_key_values(self, token_ids, past_key_values, cli):
+        # Runs `token_ids` one at a time after the cached ones, returns the
+        # output of the last, as a prefill would.
+        for token in token_ids:
+            params = {
+                "token": token,
+                "is_first": False,
+                "past_key_values": past_key_values,
+                "sv": self.shark_model,
+            }
+            generated_token_op = self.generate_new_token(
+                params=params, sharded=False, cli=cli
+            )
+            past_key_values = generated_token_op["past_key_values"]
+        return generated_token_op
+
+    def generate(self, prompt, cli, session_id=None):
         # TODO: refactor for cleaner integration
         if self.shark_model is None:
             self.compile()
         res_tokens = []
         params = {"prompt": prompt, "is_first": True, "fv": self.shark_model}
 
-        prefill_st_time = time.time()
-        generated_token_op = self.generate_new_token(
-            params=params, sharded=False, cli=cli
+        use_prefix_cache = (
+            self.prefix_cache is not None and session_id is not None
         )
+        prefix_len = 0
+        if use_prefix_cache:
+            # The token ids the past key/values hold at every step.
+            cached_ids = self.tokenizer(prompt).input_ids
+            prefix_len, pkv = self.prefix_cache.take(session_id, cached_ids)
+
+        prefill_st_time = time.time()
+        if prefix_len > 0:
+            generated_token_op = self.extend_past_key_values(
+                cached_ids[prefix_len:], pkv, cli
+            )
+        else:
+            generated_token_op = self.generate_new_token(
+                params=params, sharded=False, cli=cli
+            )
         prefill_time_ms = (time.time() - prefill_st_time) * 1000
+        if use_prefix_cache and prefix_len > 0:
+            self.prefix_cache.record_extend(
+                len(cached_ids), len(cached_ids) - prefix_len, prefill_time_ms
+            )
+        elif use_prefix_cache:
+            self.prefix_cache.record_prefill(len(cached_ids), prefill_time_ms)
 
         token = generated_token_op["token"]
         if "cpu" not in self.device:
@@ -2139,6 +2313,8 @@ class UnshardedVicuna(VicunaBase):
                 params=params, sharded=False, cli=cli
             )
             decode_time_ms = (time.time() - decode_st_time) * 1000
+            if use_prefix_cache:
+                cached_ids.append(int(token))
 
             token = generated_token_op["token"]
             if "cpu" not in self.device:
@@ -2157,6 +2333,8 @@ class UnshardedVicuna(VicunaBase):
                     print(f"{detok}", end=" ", flush=True)
             yield detok, None, decode_time_ms
 
+        if use_prefix_cache:
+            self.prefix_cache.put(session_id, cached_ids, pkv)
         res_str = self.decode_tokens(res_tokens)
         yield res_str, "formatted", None
 
@@ -2317,6 +2495,175 @@ def print_aggregate_stats(run_infos: list[BenchmarkRunInfo]) -> None:
     print(f"Decode end-2-end: avg. {avg_e2e_decode_speed:.2f} tokens/s (w/o prompt), avg. {avg_e2e_processing_speed:.2f} (w/ prompt)")
 
 
+@dataclass
+class VicunaSequence:
+    # State of one conversation stepped by VicunaInterleavedScheduler.
+    seq_id : int
+    prompt : str
+    num_prompt_tokens : int = 0
+    token : int = None
+    past_key_values : tuple = None
+    logits : object = None
+    tokens : list[int] = field(default_factory=list)
+    prefill_time_ms : float = 0.0
+    token_times_ms : list[float] = field(default_factory=list)
+    finished : bool = False
+
+    def run_info(self) -> BenchmarkRunInfo:
+        return BenchmarkRunInfo(self.num_prompt_tokens, self.prefill_time_ms, self.token_times_ms)
+
+
+class VicunaInterleavedScheduler:
+    """
+    Interleaves several conversations on one Vicuna model.
+
+    Every `step` first prefills up to `max_prefills_per_step` waiting
+    prompts, then decodes one token for each active sequence, so newly
+    admitted prompts never wait for the running conversations to finish.
+    Each sequence keeps its own past_key_values, and a sequence is retired
+    as soon as it hits the stop token (or max_num_tokens) without stalling
+    the others.
+
+    This is not batched decoding: the compiled first/second_vicuna_forward
+    functions take a single sequence with no attention mask or position
+    inputs, so every step runs them once per active sequence. What is
+    gained is latency for new prompts, not throughput per call. With
+    `pipeline_depth` > 1 up to that many sequences are stepped
+    concurrently, which lets the stages of a pipeline-parallel
+    ShardedVicuna work on different sequences at once.
+    """
+
+    def __init__(self, vic, max_active_sequences=8, max_prefills_per_step=1, sharded=False, pipeline_depth=1):
+        self.vic = vic
+        self.pipeline_depth = pipeline_depth
+        self._executor = ThreadPoolExecutor(pipeline_depth, "vicuna_pipeline") if pipeline_depth > 1 else None
+        self.max_active_sequences = max(1, max_active_sequences)
+        self.max_prefills_per_step = max(1, max_prefills_per_step)
+        self.sharded = sharded
+        self.stop_token = 2
+        self.min_num_tokens = getattr(vic, "min_num_tokens", 0)
+        self._waiting = deque()
+        self._active = []
+        self._finished = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._start_time = None
+        self._end_time = None
+
+    def add_request(self, prompt) -> int:
+        # Safe to call from other threads while `run` is stepping.
+        with self._lock:
+            seq = VicunaSequence(self._next_id, prompt)
+            self._next_id += 1
+            self._waiting.append(seq)
+        return seq.seq_id
+
+    def has_pending(self) -> bool:
+        with self._lock:
+            return bool(self._waiting or self._active)
+
+    def _run_step(self, seq, params):
+        if "cpu" not in self.vic.device and seq.logits is not None:
+            params["logits"] = seq.logits
+        st_time = time.time()
+        generated_token_op = self.vic.generate_new_token(params=params, sharded=self.sharded, cli=False)
+        time_ms = (time.time() - st_time) * 1000
+        seq.token = int(generated_token_op["token"])
+        seq.past_key_values = generated_token_op["past_key_values"]
+        seq.logits = generated_token_op.get("logits")
+        return time_ms, generated_token_op["detok"]
+
+    def _prefill(self, seq):
+        seq.num_prompt_tokens = len(self.vic.tokenizer(seq.prompt).input_ids)
+        params = {"prompt": seq.prompt, "is_first": True}
+        seq.prefill_time_ms, detok = self._run_step(seq, params)
+        seq.tokens.append(seq.token)
+        return detok
+
+    def _decode(self, seq):
+        idx = len(seq.token_times_ms)
+        params = {"token": seq.token, "is_first": False, "past_key_values": seq.past_key_values}
+        time_ms, detok = self._run_step(seq, params)
+        if seq.token == self.stop_token and idx >= self.min_num_tokens:
+            seq.finished = True
+            return None
+        seq.token_times_ms.append(time_ms)
+        seq.tokens.append(seq.token)
+        if len(seq.token_times_ms) >= self.vic.max_num_tokens:
+            seq.finished = True
+        return detok
+
+    def _retire(self, seq):
+        # Dropping the past_key_values frees the device memory of the sequence.
+        seq.past_key_values = None
+        seq.logits = None
+        self._finished[seq.seq_id] = seq
+
+    def step(self) -> list[tuple[int, str, bool]]:
+        """
+        Runs one scheduling round and returns (seq_id, detok, finished) for
+        every sequence that was stepped. detok is None for the stop token.
+        """
+        if self._start_time is None:
+            self._start_time = time.time()
+            for stage in getattr(self.vic.shark_model, "pipeline_stages", []):
+                stage.reset_stats()
+        with self._lock:
+            admitted = []
+            while (
+                self._waiting
+                and len(admitted) < self.max_prefills_per_step
+                and len(self._active) + len(admitted) < self.max_active_sequences
+            ):
+                admitted.append(self._waiting.popleft())
+            decoding = list(self._active)
+
+        work = [(self._decode, seq) for seq in decoding] + [(self._prefill, seq) for seq in admitted]
+        if self._executor is None:
+            detoks = [fn(seq) for fn, seq in work]
+        else:
+            detoks = list(self._executor.map(lambda w: w[0](w[1]), work))
+        events = [(seq.seq_id, detok, seq.finished) for (_, seq), detok in zip(work, detoks)]
+
+        with self._lock:
+            self._active = [seq for seq in decoding + admitted if not seq.finished]
+        for seq in decoding:
+            if seq.finished:
+                self._retire(seq)
+        self._end_time = time.time()
+        return events
+
+    def run(self, callback=None) -> dict[int, VicunaSequence]:
+        """
+        Steps until all queued prompts are served. `callback`, if given, is
+        called with every (seq_id, detok, finished) event as it is produced.
+        """
+        while self.has_pending():
+            for event in self.step():
+                if callback is not None:
+                    callback(*event)
+        return dict(self._finished)
+
+    def get_response(self, seq_id) -> str:
+        return self.vic.tokenizer.decode(self._finished[seq_id].tokens, skip_special_tokens=False)
+
+    def print_stats(self) -> None:
+        sequences = sorted(self._finished.values(), key=lambda seq: seq.seq_id)
+        for seq in sequences:
+            print(f"\n### Sequence {seq.seq_id} ###")
+            seq.run_info().print()
+        print("\n### Aggregate ###")
+        print_aggregate_stats([seq.run_info() for seq in sequences])
+        if self._start_time is None:
+            return
+        wall_time_s = self._end_time - self._start_time
+        num_generated = sum(seq.run_info().num_generated_tokens() for seq in sequences)
+        if wall_time_s > 0:
+            print(f"Served {len(sequences)} sequences, {num_generated} tokens in {wall_time_s:.2f} s: {num_generated / wall_time_s:.2f} tokens/s")
+        for stage_stats in getattr(self.vic.shark_model, "get_stage_stats", lambda: [])():
+            print(f"Pipeline stage: {stage_stats}")
+
+
 if __name__ == "__main__":
     args, unknown = parser.parse_known_args()
 
@@ -2398,6 +2745,7 @@ if __name__ == "__main__":
             cache_vicunas=args.cache_vicunas,
             extra_args_cmd=_extra_args,
             device_id=device_id,
+            prefix_cache_gb=args.prefix_cache_gb,
         )
     else:
         if args.config is not None:
@@ -2420,6 +2768,10 @@ if __name__ == "__main__":
             weight_group_size=args.weight_group_size,
             extra_args_cmd=_extra_args,
             n_devices=args.n_devices,
+            kv_cache_capacity=args.kv_cache_capacity,
+            kv_cache_sink_tokens=args.kv_cache_sink_tokens,
+            build_workers=args.build_workers,
+            build_memory_limit_gb=args.build_memory_limit_gb,
         )
 
     history = []
@@ -2428,6 +2780,19 @@ if __name__ == "__main__":
 
     benchmark_run_infos = []
 
+    if args.enable_microbenchmark and args.microbenchmark_interleave > 1:
+        scheduler = VicunaInterleavedScheduler(
+            vic,
+            max_active_sequences=args.microbenchmark_interleave,
+            sharded=args.sharded,
+            pipeline_depth=len(getattr(vic.shark_model, "pipeline_stages", [])) or 1,
+        )
+        for _ in range(args.microbenchmark_iterations):
+            scheduler.add_request(args.system_prompt + args.user_prompt)
+        scheduler.run()
+        print("\n### Final Statistics ###")
+        scheduler.print_stats()
+        sys.exit(0)
 
     while True:
         # TODO: Add break condition from user input
@@ -2448,7 +2813,11 @@ if __name__ == "__main__":
         prefill_time_ms = 0
         is_first = True
         token_times_ms = []
-        for text, msg, exec_time in vic.generate(prompt, cli=True):
+        # The interactive chat is one session, benchmark runs are not.
+        generate_kwargs = {}
+        if not args.sharded and not args.enable_microbenchmark:
+            generate_kwargs["session_id"] = "cli"
+        for text, msg, exec_time in vic.generate(prompt, cli=True, **generate_kwargs):
             if args.enable_tracing:
                 vic.shark_model.shark_runner.iree_config.device.flush_profiling()
             if msg is None:
@@ -2459,6 +2828,8 @@ if __name__ == "__main__":
                     token_times_ms.append(exec_time)
             elif "formatted" in msg:
                 print(f"\nResponse:\n{text.strip()}\n")
+                # The next prompt carries the reply, as the web chat's does.
+                history[-1][1] = text.strip()
                 run_info = BenchmarkRunInfo(prompt_token_count, prefill_time_ms, token_times_ms)
                 run_info.print()
                 benchmark_run_infos.append(run_info)
@@ -0,0 +1,151 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+class PrefixKVCache:
+    """
+    The past key/values at the end of the last turn of each chat session.
+
+    The prompt of the next turn repeats the whole conversation, so only the
+    tokens after the longest prefix it shares with the cached tokens need
+    to be run through the model. Sessions are evicted least recently used
+    first once their caches take more than `max_bytes`.
+
+    Extending a cache runs the new tokens one at a time, so it only pays
+    off for short extensions of long prompts. Once both have been timed,
+    the measured cost per token of either decides; until then at most
+    `max_extend_tokens` new tokens are extended.
+    """
+
+    def __init__(self, max_bytes=2 << 30, max_extend_tokens=64):
+        self.max_bytes = max_bytes
+        self.max_extend_tokens = max_extend_tokens
+        # Session id to (token ids, past key/values, bytes).
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+        self.saved_prefill_ms = 0.0
+        # Running ms per token of prefills and of extensions.
+        self.prefill_ms_per_token = None
+        self.extend_ms_per_token = None
+
+    def _is_worth_extending(self, num_new, num_tokens):
+        if self.prefill_ms_per_token is None or (
+            self.extend_ms_per_token is None
+        ):
+            return num_new <= self.max_extend_tokens
+        return (
+            num_new * self.extend_ms_per_token
+            < num_tokens * self.prefill_ms_per_token
+        )
+
+    def take(self, session_id, token_ids):
+        """
+        Removes and returns the cache of `session_id` as (prefix length,
+        past key/values) if it covers a prefix of `token_ids` worth
+        extending, else (0, None). At least the last token is left to run.
+        """
+        self.lookups += 1
+        entry = self.entries.pop(session_id, None)
+        if entry is None:
+            return 0, None
+        cached_ids, past_key_values, nbytes = entry
+        self.nbytes -= nbytes
+        prefix_len = min(
+            _common_prefix_len(cached_ids, token_ids), len(token_ids) - 1
+        )
+        num_new = len(token_ids) - prefix_len
+        if prefix_len == 0 or not self._is_worth_extending(
+            num_new, len(token_ids)
+        ):
+            return 0, None
+        self.hits += 1
+        self.reused_tokens += prefix_len
+        if prefix_len < len(cached_ids):
+            # The conversation diverged from the cached tokens, e.g. the
+            # reply was retokenized differently, drop what follows.
+            past_key_values = [
+                _truncate(x, prefix_len) for x in past_key_values
+            ]
+        return prefix_len, past_key_values
+
+    def put(self, session_id, token_ids, past_key_values):
+        # `past_key_values` hold the keys/values of exactly `token_ids`.
+        old = self.entries.pop(session_id, None)
+        if old is not None:
+            self.nbytes -= old[2]
+        nbytes = sum(_nbytes(x) for x in past_key_values)
+        if nbytes > self.max_bytes:
+            return
+        self.entries[session_id] = (
+            list(token_ids),
+            list(past_key_values),
+            nbytes,
+        )
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, _, evicted) = self.entries.popitem(last=False)
+            self.nbytes -= evicted
+            self.evictions += 1
+
+    def drop(self, session_id):
+        entry = self.entries.pop(session_id, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+
+    def record_prefill(self, num_tokens, time_ms):
+        self.prefill_ms_per_token = _running_mean(
+            self.prefill_ms_per_token, time_ms / num_tokens
+        )
+
+    def record_extend(self, num_tokens, num_new, time_ms):
+        # The time saved is estimated from the prefills timed so far.
+        self.extend_ms_per_token = _running_mean(
+            self.extend_ms_per_token, time_ms / num_new
+        )
+        if self.prefill_ms_per_token is not None:
+            self.saved_prefill_ms += (
+                num_tokens * self.prefill_ms_per_token - time_ms
+            )
+
+    def get_stats(self):
+        return {
+            "sessions": len(self.entries),
+            "bytes": self.nbytes,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "reused_tokens": self.reused_tokens,
+            "saved_prefill_ms": round(self.saved_prefill_ms, 3),
+            "evictions": self.evictions,
+        }
+
+
+def _common_prefix_len(a, b):
+    n = min(len(a), len(b))
+    mismatch = np.flatnonzero(np.asarray(a[:n]) != np.asarray(b[:n]))
+    return int(mismatch[0]) if len(mismatch) else n
+
+
+def _running_mean(mean, value, weight=0.2):
+    return value if mean is None else (1 - weight) * mean + weight * value
+
+
+def _truncate(x, length):
+    # Keys and values are [batch, heads, tokens, head_dim].
+    if hasattr(x, "to_host"):
+        x = x.to_host()
+    x = x[:, :, :length]
+    if hasattr(x, "contiguous"):
+        return x.contiguous()
+    return np.ascontiguousarray(x)
+
+
+def _nbytes(x):
+    if hasattr(x, "element_size"):
+        return x.element_size() * x.nelement()
+    return int(np.prod(x.shape)) * np.dtype(x.dtype).itemsize
@@ -1,6 +1,263 @@
+import iree.runtime as ireert
+import numpy as np
+import threading
 import torch
 import time
 
+from shark.iree_utils.pipelined_invoke import is_host_mappable
+
+
+class PipelineStage:
+    """
+    The modules of a sharded Vicuna that run on one device.
+
+    Calls into the modules bound to a stage are serialized, so when several
+    sequences are generated from different threads each of them occupies
+    a different stage at a time, keeping every device busy. The time spent
+    in those calls gives the utilization of the stage.
+    """
+
+    def __init__(self, device_idx):
+        self.device_idx = device_idx
+        self.module_names = []
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.busy_time = 0.0
+        self.calls = 0
+        self._start_time = time.time()
+
+    def bind(self, shark_module, name):
+        self.module_names.append(name)
+        return StageBoundModule(self, shark_module)
+
+    def run(self, shark_module, function_name, inputs, send_to_host):
+        with self._lock:
+            start_time = time.time()
+            try:
+                return shark_module(
+                    function_name, inputs, send_to_host=send_to_host
+                )
+            finally:
+                self.busy_time += time.time() - start_time
+                self.calls += 1
+
+    def get_utilization(self):
+        wall_time = time.time() - self._start_time
+        return self.busy_time / wall_time if wall_time > 0 else 0.0
+
+    def get_stats(self):
+        return {
+            "device_idx": self.device_idx,
+            "modules": f"{self.module_names[0]}..{self.module_names[-1]}",
+            "calls": self.calls,
+            "busy_time_s": round(self.busy_time, 3),
+            "utilization": round(self.get_utilization(), 3),
+        }
+
+
+class StageBoundModule:
+    # Stands in for a SharkInference module, running it on its stage.
+    def __init__(self, stage, shark_module):
+        self.stage = stage
+        self.shark_module = shark_module
+
+    def __call__(self, function_name, inputs, send_to_host=True):
+        return self.stage.run(
+            self.shark_module, function_name, inputs, send_to_host
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.shark_module, name)
+
+
+class RingKVCacheManager:
+    """
+    Creates the RingKVCache of every sequence generated by a sharded
+    Vicuna, and tracks the one the current thread is running.
+
+    Each sequence gets its own device buffers, so sequences generated
+    concurrently or interleaved do not overwrite each other's keys and
+    values. Where the buffers can not be mapped to the host, new entries
+    are written on the device by the compiled `slot_writers`, by device
+    index, see KVSlotWriter.
+    """
+
+    def __init__(
+        self,
+        num_layers,
+        num_heads,
+        head_dim,
+        capacity,
+        num_sink_tokens=0,
+        dtype=torch.float32,
+    ):
+        assert 0 <= num_sink_tokens < capacity
+        self.num_layers = num_layers
+        self.shape = [1, num_heads, capacity, head_dim]
+        self.capacity = capacity
+        self.num_sink_tokens = num_sink_tokens
+        self.dtype = dtype
+        self.slot_writers = {}
+        self._active = threading.local()
+
+    def new_cache(self):
+        return RingKVCache(self)
+
+    def activate(self, kv_cache):
+        self._active.kv_cache = kv_cache
+
+    @property
+    def active(self):
+        return self._active.kv_cache
+
+    def bytes_per_sequence(self):
+        itemsize = torch.finfo(self.dtype).bits // 8
+        return 2 * self.num_layers * int(np.prod(self.shape)) * itemsize
+
+
+class RingKVCache:
+    """
+    Fixed-capacity key/value buffers of every layer for one sequence.
+
+    The buffers stay on the device of their layer. Each decode step
+    writes its keys and values into one slot, so the inputs of
+    second_vicuna_forward keep the same shape however long the
+    generation runs. Once all `capacity` slots are used, the oldest slot
+    after the first `num_sink_tokens` ones is overwritten (a sliding
+    window when `num_sink_tokens` is 0). Empty slots are masked out of
+    the attention, and the current position is passed as position_ids,
+    so the order of the slots does not matter.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.capacity = manager.capacity
+        self.num_sink_tokens = manager.num_sink_tokens
+        self.dtype = manager.dtype
+        self.keys = [None] * manager.num_layers
+        self.values = [None] * manager.num_layers
+        # Absolute position held by every slot, -1 for empty slots.
+        self.slot_positions = np.full(self.capacity, -1, dtype=np.int64)
+        self.position = 0
+        self.evicted = 0
+        self._ring_ptr = 0
+        self._prefill_tokens = None
+        self._step_slot = None
+        self._step_mask = None
+
+    def num_cached(self):
+        return int((self.slot_positions >= 0).sum())
+
+    def begin_prefill(self, num_tokens):
+        # Keep the sink tokens and as many of the most recent ones as fit.
+        if num_tokens <= self.capacity:
+            tokens = np.arange(num_tokens)
+        else:
+            window = self.capacity - self.num_sink_tokens
+            tokens = np.concatenate(
+                [
+                    np.arange(self.num_sink_tokens),
+                    np.arange(num_tokens - window, num_tokens),
+                ]
+            )
+            self.evicted += num_tokens - len(tokens)
+        self._prefill_tokens = tokens
+
+    def write_prefill(self, layer_idx, shark_module, key, value):
+        # The buffers are filled on the host and uploaded once, to the
+        # device of the layer.
+        n = len(self._prefill_tokens)
+        device = shark_module.shark_runner.iree_config.device
+        np_dtype = torch.empty([], dtype=self.dtype).numpy().dtype
+        for buffers, x in ((self.keys, key), (self.values, value)):
+            host = np.zeros(self.manager.shape, dtype=np_dtype)
+            host[:, :, :n] = _to_numpy(x)[:, :, self._prefill_tokens]
+            buffers[layer_idx] = ireert.asdevicearray(device, host)
+
+    def begin_step(self):
+        # Pick the slot this step writes to, and mask out the empty slots
+        # for it. The last mask entry is the current token itself.
+        used = self.num_cached()
+        if used < self.capacity:
+            self._step_slot = used
+        else:
+            window = self.capacity - self.num_sink_tokens
+            self._step_slot = self.num_sink_tokens + self._ring_ptr
+            self._ring_ptr = (self._ring_ptr + 1) % window
+            self.evicted += 1
+        mask = torch.zeros([1, 1, 1, self.capacity + 1], dtype=self.dtype)
+        mask[0, 0, 0, :-1][
+            torch.from_numpy(self.slot_positions < 0)
+        ] = torch.finfo(self.dtype).min
+        self._step_mask = mask
+
+    def step_inputs(self):
+        position_ids = torch.tensor([[self.position]], dtype=torch.int64)
+        return self._step_mask, position_ids
+
+    def write_step(self, layer_idx, shark_module, key, value):
+        # second_vicuna_forward returns the cache with the new token's
+        # keys/values appended on the device, only that last entry is
+        # written into the slot of the step.
+        slot = self._step_slot
+        for buffers, x in ((self.keys, key), (self.values, value)):
+            cache = buffers[layer_idx]
+            if is_host_mappable(cache) and is_host_mappable(x):
+                # Both map to the device memory, only the slot is copied.
+                cache.to_host()[:, :, slot] = x.to_host()[:, :, -1]
+                continue
+            slot_writer = self.manager.slot_writers.get(
+                shark_module.device_idx
+            )
+            if slot_writer is None:
+                raise RuntimeError(
+                    "The kv cache of the sharded model is not host "
+                    "mappable on this device and needs a KVSlotWriter."
+                )
+            slot_mask = np.zeros([1, 1, self.capacity, 1], dtype=np.int64)
+            slot_mask[0, 0, slot, 0] = 1
+            buffers[layer_idx] = slot_writer(
+                "forward", (cache, x, slot_mask), send_to_host=False
+            )
+
+    def end_step(self):
+        if self._prefill_tokens is not None:
+            n = len(self._prefill_tokens)
+            self.slot_positions[:n] = self._prefill_tokens
+            self.position = int(self._prefill_tokens[-1]) + 1
+            self._prefill_tokens = None
+        else:
+            self.slot_positions[self._step_slot] = self.position
+            self.position += 1
+            self._step_slot = None
+
+    def layer_caches(self):
+        return tuple(zip(self.keys, self.values))
+
+    def get_memory_info(self):
+        return {
+            "capacity": self.capacity,
+            "cached_tokens": self.num_cached(),
+            "evicted_tokens": self.evicted,
+            "position": self.position,
+            "bytes": self.manager.bytes_per_sequence(),
+        }
+
+
+class KVSlotWriter(torch.nn.Module):
+    # Writes the entry second_vicuna_forward appended to a layer's cache
+    # into the slot selected by `slot_mask`, on the device.
+    def forward(self, cache, appended, slot_mask):
+        return torch.where(slot_mask != 0, appended[:, :, -1:], cache)
+
+
+def _to_numpy(x):
+    if hasattr(x, "to_host"):
+        return x.to_host()
+    return np.asarray(x)
+
 
 class FirstVicunaLayer(torch.nn.Module):
     def __init__(self, model):
@@ -64,9 +321,20 @@ class SecondVicunaLayer(torch.nn.Module):
 
 
 class ShardedVicunaModel(torch.nn.Module):
-    def __init__(self, model, layers, lmhead, embedding, norm):
+    def __init__(
+        self,
+        model,
+        layers,
+        lmhead,
+        embedding,
+        norm,
+        kv_cache=None,
+        pipeline_stages=None,
+    ):
         super().__init__()
         self.model = model
+        self.kv_cache = kv_cache
+        self.pipeline_stages = pipeline_stages or []
         self.model.model.config.use_cache = True
         self.model.model.config.output_attentions = False
         self.layers = layers
@@ -87,11 +355,32 @@ class ShardedVicunaModel(torch.nn.Module):
         past_key_values=None,
         attention_mask=None,
     ):
-        return self.model.forward(
+        if self.kv_cache is None:
+            return self.model.forward(
+                input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+            )
+        if past_key_values is None:
+            kv_cache = self.kv_cache.new_cache()
+            kv_cache.begin_prefill(input_ids.shape[1])
+        else:
+            # The past_key_values returned for a sequence are its cache.
+            kv_cache = past_key_values
+            kv_cache.begin_step()
+            past_key_values = kv_cache.layer_caches()
+        self.kv_cache.activate(kv_cache)
+        output = self.model.forward(
             input_ids,
             attention_mask=attention_mask,
             past_key_values=past_key_values,
         )
+        kv_cache.end_step()
+        output["past_key_values"] = kv_cache
+        return output
+
+    def get_stage_stats(self):
+        return [stage.get_stats() for stage in self.pipeline_stages]
 
 
 class LMHead(torch.nn.Module):
@@ -168,11 +457,12 @@ class VicunaEmbeddingCompiled(torch.nn.Module):
 
 
 class CompiledVicunaLayer(torch.nn.Module):
-    def __init__(self, shark_module, idx, breakpoints):
+    def __init__(self, shark_module, idx, breakpoints, kv_cache=None):
         super().__init__()
         self.model = shark_module
         self.idx = idx
         self.breakpoints = breakpoints
+        self.kv_cache = kv_cache
 
     def forward(
         self,
@@ -187,6 +477,14 @@ class CompiledVicunaLayer(torch.nn.Module):
             is_breakpoint = False
         else:
             is_breakpoint = self.idx + 1 in self.breakpoints
+        if self.kv_cache is not None:
+            return self.forward_with_kv_cache(
+                hidden_states,
+                attention_mask,
+                position_ids,
+                is_first=past_key_value is None,
+                is_breakpoint=is_breakpoint,
+            )
         if past_key_value is None:
             output = self.model(
                 "first_vicuna_forward",
@@ -245,3 +543,52 @@ class CompiledVicunaLayer(torch.nn.Module):
                     output2,
                 ),
             )
+
+    def forward_with_kv_cache(
+        self,
+        hidden_states,
+        attention_mask,
+        position_ids,
+        is_first,
+        is_breakpoint,
+    ):
+        # The layer reads the buffers of the sequence the model is running,
+        # on the device, and its outputs stay there. The attention mask and
+        # position ids of decode steps come from the cache as well.
+        kv_cache = self.kv_cache.active
+        if is_first:
+            output = self.model(
+                "first_vicuna_forward",
+                (
+                    hidden_states,
+                    attention_mask,
+                    position_ids,
+                ),
+                send_to_host=False,
+            )
+            kv_cache.write_prefill(self.idx, self.model, output[1], output[2])
+        else:
+            attention_mask, position_ids = kv_cache.step_inputs()
+            output = self.model(
+                "second_vicuna_forward",
+                (
+                    hidden_states,
+                    attention_mask,
+                    position_ids,
+                    kv_cache.keys[self.idx],
+                    kv_cache.values[self.idx],
+                ),
+                send_to_host=False,
+            )
+            kv_cache.write_step(self.idx, self.model, output[1], output[2])
+
+        output0 = output[0]
+        if is_breakpoint:
+            output0 = torch.tensor(output0.to_host())
+        return (
+            output0,
+            (
+                kv_cache.keys[self.idx],
+                kv_cache.values[self.idx],
+            ),
+        )
@@ -22,6 +22,7 @@ from contextlib import redirect_stdout
 from shark.shark_downloader import download_public_file
 from shark.shark_importer import import_with_fx, save_mlir
 from shark.shark_inference import SharkInference
+from shark.sharded_build import LayerBuild, ShardedBuilder
 from transformers import AutoTokenizer, AutoModelForCausalLM, GPTQConfig
 from transformers.generation import (
     GenerationConfig,
@@ -29,6 +30,7 @@ from transformers.generation import (
     StoppingCriteriaList,
 )
 import copy
+import functools
 import time
 import re
 import torch
@@ -101,6 +103,18 @@ parser.add_argument(
     choices=[2, 4],
     help="Number of shards.",
 )
+parser.add_argument(
+    "--build_workers",
+    type=int,
+    default=4,
+    help="Number of processes compiling the sharded layers in parallel.",
+)
+parser.add_argument(
+    "--build_memory_limit_gb",
+    type=float,
+    default=None,
+    help="Memory limit in GB of each process compiling a sharded layer.",
+)
 
 
 class ShardedFalcon(SharkLLMBase):
@@ -170,105 +184,121 @@ class ShardedFalcon(SharkLLMBase):
         )
         return falcon_model
 
-    def compile_layer(
-        self, layer, falconCompileInput, layer_id, device_idx=None
-    ):
-        self.falcon_mlir_path = Path(
+    def get_layer_paths(self, layer_id):
+        mlir_path = Path(
             f"falcon_{args.falcon_variant_to_use}_layer_{layer_id}_{self.precision}.mlir"
         )
-        self.falcon_vmfb_path = Path(
+        vmfb_path = Path(
             f"falcon_{args.falcon_variant_to_use}_layer_{layer_id}_{self.precision}_{self.device}.vmfb"
         )
+        return mlir_path, vmfb_path
 
+    def download_layer(self, mlir_path, vmfb_path):
+        # Fetches the vmfb of a layer from shark_tank, or else its mlir, as
+        # far as the flags allow.
         if args.use_precompiled_model:
-            if not self.falcon_vmfb_path.exists():
+            if not vmfb_path.exists():
                 # Downloading VMFB from shark_tank
                 print(f"[DEBUG] Trying to download vmfb from shark_tank")
                 download_public_file(
                     f"gs://shark_tank/falcon/sharded/falcon_{args.falcon_variant_to_use}/vmfb/"
-                    + str(self.falcon_vmfb_path),
-                    self.falcon_vmfb_path.absolute(),
+                    + str(vmfb_path),
+                    vmfb_path.absolute(),
                     single_file=True,
                 )
-            vmfb = get_vmfb_from_path(
-                self.falcon_vmfb_path,
-                self.device,
-                "linalg",
-                device_id=device_idx,
-            )
-            if vmfb is not None:
-                return vmfb, device_idx
+            if vmfb_path.exists():
+                return
 
-        print(f"[DEBUG] vmfb not found at {self.falcon_vmfb_path.absolute()}")
-        if self.falcon_mlir_path.exists():
-            print(f"[DEBUG] mlir found at {self.falcon_mlir_path.absolute()}")
-            with open(self.falcon_mlir_path, "rb") as f:
-                bytecode = f.read()
+        print(f"[DEBUG] vmfb not found at {vmfb_path.absolute()}")
+        if mlir_path.exists():
+            print(f"[DEBUG] mlir found at {mlir_path.absolute()}")
         else:
-            mlir_generated = False
-            print(
-                f"[DEBUG] mlir not found at {self.falcon_mlir_path.absolute()}"
-            )
+            print(f"[DEBUG] mlir not found at {mlir_path.absolute()}")
             if args.load_mlir_from_shark_tank:
                 # Downloading MLIR from shark_tank
                 print(f"[DEBUG] Trying to download mlir from shark_tank")
                 download_public_file(
                     f"gs://shark_tank/falcon/sharded/falcon_{args.falcon_variant_to_use}/mlir/"
-                    + str(self.falcon_mlir_path),
-                    self.falcon_mlir_path.absolute(),
+                    + str(mlir_path),
+                    mlir_path.absolute(),
                     single_file=True,
                 )
-                if self.falcon_mlir_path.exists():
-                    print(
-                        f"[DEBUG] mlir found at {self.falcon_mlir_path.absolute()}"
-                    )
-                    with open(self.falcon_mlir_path, "rb") as f:
-                        bytecode = f.read()
-                    mlir_generated = True
-
-            if not mlir_generated:
-                print(f"[DEBUG] generating MLIR locally")
-                if layer_id == "word_embeddings":
-                    f16_input_mask = [False]
-                elif layer_id in ["ln_f", "lm_head"]:
-                    f16_input_mask = [True]
-                elif "_" in layer_id or type(layer_id) == int:
-                    f16_input_mask = [True, True]
-                else:
-                    raise ValueError("Unsupported layer: ", layer_id)
-
-                print(f"[DEBUG] generating torchscript graph")
-                ts_graph = import_with_fx(
-                    layer,
-                    falconCompileInput,
-                    is_f16=True,
-                    f16_input_mask=f16_input_mask,
-                    mlir_type="torchscript",
-                    is_gptq=True,
-                )
-                del layer
-
-                print(f"[DEBUG] generating torch mlir")
-                module = torch_mlir.compile(
-                    ts_graph,
-                    falconCompileInput,
-                    torch_mlir.OutputType.LINALG_ON_TENSORS,
-                    use_tracing=False,
-                    verbose=False,
-                )
-                del ts_graph
+                if mlir_path.exists():
+                    print(f"[DEBUG] mlir found at {mlir_path.absolute()}")
+
+    def import_layer(self, layer, falconCompileInput, layer_id, path):
+        print(f"[DEBUG] generating MLIR locally")
+        if layer_id == "word_embeddings":
+            f16_input_mask = [False]
+        elif layer_id in ["ln_f", "lm_head"]:
+            f16_input_mask = [True]
+        elif "_" in layer_id or type(layer_id) == int:
+            f16_input_mask = [True, True]
+        else:
+            raise ValueError("Unsupported layer: ", layer_id)
+
+        print(f"[DEBUG] generating torchscript graph")
+        ts_graph = import_with_fx(
+            layer,
+            falconCompileInput,
+            is_f16=True,
+            f16_input_mask=f16_input_mask,
+            mlir_type="torchscript",
+            is_gptq=True,
+        )
+        del layer
+
+        print(f"[DEBUG] generating torch mlir")
+        module = torch_mlir.compile(
+            ts_graph,
+            falconCompileInput,
+            torch_mlir.OutputType.LINALG_ON_TENSORS,
+            use_tracing=False,
+            verbose=False,
+        )
+        del ts_graph
+
+        print(f"[DEBUG] converting to bytecode")
+        with open(path, "wb") as f_:
+            module.operation.write_bytecode(f_)
+        print("Saved falcon mlir at ", str(path))
+        del module
+
+    def get_compile_args(self):
+        return (
+            [
+                "--iree-vm-target-truncate-unsupported-floats",
+                "--iree-codegen-check-ir-before-llvm-conversion=false",
+                "--iree-vm-bytecode-module-output-format=flatbuffer-binary",
+            ]
+            + [
+                "--iree-llvmcpu-use-fast-min-max-ops",
+            ]
+            if self.precision == "int4"
+            else []
+        )
 
-                print(f"[DEBUG] converting to bytecode")
-                bytecode_stream = BytesIO()
-                module.operation.write_bytecode(bytecode_stream)
-                bytecode = bytecode_stream.getvalue()
-                del module
+    def compile_layer(
+        self, layer, falconCompileInput, layer_id, device_idx=None
+    ):
+        self.falcon_mlir_path, self.falcon_vmfb_path = self.get_layer_paths(
+            layer_id
+        )
+        self.download_layer(self.falcon_mlir_path, self.falcon_vmfb_path)
+        if args.use_precompiled_model:
+            vmfb = get_vmfb_from_path(
+                self.falcon_vmfb_path,
+                self.device,
+                "linalg",
+                device_id=device_idx,
+            )
+            if vmfb is not None:
+                return vmfb, device_idx
 
-                f_ = open(self.falcon_mlir_path, "wb")
-                f_.write(bytecode)
-                print("Saved falcon mlir at ", str(self.falcon_mlir_path))
-                f_.close()
-                del bytecode
+        if not self.falcon_mlir_path.exists():
+            self.import_layer(
+                layer, falconCompileInput, layer_id, self.falcon_mlir_path
+            )
 
         shark_module = SharkInference(
             mlir_module=self.falcon_mlir_path,
@@ -279,16 +309,7 @@ class ShardedFalcon(SharkLLMBase):
         path = shark_module.save_module(
             self.falcon_vmfb_path.parent.absolute(),
             self.falcon_vmfb_path.stem,
-            extra_args=[
-                "--iree-vm-target-truncate-unsupported-floats",
-                "--iree-codegen-check-ir-before-llvm-conversion=false",
-                "--iree-vm-bytecode-module-output-format=flatbuffer-binary",
-            ]
-            + [
-                "--iree-llvmcpu-use-fast-min-max-ops",
-            ]
-            if self.precision == "int4"
-            else [],
+            extra_args=self.get_compile_args(),
             debug=self.debug,
         )
         print("Saved falcon vmfb at ", str(path))
@@ -360,39 +381,60 @@ class ShardedFalcon(SharkLLMBase):
         )
         shark_ln_f = CompiledLNFEmbeddingLayer(shark_ln_f)
 
-        shark_layers = []
+        pytorch_class = FourWayShardingDecoderLayer
+        compiled_class = CompiledFourWayShardingDecoderLayer
+        if args.num_shards == 2:
+            pytorch_class = TwoWayShardingDecoderLayer
+            compiled_class = CompiledTwoWayShardingDecoderLayer
+
+        # The decoder layers are imported in order while the ones already
+        # imported compile in parallel, see ShardedBuilder.
+        builds = []
         for i in range(
             int(len(self.src_model.transformer.h) / num_group_layers)
         ):
-            device_idx = i % num_devices if self.device == "rocm" else None
-            layer_id = i
             layer_id = (
                 str(i * num_group_layers)
                 + "_"
                 + str((i + 1) * num_group_layers)
             )
-            pytorch_class = FourWayShardingDecoderLayer
-            compiled_class = CompiledFourWayShardingDecoderLayer
-            if args.num_shards == 2:
-                pytorch_class = TwoWayShardingDecoderLayer
-                compiled_class = CompiledTwoWayShardingDecoderLayer
-
-            print("Compiling Layer {}".format(layer_id))
+            mlir_path, vmfb_path = self.get_layer_paths(layer_id)
+            self.download_layer(mlir_path, vmfb_path)
             layer_i = self.src_model.transformer.h[
                 i * num_group_layers : (i + 1) * num_group_layers
             ]
-
-            pytorch_layer_i = pytorch_class(
-                layer_i, args.falcon_variant_to_use
+            builds.append(
+                LayerBuild(
+                    layer_id,
+                    mlir_path,
+                    vmfb_path,
+                    import_fn=functools.partial(
+                        self.import_layer,
+                        pytorch_class(layer_i, args.falcon_variant_to_use),
+                        [sample_hidden_states, sample_attention_mask],
+                        layer_id,
+                    ),
+                    device=self.device,
+                    mlir_dialect="linalg",
+                    extra_args=self.get_compile_args(),
+                    debug=self.debug,
+                )
             )
-            shark_module, device_idx = self.compile_layer(
-                pytorch_layer_i,
-                [sample_hidden_states, sample_attention_mask],
-                layer_id,
-                device_idx=device_idx,
+        ShardedBuilder(
+            ".",
+            num_workers=args.build_workers,
+            memory_limit_gb=args.build_memory_limit_gb,
+            trust_unrecorded=args.use_precompiled_model,
+        ).build(builds)
+
+        shark_layers = []
+        for i, build in enumerate(builds):
+            device_idx = i % num_devices if self.device == "rocm" else None
+            shark_module = get_vmfb_from_path(
+                build.vmfb_path, self.device, "linalg", device_id=device_idx
             )
             shark_layer_i = compiled_class(
-                layer_id,
+                build.name,
                 device_idx,
                 args.falcon_variant_to_use,
                 self.device,
@@ -3,7 +3,8 @@ from shark.iree_utils.compile_utils import get_iree_compiled_module
 from apps.shark_studio.api.utils import get_resource_path
 import iree.runtime as ireert
 import gc
-import torch
+import numpy as np
+import time
 
 llm_model_map = {
     "llama2_7b": {
@@ -33,6 +34,7 @@ class LanguageModel:
         self.device = device
         self.precision = precision
         self.max_tokens = llm_model_map[model_name]["max_tokens"]
+        self.stop_token = llm_model_map[model_name]["stop_token"]
         self.iree_module_dict = None
         self.compile()
 
@@ -44,40 +46,84 @@ class LanguageModel:
         # TODO: delete the temp file
 
     def chat(self, prompt):
-        history = []
+        # The prompt is tokenized once for run_initialize; every later step
+        # only feeds the token generated by the previous one.
+        input_tensor = self.tokenizer(prompt, return_tensors="pt").input_ids
+        device = self.iree_module_dict["config"].device
+        vmfb = self.iree_module_dict["vmfb"]
+        detokenizer = IncrementalDetokenizer(self.tokenizer)
+        text = ""
+        host_time = 0.0
+        start = time.perf_counter()
+        host_start = time.perf_counter()
+        device_inputs = [ireert.asdevicearray(device, input_tensor)]
+        host_time += time.perf_counter() - host_start
+        token = int(vmfb["run_initialize"](*device_inputs).to_host()[0][0])
         for iter in range(self.max_tokens):
-            input_tensor = self.tokenizer(
-                prompt, return_tensors="pt"
-            ).input_ids
+            host_start = time.perf_counter()
+            text += detokenizer.add_token(token)
+            host_time += time.perf_counter() - host_start
+            yield text
+
+            if token == self.stop_token or iter == self.max_tokens - 1:
+                break
+
+            host_start = time.perf_counter()
             device_inputs = [
                 ireert.asdevicearray(
-                    self.iree_module_dict["config"], input_tensor
+                    device, np.array([[token]], dtype=np.int64)
                 )
             ]
-            if iter == 0:
-                token = torch.tensor(
-                    self.iree_module_dict["vmfb"]["run_initialize"](
-                        *device_inputs
-                    ).to_host()[0][0]
-                )
-            else:
-                token = torch.tensor(
-                    self.iree_module_dict["vmfb"]["run_forward"](
-                        *device_inputs
-                    ).to_host()[0][0]
-                )
+            host_time += time.perf_counter() - host_start
+            token = int(vmfb["run_forward"](*device_inputs).to_host()[0][0])
 
-            history.append(token)
-            yield self.tokenizer.decode(history)
+        num_tokens = len(detokenizer.tokens)
+        total_time = time.perf_counter() - start
+        print(
+            f"{num_tokens} tokens in {total_time:.3f}s "
+            f"({num_tokens / total_time:.2f} tokens/s), "
+            f"host overhead {1000 * host_time / num_tokens:.3f}ms/token"
+        )
+        yield text + detokenizer.flush()
 
-            if token == llm_model_map["llama2_7b"]["stop_token"]:
-                break
 
-        for i in range(len(history)):
-            if type(history[i]) != int:
-                history[i] = int(history[i])
-        result_output = self.tokenizer.decode(history)
-        yield result_output
+class IncrementalDetokenizer:
+    """
+    Turns a growing sequence of token ids into text deltas.
+
+    Decoding only looks at a window starting a few tokens back
+    (`prefix_offset`), which keeps the per-token cost constant while still
+    letting the tokenizer resolve leading spaces and merges across token
+    boundaries. Text is held back while it ends in an incomplete multi-byte
+    character, which the tokenizer renders as U+FFFD.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.tokens = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def add_token(self, token):
+        self.tokens.append(token)
+        return self._decode_delta()
+
+    def _decode_delta(self, final=False):
+        prefix_text = self.tokenizer.decode(
+            self.tokens[self.prefix_offset : self.read_offset]
+        )
+        new_text = self.tokenizer.decode(self.tokens[self.prefix_offset :])
+        if len(new_text) > len(prefix_text) and (
+            final or not new_text.endswith("\ufffd")
+        ):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.tokens)
+            return new_text[len(prefix_text) :]
+        return ""
+
+    def flush(self):
+        """Returns any text still held back as an incomplete character."""
+        return self._decode_delta(final=True)
 
 
 if __name__ == "__main__":
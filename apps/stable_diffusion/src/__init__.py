@@ -5,6 +5,7 @@ from apps.stable_diffusion.src.utils import (
     get_available_devices,
     clear_all,
     save_output_img,
+    get_img_save_info,
     resize_stencil,
 )
 from apps.stable_diffusion.src.pipelines import (
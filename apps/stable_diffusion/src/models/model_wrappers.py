@@ -1,6 +1,7 @@
 from diffusers import AutoencoderKL, UNet2DConditionModel, ControlNetModel
 from transformers import CLIPTextModel, CLIPTextModelWithProjection
 from collections import defaultdict
+from contextlib import contextmanager
 from pathlib import Path
 import torch
 import safetensors.torch
@@ -23,6 +24,8 @@ from apps.stable_diffusion.src.utils import (
     get_extended_name,
     get_stencil_model_id,
     update_lora_weight,
+    with_external_lora_weights,
+    RuntimeLoraModule,
 )
 from shark.shark_downloader import download_public_file
 from shark.shark_inference import SharkInference
@@ -217,7 +220,11 @@ class SharkifyStableDiffusionModel:
         self.is_inpaint = is_inpaint
         self.is_upscaler = is_upscaler
         self.stencils = [get_stencil_model_id(x) for x in stencils]
-        if use_lora != "":
+        if args.runtime_lora:
+            # LoRAs are applied to the compiled unet and clip at runtime, so
+            # their vmfbs do not depend on the LoRA.
+            self.model_name = self.model_name + "_runtime_lora"
+        elif use_lora != "":
             self.model_name = self.model_name + "_" + get_path_stem(use_lora)
         self.use_lora = use_lora
 
@@ -283,6 +290,27 @@ class SharkifyStableDiffusionModel:
         index += 1
         return model_name
 
+    @contextmanager
+    def vae_tiles(self, tile_size):
+        """
+        Within this context vae() and vae_encode() build the VAEs for square
+        tiles of `tile_size` pixels, named after the tile size instead of
+        the resolution, so that every resolution shares their vmfbs.
+        """
+        height, width, model_name = self.height, self.width, self.model_name
+        resolution = f"_{height * 8}_{width * 8}_"
+        self.model_name = dict(model_name)
+        for model in ["vae", "vae_encode"]:
+            self.model_name[model] = model_name[model].replace(
+                resolution, f"_tile{tile_size}_", 1
+            )
+        self.height = self.width = tile_size // 8
+        try:
+            yield
+        finally:
+            self.height, self.width = height, width
+            self.model_name = model_name
+
     def check_params(self, max_len, width, height):
         if not (max_len >= 32 and max_len <= 77):
             sys.exit("please specify max_len in the range [32, 77].")
@@ -853,7 +881,12 @@ class SharkifyStableDiffusionModel:
                 )
                 return noise_pred
 
-        unet = UnetModel(low_cpu_mem_usage=self.low_cpu_mem_usage)
+        if args.runtime_lora:
+            unet = UnetModel(
+                low_cpu_mem_usage=self.low_cpu_mem_usage, use_lora=""
+            )
+        else:
+            unet = UnetModel(low_cpu_mem_usage=self.low_cpu_mem_usage)
         is_f16 = True if self.precision == "fp16" else False
         inputs = tuple(self.inputs["unet"])
         if use_large:
@@ -873,6 +906,16 @@ class SharkifyStableDiffusionModel:
                 self.sharktank_dir, self.model_name["unet"]
             )
         input_mask = [True, True, True, False]
+        if args.runtime_lora:
+            (
+                unet,
+                inputs,
+                input_mask,
+                base_weights,
+                module_names,
+            ) = with_external_lora_weights(
+                unet, "unet", "attentions.", inputs, input_mask
+            )
         if self.debug:
             os.makedirs(
                 save_dir,
@@ -895,6 +938,15 @@ class SharkifyStableDiffusionModel:
             precision=self.precision,
             return_mlir=self.return_mlir,
         )
+        if args.runtime_lora and shark_unet is not None:
+            shark_unet = RuntimeLoraModule(
+                shark_unet,
+                base_weights,
+                module_names,
+                "lora_unet_",
+                torch.float16 if is_f16 else torch.float32,
+            )
+            shark_unet.set_loras(self.use_lora)
         return shark_unet, unet_mlir
 
     def get_unet_upscaler(self, use_large=False):
@@ -1067,7 +1119,23 @@ class SharkifyStableDiffusionModel:
             def forward(self, input):
                 return self.text_encoder(input)[0]
 
-        clip_model = CLIPText(low_cpu_mem_usage=self.low_cpu_mem_usage)
+        if args.runtime_lora:
+            clip_model = CLIPText(
+                low_cpu_mem_usage=self.low_cpu_mem_usage, use_lora=""
+            )
+        else:
+            clip_model = CLIPText(low_cpu_mem_usage=self.low_cpu_mem_usage)
+        inputs = tuple(self.inputs["clip"])
+        if args.runtime_lora:
+            (
+                clip_model,
+                inputs,
+                _,
+                base_weights,
+                module_names,
+            ) = with_external_lora_weights(
+                clip_model, "text_encoder", "encoder.layers.", inputs, None
+            )
         save_dir = ""
         if self.debug:
             save_dir = os.path.join(
@@ -1079,7 +1147,7 @@ class SharkifyStableDiffusionModel:
             )
         shark_clip, clip_mlir = compile_through_fx(
             clip_model,
-            tuple(self.inputs["clip"]),
+            inputs,
             extended_model_name=self.model_name["clip"],
             debug=self.debug,
             generate_vmfb=self.generate_vmfb,
@@ -1090,6 +1158,15 @@ class SharkifyStableDiffusionModel:
             precision=self.precision,
             return_mlir=self.return_mlir,
         )
+        if args.runtime_lora and shark_clip is not None:
+            shark_clip = RuntimeLoraModule(
+                shark_clip,
+                base_weights,
+                module_names,
+                "lora_te_",
+                torch.float32,
+            )
+            shark_clip.set_loras(self.use_lora)
         return shark_clip, clip_mlir
 
     def get_clip_sdxl(self, clip_index=1):
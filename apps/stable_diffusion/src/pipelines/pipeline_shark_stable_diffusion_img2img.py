@@ -30,8 +30,10 @@ from apps.stable_diffusion.src.models import (
     get_vae_encode,
 )
 from apps.stable_diffusion.src.utils import (
+    args,
     resamplers,
     resampler_list,
+    tiled_encode,
 )
 
 
@@ -60,12 +62,17 @@ class Image2ImagePipeline(StableDiffusionPipeline):
     ):
         super().__init__(scheduler, sd_model, import_mlir, use_lora, ondemand)
         self.vae_encode = None
+        self.vae_encode_tile_size = None
 
     def load_vae_encode(self):
         if self.vae_encode is not None:
             return
 
-        if self.import_mlir or self.use_lora:
+        self.vae_encode_tile_size = self.get_vae_tile_size()
+        if self.vae_encode_tile_size is not None:
+            with self.sd_model.vae_tiles(self.vae_encode_tile_size):
+                self.vae_encode = self.sd_model.vae_encode()
+        elif self.import_mlir or self.use_lora:
             self.vae_encode = self.sd_model.vae_encode()
         else:
             try:
@@ -77,6 +84,7 @@ class Image2ImagePipeline(StableDiffusionPipeline):
     def unload_vae_encode(self):
         del self.vae_encode
         self.vae_encode = None
+        self.vae_encode_tile_size = None
 
     def prepare_image_latents(
         self,
@@ -133,7 +141,15 @@ class Image2ImagePipeline(StableDiffusionPipeline):
     def encode_image(self, input_image):
         self.load_vae_encode()
         vae_encode_start = time.time()
-        latents = self.vae_encode("forward", input_image)
+        if self.vae_encode_tile_size is None:
+            latents = self.vae_encode("forward", input_image)
+        else:
+            latents = tiled_encode(
+                lambda tile: self.vae_encode("forward", (tile,)),
+                input_image[0],
+                self.vae_encode_tile_size,
+                args.vae_tile_overlap,
+            )
         vae_inf_time = (time.time() - vae_encode_start) * 1000
         if self.ondemand:
             self.unload_vae_encode()
@@ -101,26 +101,49 @@ class Text2ImagePipeline(StableDiffusionPipeline):
         if isinstance(neg_prompts, str):
             neg_prompts = [neg_prompts]
 
-        prompts = prompts * batch_size
-        neg_prompts = neg_prompts * batch_size
+        # A list with one prompt per image is used as is.
+        if len(prompts) != batch_size:
+            prompts = prompts * batch_size
+        if len(neg_prompts) != batch_size:
+            neg_prompts = neg_prompts * batch_size
 
         # seed generator to create the inital latent noise. Also handle out of range seeds.
         # TODO: Wouldn't it be preferable to just report an error instead of modifying the seed on the fly?
         uint32_info = np.iinfo(np.uint32)
         uint32_min, uint32_max = uint32_info.min, uint32_info.max
-        if seed < uint32_min or seed >= uint32_max:
-            seed = randint(uint32_min, uint32_max)
-        generator = torch.manual_seed(seed)
+
+        def sanitize_seed(seed):
+            if seed < uint32_min or seed >= uint32_max:
+                seed = randint(uint32_min, uint32_max)
+            return seed
 
         # Get initial latents
-        init_latents = self.prepare_latents(
-            batch_size=batch_size,
-            height=height,
-            width=width,
-            generator=generator,
-            num_inference_steps=num_inference_steps,
-            dtype=dtype,
-        )
+        if isinstance(seed, list):
+            # One seed per image, each image gets the same initial noise it
+            # would get if it were generated on its own with batch_size 1.
+            init_latents = torch.cat(
+                [
+                    self.prepare_latents(
+                        batch_size=1,
+                        height=height,
+                        width=width,
+                        generator=torch.manual_seed(sanitize_seed(s)),
+                        num_inference_steps=num_inference_steps,
+                        dtype=dtype,
+                    )
+                    for s in seed
+                ]
+            )
+        else:
+            generator = torch.manual_seed(sanitize_seed(seed))
+            init_latents = self.prepare_latents(
+                batch_size=batch_size,
+                height=height,
+                width=width,
+                generator=generator,
+                num_inference_steps=num_inference_steps,
+                dtype=dtype,
+            )
 
         # Get text embeddings with weight emphasis from prompts
         text_embeddings = self.encode_prompts_weight(
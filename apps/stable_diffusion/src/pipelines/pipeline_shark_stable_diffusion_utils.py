@@ -32,8 +32,13 @@ from apps.stable_diffusion.src.models import (
     get_tokenizer,
 )
 from apps.stable_diffusion.src.utils import (
+    args,
     start_profiling,
     end_profiling,
+    RuntimeLoraModule,
+    check_tile_args,
+    needs_tiling,
+    tiled_decode,
 )
 import sys
 import gc
@@ -69,6 +74,8 @@ class StableDiffusionPipeline:
         is_f32_vae: bool = False,
     ):
         self.vae = None
+        # Size of the tiles the loaded VAE decodes, None if not tiled.
+        self.vae_tile_size = None
         self.text_encoder = None
         self.text_encoder_2 = None
         self.unet = None
@@ -92,11 +99,23 @@ class StableDiffusionPipeline:
             self.unload_unet()
             self.tokenizer = get_tokenizer()
 
+    def set_lora(self, use_lora):
+        """
+        Switches the LoRA applied by the loaded clip and unet modules, which
+        need to be built with --runtime_lora. Modules loaded later pick it
+        up from the model.
+        """
+        self.use_lora = use_lora
+        self.sd_model.use_lora = use_lora
+        for module in [self.text_encoder, self.unet, self.unet_512]:
+            if isinstance(module, RuntimeLoraModule):
+                module.set_loras(use_lora)
+
     def load_clip(self):
         if self.text_encoder is not None:
             return
 
-        if self.import_mlir or self.use_lora:
+        if self.import_mlir or self.use_lora or args.runtime_lora:
             if not self.import_mlir:
                 print(
                     "Warning: LoRA provided but import_mlir not specified. "
@@ -147,7 +166,7 @@ class StableDiffusionPipeline:
         if self.unet is not None:
             return
 
-        if self.import_mlir or self.use_lora:
+        if self.import_mlir or self.use_lora or args.runtime_lora:
             self.unet = self.sd_model.unet()
         else:
             try:
@@ -165,7 +184,7 @@ class StableDiffusionPipeline:
         if self.unet_512 is not None:
             return
 
-        if self.import_mlir or self.use_lora:
+        if self.import_mlir or self.use_lora or args.runtime_lora:
             self.unet_512 = self.sd_model.unet(use_large=True)
         else:
             try:
@@ -179,11 +198,25 @@ class StableDiffusionPipeline:
         del self.unet_512
         self.unet_512 = None
 
+    def get_vae_tile_size(self):
+        if not args.vae_tiling or self.sd_model.is_upscaler:
+            return None
+        check_tile_args(args.vae_tile_size, args.vae_tile_overlap)
+        height, width = self.sd_model.height * 8, self.sd_model.width * 8
+        if not needs_tiling(height, width, args.vae_tile_size):
+            return None
+        return args.vae_tile_size
+
     def load_vae(self):
         if self.vae is not None:
             return
 
-        if self.import_mlir or self.use_lora:
+        self.vae_tile_size = self.get_vae_tile_size()
+        if self.vae_tile_size is not None:
+            # The tile VAE is the same for every resolution, import it.
+            with self.sd_model.vae_tiles(self.vae_tile_size):
+                self.vae = self.sd_model.vae()
+        elif self.import_mlir or self.use_lora:
             self.vae = self.sd_model.vae()
         else:
             try:
@@ -196,6 +229,7 @@ class StableDiffusionPipeline:
     def unload_vae(self):
         del self.vae
         self.vae = None
+        self.vae_tile_size = None
         gc.collect()
 
     def encode_prompt_sdxl(
@@ -404,6 +438,16 @@ class StableDiffusionPipeline:
 
         return text_embeddings
 
+    def run_vae(self, latents):
+        if self.vae_tile_size is None:
+            return self.vae("forward", (latents,))
+        return tiled_decode(
+            lambda tile: self.vae("forward", (tile,)),
+            latents,
+            self.vae_tile_size // 8,
+            args.vae_tile_overlap // 8,
+        )
+
     def decode_latents(self, latents, use_base_vae, cpu_scheduling):
         if use_base_vae:
             latents = 1 / 0.18215 * latents
@@ -414,7 +458,7 @@ class StableDiffusionPipeline:
 
         profile_device = start_profiling(file_path="vae.rdc")
         vae_start = time.time()
-        images = self.vae("forward", (latents_numpy,))
+        images = self.run_vae(latents_numpy)
         vae_inf_time = (time.time() - vae_start) * 1000
         end_profiling(profile_device)
         self.log += f"\nVAE Inference time (ms): {vae_inf_time:.3f}"
@@ -603,7 +647,7 @@ class StableDiffusionPipeline:
         if is_fp32_vae:
             print("Casting latents to float32 for VAE")
             latents = latents.to(torch.float32)
-        images = self.vae("forward", (latents,))
+        images = self.run_vae(latents)
         images = (torch.from_numpy(images) / 2 + 0.5).clamp(0, 1)
         images = images.cpu().permute(0, 2, 3, 1).float().numpy()
 
@@ -11,6 +11,11 @@ from apps.stable_diffusion.src.utils.resources import (
 )
 from apps.stable_diffusion.src.utils.sd_annotation import sd_model_annotation
 from apps.stable_diffusion.src.utils.stable_args import args
+from apps.stable_diffusion.src.utils.image_writer import (
+    get_image_writer,
+    flush_image_writer,
+    get_img_save_info,
+)
 from apps.stable_diffusion.src.utils.stencils.stencil_utils import (
     controlnet_hint_conversion,
     get_stencil_model_id,
@@ -38,10 +43,18 @@ from apps.stable_diffusion.src.utils.utils import (
     save_output_img,
     get_generation_text_info,
     update_lora_weight,
+    with_external_lora_weights,
+    RuntimeLoraModule,
     resize_stencil,
     _compile_module,
 )
 from apps.stable_diffusion.src.utils.civitai import get_civitai_checkpoint
+from apps.stable_diffusion.src.utils.vae_tiling import (
+    check_tile_args,
+    needs_tiling,
+    tiled_decode,
+    tiled_encode,
+)
 from apps.stable_diffusion.src.utils.resamplers import (
     resamplers,
     resampler_list,
@@ -0,0 +1,164 @@
+import atexit
+import concurrent.futures
+import json
+import os
+import threading
+import time
+from collections import deque
+from csv import DictWriter
+
+from apps.stable_diffusion.src.utils.stable_args import args
+
+
+"""
+Saving of output images off the request thread.
+
+Images are encoded in a pool of worker threads (PIL releases the GIL
+while compressing), at most --img_save_queue_size at a time; submitting
+more blocks until one is written. The CSV and JSON metadata of an image is
+appended as soon as it and every image submitted before it are written.
+"""
+
+
+def encode_image(img, path, img_format, params):
+    img.save(path, img_format, **params)
+    return path
+
+
+def write_image_metadata(entries):
+    """
+    Appends `entries`, (csv_path, entry, json_path) tuples, to their
+    CSV files, opening each file once. Entries with a json_path are also
+    written to that JSON file, without their "OUTPUT".
+    """
+    by_csv = {}
+    for csv_path, entry, json_path in entries:
+        by_csv.setdefault(csv_path, []).append(entry)
+        if json_path is not None:
+            json_entry = {k: v for k, v in entry.items() if k != "OUTPUT"}
+            with open(json_path, "w") as f:
+                json.dump(json_entry, f, indent=4)
+
+    for csv_path, rows in by_csv.items():
+        write_header = not os.path.isfile(csv_path)
+        with open(csv_path, "a", encoding="utf-8") as csv_obj:
+            for row in rows:
+                dictwriter_obj = DictWriter(csv_obj, fieldnames=list(row))
+                if write_header:
+                    dictwriter_obj.writeheader()
+                    write_header = False
+                dictwriter_obj.writerow(row)
+
+
+class ImageWriter:
+    def __init__(self, num_workers=2, max_pending=16):
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, num_workers), thread_name_prefix="img_save"
+        )
+        self.slots = threading.BoundedSemaphore(max(1, max_pending))
+        self.lock = threading.Lock()
+        # (future, metadata) in submission order, not yet in the CSV.
+        self.pending = deque()
+
+    def submit(self, img, path, img_format, params, metadata):
+        """
+        Queues `img` to be saved to `path`, followed by its `metadata` (see
+        write_image_metadata). Returns a future that is done once the image
+        is written; the caller must not modify `img` until then.
+        """
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(
+                encode_image, img, path, img_format, params
+            )
+        except BaseException:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending.append((future, metadata))
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        self.slots.release()
+        if future.exception() is not None:
+            print(f"[ERROR] Saving output image failed: {future.exception()}")
+        self._write_done()
+
+    def _write_done(self):
+        with self.lock:
+            ready = 0
+            for future, _ in self.pending:
+                if not future.done():
+                    break
+                ready += 1
+            if ready == 0:
+                return
+            done = [self.pending.popleft() for _ in range(ready)]
+            entries = [
+                metadata
+                for future, metadata in done
+                if future.exception() is None
+            ]
+            write_image_metadata(entries)
+
+    def flush(self, timeout=None):
+        """
+        Waits until every submitted image and its metadata is written.
+        Returns False if that took longer than `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            futures = [future for future, _ in self.pending]
+        for future in futures:
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+            try:
+                future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                return False
+            except Exception:
+                pass
+        self._write_done()
+        return True
+
+    def shutdown(self):
+        self.flush()
+        self.pool.shutdown()
+
+
+_image_writer = None
+
+
+def get_image_writer():
+    global _image_writer
+    if _image_writer is None:
+        _image_writer = ImageWriter(
+            args.img_save_workers, args.img_save_queue_size
+        )
+        atexit.register(_image_writer.shutdown)
+    return _image_writer
+
+
+def flush_image_writer(timeout=None):
+    """Writes out the output images still queued, if any."""
+    if _image_writer is None:
+        return True
+    return _image_writer.flush(timeout)
+
+
+def get_img_save_info(saves):
+    """
+    Returns a line for the generation info about `saves`, the results of
+    save_output_img calls, saying how many images are still being written
+    in the background or failed to save. Empty when all are on disk.
+    """
+    futures = [x for x in saves if isinstance(x, concurrent.futures.Future)]
+    pending = sum(not x.done() for x in futures)
+    failed = sum(x.done() and x.exception() is not None for x in futures)
+    info = ""
+    if pending:
+        info += f"\n{pending} image(s) still being saved in the background"
+    if failed:
+        info += f"\n{failed} image(s) could not be saved"
+    return info
@@ -335,6 +335,31 @@ p.add_argument(
     help="Do conversion from the VAE output to pixel space on cpu.",
 )
 
+p.add_argument(
+    "--vae_tiling",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Decode and encode images larger than --vae_tile_size in "
+    "overlapping tiles, with one VAE compiled for the tile size instead of "
+    "one per resolution.",
+)
+
+p.add_argument(
+    "--vae_tile_size",
+    type=int,
+    default=512,
+    help="Size in pixels of the square VAE tiles with --vae_tiling, a "
+    "multiple of 8 of at least 128.",
+)
+
+p.add_argument(
+    "--vae_tile_overlap",
+    type=int,
+    default=64,
+    help="Overlap in pixels of neighbouring VAE tiles with --vae_tiling, a "
+    "multiple of 8. Wider overlaps blend the seams better.",
+)
+
 p.add_argument(
     "--scheduler",
     type=str,
@@ -351,7 +376,38 @@ p.add_argument(
     type=str,
     default="png",
     help="Specify the format in which output image is save. "
-    "Supported options: jpg / png.",
+    "Supported options: jpg / png / webp.",
+)
+
+p.add_argument(
+    "--fast_img_encode",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Save output images with a faster, lighter compression (larger "
+    "png files).",
+)
+
+p.add_argument(
+    "--async_img_save",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Save output images and their metadata in the background instead "
+    "of before returning them.",
+)
+
+p.add_argument(
+    "--img_save_workers",
+    type=int,
+    default=2,
+    help="Number of threads encoding output images with --async_img_save.",
+)
+
+p.add_argument(
+    "--img_save_queue_size",
+    type=int,
+    default=16,
+    help="Number of output images that can be waiting to be saved with "
+    "--async_img_save before generation blocks.",
 )
 
 p.add_argument(
@@ -435,6 +491,23 @@ p.add_argument(
     "file (~3 MB).",
 )
 
+p.add_argument(
+    "--runtime_lora",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Compile the unet and clip with their LoRA target weights as "
+    "inputs, so that LoRA checkpoint files are applied and switched "
+    "without recompiling.",
+)
+
+p.add_argument(
+    "--lora_weight_cache_size",
+    type=int,
+    default=4,
+    help="Number of LoRA merged weight sets kept on the device per module "
+    "with --runtime_lora.",
+)
+
 p.add_argument(
     "--use_quantize",
     type=str,
@@ -452,6 +525,23 @@ p.add_argument(
     help="Load and unload models for low VRAM.",
 )
 
+p.add_argument(
+    "--max_resident_pipelines",
+    type=int,
+    default=1,
+    help="Number of compiled pipelines the web UI and api keep loaded at "
+    "once. Switching back to a resident model/config skips reloading its "
+    "modules. Least recently used pipelines are unloaded beyond this.",
+)
+
+p.add_argument(
+    "--resident_pipelines_max_gb",
+    type=float,
+    default=None,
+    help="Memory budget in GB for the modules of resident pipelines, "
+    "counting modules shared between pipelines once. Unbounded if not set.",
+)
+
 p.add_argument(
     "--hf_auth_token",
     type=str,
@@ -668,6 +758,23 @@ p.add_argument(
     "in a web browser.",
 )
 
+p.add_argument(
+    "--api_max_batch_size",
+    type=int,
+    default=1,
+    help="Maximum number of concurrent txt2img REST api requests that are "
+    "batched into a single pipeline invocation. Batches are padded to this "
+    "size so that only one pipeline is compiled. 1 disables batching.",
+)
+
+p.add_argument(
+    "--api_max_batch_wait_ms",
+    type=float,
+    default=50,
+    help="How long the REST api batching scheduler waits for more "
+    "compatible requests before running an incomplete batch.",
+)
+
 p.add_argument(
     "--debug",
     default=False,
@@ -752,6 +859,32 @@ p.add_argument(
     help="Specifies whether the docuchat's web version is running or not.",
 )
 
+p.add_argument(
+    "--chat_prefix_cache_gb",
+    type=float,
+    default=0,
+    help="Memory budget in GB for keeping the kv caches of chat sessions "
+    "between turns, so that a turn only prefills the tokens it adds. The "
+    "budget is taken on top of the model, in device memory on GPUs: about "
+    "0.5 MB per token of conversation for a 7B model in fp16, so 2 GB hold "
+    "~4000 tokens. 0 disables it.",
+)
+
+p.add_argument(
+    "--shark_embedding",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Embeds documents with a SHARK compiled sentence-transformer, "
+    "batched by token count, instead of the PyTorch one.",
+)
+
+p.add_argument(
+    "--shark_embedding_workers",
+    type=int,
+    default=2,
+    help="Number of workers running batches of the SHARK embedding model.",
+)
+
 ##############################################################################
 # rocm Flags
 ##############################################################################
@@ -1,6 +1,5 @@
 import cv2
 import numpy as np
-import math
 from scipy.ndimage.filters import gaussian_filter
 import torch
 import torch.nn as nn
@@ -12,6 +11,229 @@ from apps.stable_diffusion.src.utils.stencils.openpose.openpose_util import (
 )
 
 
+# find connection in the specified sequence, center 29 is in the position 15
+limbSeq = [
+    [2, 3],
+    [2, 6],
+    [3, 4],
+    [4, 5],
+    [6, 7],
+    [7, 8],
+    [2, 9],
+    [9, 10],
+    [10, 11],
+    [2, 12],
+    [12, 13],
+    [13, 14],
+    [2, 1],
+    [1, 15],
+    [15, 17],
+    [1, 16],
+    [16, 18],
+    [3, 17],
+    [6, 18],
+]
+# the middle joints heatmap correpondence
+mapIdx = [
+    [31, 32],
+    [39, 40],
+    [33, 34],
+    [35, 36],
+    [41, 42],
+    [43, 44],
+    [19, 20],
+    [21, 22],
+    [23, 24],
+    [25, 26],
+    [27, 28],
+    [29, 30],
+    [47, 48],
+    [49, 50],
+    [53, 54],
+    [51, 52],
+    [55, 56],
+    [37, 38],
+    [45, 46],
+]
+
+
+def find_peaks(heatmap_avg, thre1):
+    """
+    Returns for each of the 18 body parts an array with the x, y, score and
+    id of its peaks in `heatmap_avg`.
+    """
+    maps_ori = heatmap_avg[:, :, :18]
+    # sigma 0 along the last axis smooths every part map on its own
+    heatmaps = gaussian_filter(maps_ori, sigma=(3, 3, 0))
+
+    map_left = np.zeros(heatmaps.shape)
+    map_left[1:, :] = heatmaps[:-1, :]
+    map_right = np.zeros(heatmaps.shape)
+    map_right[:-1, :] = heatmaps[1:, :]
+    map_up = np.zeros(heatmaps.shape)
+    map_up[:, 1:] = heatmaps[:, :-1]
+    map_down = np.zeros(heatmaps.shape)
+    map_down[:, :-1] = heatmaps[:, 1:]
+
+    peaks_binary = np.logical_and.reduce(
+        (
+            heatmaps >= map_left,
+            heatmaps >= map_right,
+            heatmaps >= map_up,
+            heatmaps >= map_down,
+            heatmaps > thre1,
+        )
+    )
+
+    all_peaks = []
+    peak_counter = 0
+    for part in range(18):
+        ys, xs = np.nonzero(peaks_binary[:, :, part])
+        peaks = np.empty((len(xs), 4))
+        peaks[:, 0] = xs
+        peaks[:, 1] = ys
+        peaks[:, 2] = maps_ori[ys, xs, part]
+        peaks[:, 3] = np.arange(peak_counter, peak_counter + len(xs))
+        all_peaks.append(peaks)
+        peak_counter += len(xs)
+    return all_peaks
+
+
+def find_connections(paf_avg, all_peaks, img_height, thre2, mid_num=10):
+    """
+    Scores every candidate pair of each limb by the line integral of its
+    PAF over `mid_num` points, and greedily picks the best scoring pairs.
+    Returns the picked connections per limb (part ids, score and indices
+    into the peaks of both parts) and the limbs without candidates.
+    """
+    connection_all = []
+    special_k = []
+
+    for k in range(len(mapIdx)):
+        score_mid = paf_avg[:, :, [x - 19 for x in mapIdx[k]]]
+        candA = all_peaks[limbSeq[k][0] - 1]
+        candB = all_peaks[limbSeq[k][1] - 1]
+        nA = len(candA)
+        nB = len(candB)
+        if nA == 0 or nB == 0:
+            special_k.append(k)
+            connection_all.append([])
+            continue
+
+        # all nA x nB pairs at once
+        startA = candA[:, np.newaxis, :2]
+        endB = candB[np.newaxis, :, :2]
+        vec = endB - startA
+        norm = np.sqrt(vec[..., 0] * vec[..., 0] + vec[..., 1] * vec[..., 1])
+        norm = np.maximum(0.001, norm)
+        vec = vec / norm[..., np.newaxis]
+
+        startend = np.rint(np.linspace(startA, endB, num=mid_num)).astype(int)
+        vec_x = score_mid[startend[..., 1], startend[..., 0], 0]
+        vec_y = score_mid[startend[..., 1], startend[..., 0], 1]
+        score_midpts = vec_x * vec[..., 0] + vec_y * vec[..., 1]
+
+        # added up point by point, the pairwise summation of np.sum rounds
+        # differently and can reorder close candidates
+        score_sum = np.zeros((nA, nB))
+        for score in score_midpts:
+            score_sum = score_sum + score
+        score_with_dist_prior = score_sum / mid_num + np.minimum(
+            0.5 * img_height / norm - 1, 0
+        )
+        criterion1 = np.count_nonzero(
+            score_midpts > thre2, axis=0
+        ) > 0.8 * len(score_midpts)
+        criterion2 = score_with_dist_prior > 0
+
+        i, j = np.nonzero(criterion1 & criterion2)
+        scores = score_with_dist_prior[i, j]
+        connection = []
+        usedA = np.zeros(nA, dtype=bool)
+        usedB = np.zeros(nB, dtype=bool)
+        for c in np.argsort(-scores, kind="stable"):
+            if usedA[i[c]] or usedB[j[c]]:
+                continue
+            usedA[i[c]] = True
+            usedB[j[c]] = True
+            connection.append(
+                [candA[i[c], 3], candB[j[c], 3], scores[c], i[c], j[c]]
+            )
+            if len(connection) >= min(nA, nB):
+                break
+
+        connection_all.append(np.array(connection).reshape(-1, 5))
+    return connection_all, special_k
+
+
+def find_subsets(candidate, connection_all, special_k):
+    """
+    Assembles the connections into people. Each row of the returned subset
+    holds the candidate id of every part (-1 if missing), followed by the
+    score of the overall configuration and the number of parts.
+    """
+    num_connections = sum(
+        len(connection_all[k])
+        for k in range(len(mapIdx))
+        if k not in special_k
+    )
+    # every connection adds at most one row, rows [0, n) are in use
+    subset = -1 * np.ones((num_connections, 20))
+    n = 0
+
+    for k in range(len(mapIdx)):
+        if k in special_k:
+            continue
+        connection = connection_all[k]
+        partAs = connection[:, 0]
+        partBs = connection[:, 1]
+        indexA, indexB = np.array(limbSeq[k]) - 1
+        scoresB = candidate[partBs.astype(int), 2] + connection[:, 2]
+
+        for i in range(len(connection)):
+            found = np.nonzero(
+                (subset[:n, indexA] == partAs[i])
+                | (subset[:n, indexB] == partBs[i])
+            )[0]
+
+            if len(found) == 1:
+                j = found[0]
+                if subset[j, indexB] != partBs[i]:
+                    subset[j, indexB] = partBs[i]
+                    subset[j, -1] += 1
+                    subset[j, -2] += scoresB[i]
+            elif len(found) >= 2:  # if found 2 and disjoint, merge them
+                j1, j2 = found[:2]
+                membership = (subset[j1, :-2] >= 0) & (subset[j2, :-2] >= 0)
+                if not membership.any():  # merge
+                    subset[j1, :-2] += subset[j2, :-2] + 1
+                    subset[j1, -2:] += subset[j2, -2:]
+                    subset[j1, -2] += connection[i, 2]
+                    subset[j2 : n - 1] = subset[j2 + 1 : n]
+                    n -= 1
+                else:  # as like found == 1
+                    subset[j1, indexB] = partBs[i]
+                    subset[j1, -1] += 1
+                    subset[j1, -2] += scoresB[i]
+
+            # if find no partA in the subset, create a new subset
+            elif k < 17:
+                subset[n] = -1
+                subset[n, indexA] = partAs[i]
+                subset[n, indexB] = partBs[i]
+                subset[n, -1] = 2
+                subset[n, -2] = (
+                    sum(candidate[connection[i, :2].astype(int), 2])
+                    + connection[i, 2]
+                )
+                n += 1
+
+    # delete some rows of subset which has few parts occur
+    subset = subset[:n]
+    keep = (subset[:, -1] >= 4) & (subset[:, -2] / subset[:, -1] >= 0.4)
+    return subset[keep]
+
+
 class BodyPoseModel(nn.Module):
     def __init__(self):
         super(BodyPoseModel, self).__init__()
@@ -158,13 +380,12 @@ class Body(object):
         self.model.load_state_dict(model_dict)
         self.model.eval()
 
-    def __call__(self, oriImg):
+    def get_maps(self, oriImg):
+        """Returns the part heatmaps and PAFs of `oriImg` at its size."""
         scale_search = [0.5]
         boxsize = 368
         stride = 8
         padValue = 128
-        thre1 = 0.1
-        thre2 = 0.05
         multiplier = [x * boxsize / oriImg.shape[0] for x in scale_search]
         heatmap_avg = np.zeros((oriImg.shape[0], oriImg.shape[1], 19))
         paf_avg = np.zeros((oriImg.shape[0], oriImg.shape[1], 38))
@@ -245,255 +466,18 @@ class Body(object):
 
             heatmap_avg += heatmap_avg + heatmap / len(multiplier)
             paf_avg += +paf / len(multiplier)
+        return heatmap_avg, paf_avg
 
-        all_peaks = []
-        peak_counter = 0
-
-        for part in range(18):
-            map_ori = heatmap_avg[:, :, part]
-            one_heatmap = gaussian_filter(map_ori, sigma=3)
-
-            map_left = np.zeros(one_heatmap.shape)
-            map_left[1:, :] = one_heatmap[:-1, :]
-            map_right = np.zeros(one_heatmap.shape)
-            map_right[:-1, :] = one_heatmap[1:, :]
-            map_up = np.zeros(one_heatmap.shape)
-            map_up[:, 1:] = one_heatmap[:, :-1]
-            map_down = np.zeros(one_heatmap.shape)
-            map_down[:, :-1] = one_heatmap[:, 1:]
-
-            peaks_binary = np.logical_and.reduce(
-                (
-                    one_heatmap >= map_left,
-                    one_heatmap >= map_right,
-                    one_heatmap >= map_up,
-                    one_heatmap >= map_down,
-                    one_heatmap > thre1,
-                )
-            )
-            peaks = list(
-                zip(np.nonzero(peaks_binary)[1], np.nonzero(peaks_binary)[0])
-            )  # note reverse
-            peaks_with_score = [x + (map_ori[x[1], x[0]],) for x in peaks]
-            peak_id = range(peak_counter, peak_counter + len(peaks))
-            peaks_with_score_and_id = [
-                peaks_with_score[i] + (peak_id[i],)
-                for i in range(len(peak_id))
-            ]
-
-            all_peaks.append(peaks_with_score_and_id)
-            peak_counter += len(peaks)
-
-        # find connection in the specified sequence, center 29 is in the position 15
-        limbSeq = [
-            [2, 3],
-            [2, 6],
-            [3, 4],
-            [4, 5],
-            [6, 7],
-            [7, 8],
-            [2, 9],
-            [9, 10],
-            [10, 11],
-            [2, 12],
-            [12, 13],
-            [13, 14],
-            [2, 1],
-            [1, 15],
-            [15, 17],
-            [1, 16],
-            [16, 18],
-            [3, 17],
-            [6, 18],
-        ]
-        # the middle joints heatmap correpondence
-        mapIdx = [
-            [31, 32],
-            [39, 40],
-            [33, 34],
-            [35, 36],
-            [41, 42],
-            [43, 44],
-            [19, 20],
-            [21, 22],
-            [23, 24],
-            [25, 26],
-            [27, 28],
-            [29, 30],
-            [47, 48],
-            [49, 50],
-            [53, 54],
-            [51, 52],
-            [55, 56],
-            [37, 38],
-            [45, 46],
-        ]
+    def __call__(self, oriImg):
+        thre1 = 0.1
+        thre2 = 0.05
+        heatmap_avg, paf_avg = self.get_maps(oriImg)
 
-        connection_all = []
-        special_k = []
-        mid_num = 10
-
-        for k in range(len(mapIdx)):
-            score_mid = paf_avg[:, :, [x - 19 for x in mapIdx[k]]]
-            candA = all_peaks[limbSeq[k][0] - 1]
-            candB = all_peaks[limbSeq[k][1] - 1]
-            nA = len(candA)
-            nB = len(candB)
-            indexA, indexB = limbSeq[k]
-            if nA != 0 and nB != 0:
-                connection_candidate = []
-                for i in range(nA):
-                    for j in range(nB):
-                        vec = np.subtract(candB[j][:2], candA[i][:2])
-                        norm = math.sqrt(vec[0] * vec[0] + vec[1] * vec[1])
-                        norm = max(0.001, norm)
-                        vec = np.divide(vec, norm)
-
-                        startend = list(
-                            zip(
-                                np.linspace(
-                                    candA[i][0], candB[j][0], num=mid_num
-                                ),
-                                np.linspace(
-                                    candA[i][1], candB[j][1], num=mid_num
-                                ),
-                            )
-                        )
-
-                        vec_x = np.array(
-                            [
-                                score_mid[
-                                    int(round(startend[I][1])),
-                                    int(round(startend[I][0])),
-                                    0,
-                                ]
-                                for I in range(len(startend))
-                            ]
-                        )
-                        vec_y = np.array(
-                            [
-                                score_mid[
-                                    int(round(startend[I][1])),
-                                    int(round(startend[I][0])),
-                                    1,
-                                ]
-                                for I in range(len(startend))
-                            ]
-                        )
-
-                        score_midpts = np.multiply(
-                            vec_x, vec[0]
-                        ) + np.multiply(vec_y, vec[1])
-                        score_with_dist_prior = sum(score_midpts) / len(
-                            score_midpts
-                        ) + min(0.5 * oriImg.shape[0] / norm - 1, 0)
-                        criterion1 = len(
-                            np.nonzero(score_midpts > thre2)[0]
-                        ) > 0.8 * len(score_midpts)
-                        criterion2 = score_with_dist_prior > 0
-                        if criterion1 and criterion2:
-                            connection_candidate.append(
-                                [
-                                    i,
-                                    j,
-                                    score_with_dist_prior,
-                                    score_with_dist_prior
-                                    + candA[i][2]
-                                    + candB[j][2],
-                                ]
-                            )
-
-                connection_candidate = sorted(
-                    connection_candidate, key=lambda x: x[2], reverse=True
-                )
-                connection = np.zeros((0, 5))
-                for c in range(len(connection_candidate)):
-                    i, j, s = connection_candidate[c][0:3]
-                    if i not in connection[:, 3] and j not in connection[:, 4]:
-                        connection = np.vstack(
-                            [connection, [candA[i][3], candB[j][3], s, i, j]]
-                        )
-                        if len(connection) >= min(nA, nB):
-                            break
-
-                connection_all.append(connection)
-            else:
-                special_k.append(k)
-                connection_all.append([])
-
-        # last number in each row is the total parts number of that person
-        # the second last number in each row is the score of the overall configuration
-        subset = -1 * np.ones((0, 20))
-        candidate = np.array(
-            [item for sublist in all_peaks for item in sublist]
+        all_peaks = find_peaks(heatmap_avg, thre1)
+        connection_all, special_k = find_connections(
+            paf_avg, all_peaks, oriImg.shape[0], thre2
         )
-
-        for k in range(len(mapIdx)):
-            if k not in special_k:
-                partAs = connection_all[k][:, 0]
-                partBs = connection_all[k][:, 1]
-                indexA, indexB = np.array(limbSeq[k]) - 1
-
-                for i in range(len(connection_all[k])):  # = 1:size(temp,1)
-                    found = 0
-                    subset_idx = [-1, -1]
-                    for j in range(len(subset)):  # 1:size(subset,1):
-                        if (
-                            subset[j][indexA] == partAs[i]
-                            or subset[j][indexB] == partBs[i]
-                        ):
-                            subset_idx[found] = j
-                            found += 1
-
-                    if found == 1:
-                        j = subset_idx[0]
-                        if subset[j][indexB] != partBs[i]:
-                            subset[j][indexB] = partBs[i]
-                            subset[j][-1] += 1
-                            subset[j][-2] += (
-                                candidate[partBs[i].astype(int), 2]
-                                + connection_all[k][i][2]
-                            )
-                    elif found == 2:  # if found 2 and disjoint, merge them
-                        j1, j2 = subset_idx
-                        membership = (
-                            (subset[j1] >= 0).astype(int)
-                            + (subset[j2] >= 0).astype(int)
-                        )[:-2]
-                        if len(np.nonzero(membership == 2)[0]) == 0:  # merge
-                            subset[j1][:-2] += subset[j2][:-2] + 1
-                            subset[j1][-2:] += subset[j2][-2:]
-                            subset[j1][-2] += connection_all[k][i][2]
-                            subset = np.delete(subset, j2, 0)
-                        else:  # as like found == 1
-                            subset[j1][indexB] = partBs[i]
-                            subset[j1][-1] += 1
-                            subset[j1][-2] += (
-                                candidate[partBs[i].astype(int), 2]
-                                + connection_all[k][i][2]
-                            )
-
-                    # if find no partA in the subset, create a new subset
-                    elif not found and k < 17:
-                        row = -1 * np.ones(20)
-                        row[indexA] = partAs[i]
-                        row[indexB] = partBs[i]
-                        row[-1] = 2
-                        row[-2] = (
-                            sum(
-                                candidate[
-                                    connection_all[k][i, :2].astype(int), 2
-                                ]
-                            )
-                            + connection_all[k][i][2]
-                        )
-                        subset = np.vstack([subset, row])
-        # delete some rows of subset which has few parts occur
-        deleteIdx = []
-        for i in range(len(subset)):
-            if subset[i][-1] < 4 or subset[i][-2] / subset[i][-1] < 0.4:
-                deleteIdx.append(i)
-        subset = np.delete(subset, deleteIdx, axis=0)
-
         # candidate: x, y, score, id
+        candidate = np.concatenate(all_peaks)
+        subset = find_subsets(candidate, connection_all, special_k)
         return candidate, subset
@@ -5,7 +5,6 @@ import re
 from PIL import PngImagePlugin
 from PIL import Image
 from datetime import datetime as dt
-from csv import DictWriter
 from pathlib import Path
 import numpy as np
 from random import (
@@ -15,6 +14,8 @@ from random import (
     setstate as random_setstate,
 )
 import tempfile
+import weakref
+from collections import OrderedDict
 import torch
 from safetensors.torch import load_file
 from shark.shark_inference import SharkInference
@@ -27,6 +28,11 @@ from shark.iree_utils.vulkan_utils import (
 from shark.iree_utils.metal_utils import get_metal_target_triple
 from shark.iree_utils.gpu_utils import get_cuda_sm_cc, get_iree_rocm_args
 from apps.stable_diffusion.src.utils.stable_args import args
+from apps.stable_diffusion.src.utils.image_writer import (
+    encode_image,
+    get_image_writer,
+    write_image_metadata,
+)
 from apps.stable_diffusion.src.utils.resources import opt_flags
 from apps.stable_diffusion.src.utils.sd_annotation import sd_model_annotation
 import sys
@@ -52,13 +58,28 @@ def get_vmfb_path_name(model_name):
     return vmfb_path
 
 
+# Modules loaded from a vmfb, shared by every pipeline that loads the same
+# vmfb (e.g. the same VAE) for as long as one of them holds on to it.
+_loaded_vmfbs = weakref.WeakValueDictionary()
+
+
 def _load_vmfb(shark_module, vmfb_path, model, precision):
+    vmfb_key = (
+        os.path.abspath(vmfb_path),
+        os.path.getmtime(vmfb_path),
+        args.device,
+    )
+    if vmfb_key in _loaded_vmfbs:
+        print(f"Sharing already loaded module: {vmfb_path}")
+        return _loaded_vmfbs[vmfb_key]
     model = "vae" if "base_vae" in model or "vae_encode" in model else model
     model = "unet" if "stencil" in model else model
     model = "unet" if "unet512" in model else model
     precision = "fp32" if "clip" in model else precision
     extra_args = get_opt_flags(model, precision)
     shark_module.load_module(vmfb_path, extra_args=extra_args)
+    shark_module.vmfb_path = vmfb_path
+    _loaded_vmfbs[vmfb_key] = shark_module
     return shark_module
 
 
@@ -638,22 +659,42 @@ def convert_original_vae(vae_checkpoint):
     return converted_vae_checkpoint
 
 
-def processLoRA(model, use_lora, splitting_prefix):
-    state_dict = ""
+def load_lora_state_dict(use_lora):
     if ".safetensors" in use_lora:
-        state_dict = load_file(use_lora)
-    else:
-        state_dict = torch.load(use_lora)
-    alpha = 0.75
-    visited = []
+        return load_file(use_lora)
+    return torch.load(use_lora)
+
+
+def _resolve_lora_layer(layer_infos, module_names):
+    # Finds the module a LoRA key refers to. Its name is "_" separated in
+    # the key, while module names themselves may contain "_" as well.
+    path = []
+    temp_name = layer_infos.pop(0)
+    while True:
+        if ".".join(path + [temp_name]) in module_names:
+            path.append(temp_name)
+            if len(layer_infos) == 0:
+                return ".".join(path)
+            temp_name = layer_infos.pop(0)
+        elif len(temp_name) > 0:
+            temp_name += "_" + layer_infos.pop(0)
+        else:
+            temp_name = layer_infos.pop(0)
+
+
+def get_lora_deltas(state_dict, module_names, splitting_prefix, alpha=0.75):
+    """
+    Returns the weight deltas of a LoRA state dict by parameter name,
+    for the model with the given `module_names`.
+    """
+    visited = set()
+    deltas = {}
 
-    # directly update weight in model
     process_unet = "te" not in splitting_prefix
     for key in state_dict:
         if ".alpha" in key or key in visited:
             continue
 
-        curr_layer = model
         if ("text" not in key and process_unet) or (
             "text" in key and not process_unet
         ):
@@ -664,19 +705,7 @@ def processLoRA(model, use_lora, splitting_prefix):
             continue
 
         # find the target layer
-        temp_name = layer_infos.pop(0)
-        while len(layer_infos) > -1:
-            try:
-                curr_layer = curr_layer.__getattr__(temp_name)
-                if len(layer_infos) > 0:
-                    temp_name = layer_infos.pop(0)
-                elif len(layer_infos) == 0:
-                    break
-            except Exception:
-                if len(temp_name) > 0:
-                    temp_name += "_" + layer_infos.pop(0)
-                else:
-                    temp_name = layer_infos.pop(0)
+        layer_name = _resolve_lora_layer(layer_infos, module_names)
 
         pair_keys = []
         if "lora_down" in key:
@@ -686,7 +715,7 @@ def processLoRA(model, use_lora, splitting_prefix):
             pair_keys.append(key)
             pair_keys.append(key.replace("lora_up", "lora_down"))
 
-        # update weight
+        # weight delta
         if len(state_dict[pair_keys[0]].shape) == 4:
             weight_up = (
                 state_dict[pair_keys[0]]
@@ -700,19 +729,204 @@ def processLoRA(model, use_lora, splitting_prefix):
                 .squeeze(2)
                 .to(torch.float32)
             )
-            curr_layer.weight.data += alpha * torch.mm(
-                weight_up, weight_down
-            ).unsqueeze(2).unsqueeze(3)
+            delta = alpha * torch.mm(weight_up, weight_down).unsqueeze(
+                2
+            ).unsqueeze(3)
         else:
             weight_up = state_dict[pair_keys[0]].to(torch.float32)
             weight_down = state_dict[pair_keys[1]].to(torch.float32)
-            curr_layer.weight.data += alpha * torch.mm(weight_up, weight_down)
-        # update visited list
-        for item in pair_keys:
-            visited.append(item)
+            delta = alpha * torch.mm(weight_up, weight_down)
+        name = layer_name + ".weight"
+        deltas[name] = deltas[name] + delta if name in deltas else delta
+        # update visited set
+        visited.update(pair_keys)
+    return deltas
+
+
+def processLoRA(model, use_lora, splitting_prefix):
+    state_dict = load_lora_state_dict(use_lora)
+    module_names = {name for name, _ in model.named_modules()}
+    params = dict(model.named_parameters())
+
+    # directly update weight in model
+    deltas = get_lora_deltas(state_dict, module_names, splitting_prefix)
+    for name, delta in deltas.items():
+        params[name].data += delta
     return model
 
 
+def get_lora_target_params(model, scope):
+    # Weights LoRAs may change: those of the linear and 1x1 conv layers
+    # whose name contains `scope`, i.e. of the attention/transformer blocks.
+    names = []
+    for name, module in model.named_modules():
+        if scope not in name:
+            continue
+        if isinstance(module, torch.nn.Linear) or (
+            isinstance(module, torch.nn.Conv2d)
+            and module.kernel_size == (1, 1)
+        ):
+            names.append(name + ".weight")
+    return names
+
+
+class ExternalWeightsModel(torch.nn.Module):
+    """
+    Runs `model` with the weights named `param_names` taken from the last
+    inputs of forward, so that they become inputs of the compiled module.
+    """
+
+    def __init__(self, model, param_names):
+        super().__init__()
+        self.model = model
+        self.param_names = param_names
+
+    def forward(self, *inputs):
+        num_inputs = len(inputs) - len(self.param_names)
+        weights = dict(zip(self.param_names, inputs[num_inputs:]))
+        return torch.func.functional_call(
+            self.model, weights, inputs[:num_inputs]
+        )
+
+
+def with_external_lora_weights(model, submodule, scope, inputs, input_mask):
+    """
+    Prepares `model` for compiling with the LoRA target weights of its
+    `submodule` as inputs. Returns the model, inputs and f16 input mask
+    to compile with, and the target weights by name within `submodule`.
+    """
+    inner = getattr(model, submodule)
+    names = get_lora_target_params(inner, scope)
+    params = dict(inner.named_parameters())
+    base_weights = {name: params[name].detach() for name in names}
+    model = ExternalWeightsModel(model, [f"{submodule}.{n}" for n in names])
+    inputs = tuple(inputs) + tuple(base_weights.values())
+    if input_mask is not None:
+        input_mask = list(input_mask) + [True] * len(names)
+    module_names = {name for name, _ in inner.named_modules()}
+    return model, inputs, input_mask, base_weights, module_names
+
+
+class RuntimeLoraModule:
+    """
+    A compiled module whose LoRA target weights are inputs, see
+    with_external_lora_weights. Every call passes it the weights of the
+    LoRAs currently set, which live on the device, so LoRAs are switched
+    without recompiling. The merged weights of the last
+    --lora_weight_cache_size LoRA combinations are kept on the device.
+    """
+
+    def __init__(
+        self,
+        shark_module,
+        base_weights,
+        module_names,
+        splitting_prefix,
+        dtype,
+    ):
+        self.shark_module = shark_module
+        self.param_names = list(base_weights.keys())
+        self.base_weights = {
+            name: weight.to(dtype) for name, weight in base_weights.items()
+        }
+        self.module_names = module_names
+        self.splitting_prefix = splitting_prefix
+        self.dtype = dtype
+        self.merged_cache = OrderedDict()
+        self.base_device_weights = self._upload(self.base_weights)
+        self.lora_key = None
+        self._use((), {})
+
+    def _upload(self, weights):
+        from iree.runtime import asdevicearray
+
+        device = self.shark_module.shark_runner.iree_config.device
+        return {
+            name: asdevicearray(device, weight.to(self.dtype).numpy())
+            for name, weight in weights.items()
+        }
+
+    def _use(self, key, device_weights):
+        self.lora_key = key
+        self.device_weights = [
+            device_weights.get(name, self.base_device_weights[name])
+            for name in self.param_names
+        ]
+
+    def _cache(self, key, device_weights):
+        self.merged_cache[key] = device_weights
+        while len(self.merged_cache) > max(1, args.lora_weight_cache_size):
+            self.merged_cache.popitem(last=False)
+
+    def _lookup(self, key):
+        if key not in self.merged_cache:
+            return None
+        self.merged_cache.move_to_end(key)
+        return self.merged_cache[key]
+
+    def set_loras(self, loras, alpha=0.75):
+        """
+        Applies the LoRA file(s) `loras`, replacing the ones set before. A
+        list may give (file, alpha) pairs; "" or [] removes all LoRAs.
+        """
+        if isinstance(loras, str):
+            loras = [loras] if loras else []
+        key = tuple(
+            (lora, alpha) if isinstance(lora, str) else tuple(lora)
+            for lora in loras
+        )
+        if key == self.lora_key:
+            return
+        if not key:
+            self._use(key, {})
+            return
+        device_weights = self._lookup(key)
+        if device_weights is None:
+            merged = {}
+            for lora, lora_alpha in key:
+                if not os.path.isfile(lora):
+                    print(f"Runtime LoRA needs a LoRA file, ignoring {lora}")
+                    continue
+                deltas = get_lora_deltas(
+                    load_lora_state_dict(lora),
+                    self.module_names,
+                    self.splitting_prefix,
+                    lora_alpha,
+                )
+                for name, delta in deltas.items():
+                    if name not in self.base_weights:
+                        print(f"Runtime LoRA can not change {name}, ignored")
+                        continue
+                    if name not in merged:
+                        merged[name] = self.base_weights[name].float().clone()
+                    merged[name] += delta
+            device_weights = self._upload(merged)
+            self._cache(key, device_weights)
+        self._use(key, device_weights)
+
+    def set_merged_weights(self, name, weights):
+        """
+        Uses the pre-merged `weights` (by parameter name) instead of the
+        base ones, cached under `name`.
+        """
+        key = (("merged", name),)
+        device_weights = self._lookup(key)
+        if device_weights is None:
+            device_weights = self._upload(weights)
+            self._cache(key, device_weights)
+        self._use(key, device_weights)
+
+    def __call__(self, function_name, inputs, send_to_host=True):
+        return self.shark_module(
+            function_name,
+            tuple(inputs) + tuple(self.device_weights),
+            send_to_host=send_to_host,
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.shark_module, name)
+
+
 def update_lora_weight_for_unet(unet, use_lora):
     extensions = [".bin", ".safetensors", ".pt"]
     if not any([extension in use_lora for extension in extensions]):
@@ -876,16 +1090,24 @@ def get_generated_imgs_todays_subdir() -> str:
 
 
 # save output images and the inputs corresponding to it.
-def save_output_img(output_img, img_seed, extra_info=None):
+def save_output_img(
+    output_img, img_seed, extra_info=None, prompt=None, negative_prompt=None
+):
+    # `prompt` and `negative_prompt` default to the ones of the run, images
+    # of a batch of different requests pass their own.
     if extra_info is None:
         extra_info = {}
+    if prompt is None:
+        prompt = args.prompts[0]
+    if negative_prompt is None:
+        negative_prompt = args.negative_prompts[0]
     generated_imgs_path = Path(
         get_generated_imgs_path(), get_generated_imgs_todays_subdir()
     )
     generated_imgs_path.mkdir(parents=True, exist_ok=True)
     csv_path = Path(generated_imgs_path, "imgs_details.csv")
 
-    prompt_slice = re.sub("[^a-zA-Z0-9]", "_", args.prompts[0][:15])
+    prompt_slice = re.sub("[^a-zA-Z0-9]", "_", prompt[:15])
     out_img_name = f"{dt.now().strftime('%H%M%S')}_{prompt_slice}_{img_seed}"
 
     img_model = args.hf_model_id
@@ -902,7 +1124,15 @@ def save_output_img(output_img, img_seed, extra_info=None):
 
     if args.output_img_format == "jpg":
         out_img_path = Path(generated_imgs_path, f"{out_img_name}.jpg")
-        output_img.save(out_img_path, quality=95, subsampling=0)
+        img_format = "JPEG"
+        save_params = {"quality": 95, "subsampling": 0}
+    elif args.output_img_format == "webp":
+        out_img_path = Path(generated_imgs_path, f"{out_img_name}.webp")
+        img_format = "WEBP"
+        save_params = {
+            "quality": 95,
+            "method": 0 if args.fast_img_encode else 4,
+        }
     else:
         out_img_path = Path(generated_imgs_path, f"{out_img_name}.png")
         pngInfo = PngImagePlugin.PngInfo()
@@ -917,8 +1147,8 @@ def save_output_img(output_img, img_seed, extra_info=None):
 
             pngInfo.add_text(
                 "parameters",
-                f"{args.prompts[0]}"
-                f"\nNegative prompt: {args.negative_prompts[0]}"
+                f"{prompt}"
+                f"\nNegative prompt: {negative_prompt}"
                 f"\nSteps: {args.steps},"
                 f"Sampler: {args.scheduler}, "
                 f"CFG scale: {args.guidance_scale}, "
@@ -929,13 +1159,17 @@ def save_output_img(output_img, img_seed, extra_info=None):
                 f"LoRA: {img_lora}",
             )
 
-        output_img.save(out_img_path, "PNG", pnginfo=pngInfo)
+        img_format = "PNG"
+        save_params = {
+            "pnginfo": pngInfo,
+            "compress_level": 1 if args.fast_img_encode else 6,
+        }
 
         if args.output_img_format not in ["png", "jpg"]:
             print(
                 f"[ERROR] Format {args.output_img_format} is not "
                 f"supported yet. Image saved as png instead."
-                f"Supported formats: png / jpg"
+                f"Supported formats: png / jpg / webp"
             )
 
     # To be as low-impact as possible to the existing CSV format, we append
@@ -944,8 +1178,8 @@ def save_output_img(output_img, img_seed, extra_info=None):
     new_entry = {
         "VARIANT": img_model,
         "SCHEDULER": args.scheduler,
-        "PROMPT": args.prompts[0],
-        "NEG_PROMPT": args.negative_prompts[0],
+        "PROMPT": prompt,
+        "NEG_PROMPT": negative_prompt,
         "SEED": img_seed,
         "CFG_SCALE": args.guidance_scale,
         "PRECISION": args.precision,
@@ -962,19 +1196,19 @@ def save_output_img(output_img, img_seed, extra_info=None):
 
     new_entry.update(extra_info)
 
-    csv_mode = "a" if os.path.isfile(csv_path) else "w"
-    with open(csv_path, csv_mode, encoding="utf-8") as csv_obj:
-        dictwriter_obj = DictWriter(csv_obj, fieldnames=list(new_entry.keys()))
-        if csv_mode == "w":
-            dictwriter_obj.writeheader()
-        dictwriter_obj.writerow(new_entry)
-        csv_obj.close()
-
+    json_path = None
     if args.save_metadata_to_json:
-        del new_entry["OUTPUT"]
         json_path = Path(generated_imgs_path, f"{out_img_name}.json")
-        with open(json_path, "w") as f:
-            json.dump(new_entry, f, indent=4)
+    metadata = (csv_path, new_entry, json_path)
+
+    # With --async_img_save this returns once the image is queued, with a
+    # future that is done when it is written.
+    if args.async_img_save:
+        return get_image_writer().submit(
+            output_img, out_img_path, img_format, save_params, metadata
+        )
+    encode_image(output_img, out_img_path, img_format, save_params)
+    write_image_metadata([metadata])
 
 
 def get_generation_text_info(seeds, device):
@@ -0,0 +1,134 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Tiled VAE decoding and encoding.
+#
+# The input is split into overlapping tiles of one fixed shape, so a single
+# compiled VAE serves every resolution. The outputs of the tiles are
+# blended with weights that ramp down linearly across the overlaps, which
+# hides the seams.
+import math
+
+import numpy as np
+
+
+def tile_starts(size, tile, overlap, align=1):
+    """
+    Returns the offsets, multiples of `align`, of the tiles covering `size`,
+    spread evenly so that neighbouring tiles overlap by about `overlap`.
+    """
+    if size <= tile:
+        return [0]
+    stride = max(tile - overlap, 1)
+    count = math.ceil((size - tile) / stride) + 1
+    return [
+        align * round(i * (size - tile) / (count - 1) / align)
+        for i in range(count)
+    ]
+
+
+def blend_weights(height, width, overlap_h, overlap_w):
+    # 1 in the middle of the tile, falling towards 0 over `overlap` at every
+    # edge, but never 0, so that pixels seen by one tile only keep it.
+    def ramp(size, overlap):
+        ramp = np.ones(size, dtype=np.float32)
+        if overlap > 0:
+            edge = np.arange(1, overlap + 1, dtype=np.float32) / (overlap + 1)
+            edge = edge[: size // 2]
+            ramp[: len(edge)] = edge
+            ramp[size - len(edge) :] = edge[::-1]
+        return ramp
+
+    return np.outer(ramp(height, overlap_h), ramp(width, overlap_w))
+
+
+def tiled_apply(fn, x, tile, overlap, scale):
+    """
+    Applies `fn`, which maps a (N, C, tile, tile) array to a
+    (N, C', tile * scale, tile * scale) one, to all of `x` (N, C, H, W) and
+    returns the blended (N, C', H * scale, W * scale) result. Inputs smaller
+    than a tile are padded by reflection.
+    """
+    x = np.asarray(x)
+    height, width = x.shape[-2:]
+    pad_h, pad_w = max(tile - height, 0), max(tile - width, 0)
+    if pad_h or pad_w:
+        mode = "reflect" if pad_h < height and pad_w < width else "edge"
+        x = np.pad(x, ((0, 0), (0, 0), (0, pad_h), (0, pad_w)), mode=mode)
+
+    # Tiles of the input must start on whole output pixels.
+    align = round(1 / scale) if scale < 1 else 1
+    out_tile = round(tile * scale)
+    out_overlap = round(overlap * scale)
+    weights = blend_weights(out_tile, out_tile, out_overlap, out_overlap)
+    output = None
+    weight_sum = np.zeros(
+        (round(x.shape[-2] * scale), round(x.shape[-1] * scale)),
+        dtype=np.float32,
+    )
+    for top in tile_starts(x.shape[-2], tile, overlap, align):
+        for left in tile_starts(x.shape[-1], tile, overlap, align):
+            result = np.asarray(
+                fn(x[:, :, top : top + tile, left : left + tile])
+            )
+            if output is None:
+                output = np.zeros(
+                    result.shape[:2] + weight_sum.shape, dtype=np.float32
+                )
+            out_top, out_left = round(top * scale), round(left * scale)
+            window = (
+                slice(out_top, out_top + out_tile),
+                slice(out_left, out_left + out_tile),
+            )
+            output[(Ellipsis,) + window] += result * weights
+            weight_sum[window] += weights
+
+    output /= weight_sum
+    return output[
+        :, :, : round(height * scale), : round(width * scale)
+    ].astype(result.dtype)
+
+
+def tiled_decode(vae_fn, latents, tile, overlap):
+    # `tile` and `overlap` are in latent pixels, the VAE upsamples by 8.
+    return tiled_apply(vae_fn, latents, tile, overlap, 8)
+
+
+def tiled_encode(vae_encode_fn, image, tile, overlap):
+    # `tile` and `overlap` are in image pixels, multiples of 8.
+    return tiled_apply(vae_encode_fn, image, tile, overlap, 1 / 8)
+
+
+def check_tile_args(tile, overlap):
+    """
+    Raises ValueError unless `tile` is a multiple of 8 of at least 128 and
+    `overlap` a multiple of 8 smaller than `tile`, in pixels. The VAE works
+    on whole latents, and tiles overlapping by a whole tile would never
+    advance.
+    """
+    if tile < 128 or tile % 8:
+        raise ValueError(
+            f"--vae_tile_size must be a multiple of 8 of at least 128, "
+            f"got {tile}"
+        )
+    if not 0 <= overlap < tile or overlap % 8:
+        raise ValueError(
+            f"--vae_tile_overlap must be a multiple of 8 in [0, "
+            f"--vae_tile_size), got {overlap} for a tile size of {tile}"
+        )
+
+
+def needs_tiling(height, width, tile):
+    # Images that fit in a tile are cheaper to run through the VAE whole.
+    return height > tile or width > tile
@@ -0,0 +1,102 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import json
+import threading
+import time
+
+from PIL import Image
+
+from apps.stable_diffusion.src.utils import image_writer
+from apps.stable_diffusion.src.utils.image_writer import (
+    ImageWriter,
+    get_img_save_info,
+)
+
+
+def read_seeds(csv_path):
+    if not csv_path.exists():
+        return []
+    with open(csv_path, encoding="utf-8") as f:
+        return [row["SEED"] for row in csv.DictReader(f)]
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def submit(writer, tmp_path, seed, json_path=None):
+    metadata = (tmp_path / "imgs_details.csv", {"SEED": seed}, json_path)
+    return writer.submit(
+        Image.new("RGB", (8, 8)),
+        tmp_path / f"{seed}.png",
+        "PNG",
+        {},
+        metadata,
+    )
+
+
+def test_metadata_written_per_image_in_order(tmp_path, monkeypatch):
+    release_first = threading.Event()
+    encode_image = image_writer.encode_image
+
+    def slow_first(img, path, img_format, params):
+        if path.stem == "0":
+            release_first.wait(10)
+        return encode_image(img, path, img_format, params)
+
+    monkeypatch.setattr(image_writer, "encode_image", slow_first)
+    writer = ImageWriter(num_workers=2, max_pending=4)
+    csv_path = tmp_path / "imgs_details.csv"
+    try:
+        first = submit(writer, tmp_path, 0)
+        second = submit(writer, tmp_path, 1, tmp_path / "1.json")
+        second.result(10)
+        # The second image is on disk, but its row waits for the first one.
+        assert (tmp_path / "1.png").exists()
+        assert read_seeds(csv_path) == []
+        assert "1 image(s) still being saved" in get_img_save_info(
+            [first, second]
+        )
+
+        release_first.set()
+        first.result(10)
+        # Written without a flush, as soon as both images are done.
+        wait_for(lambda: len(read_seeds(csv_path)) == 2)
+        assert read_seeds(csv_path) == ["0", "1"]
+        with open(tmp_path / "1.json") as f:
+            assert json.load(f) == {"SEED": 1}
+        assert get_img_save_info([first, second, None]) == ""
+    finally:
+        release_first.set()
+        writer.shutdown()
+
+
+def test_failed_image_has_no_metadata(tmp_path, monkeypatch):
+    def fail(img, path, img_format, params):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(image_writer, "encode_image", fail)
+    writer = ImageWriter(num_workers=1, max_pending=1)
+    try:
+        future = submit(writer, tmp_path, 0)
+        assert writer.flush(10)
+    finally:
+        writer.shutdown()
+    assert read_seeds(tmp_path / "imgs_details.csv") == []
+    assert "1 image(s) could not be saved" in get_img_save_info([future])
@@ -0,0 +1,317 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Checks the vectorized OpenPose body post-processing against the loop
+# based implementation it replaced. Run as a script to benchmark both:
+#   python test_openpose_body.py [image ...]
+
+import argparse
+import math
+import time
+
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+from apps.stable_diffusion.src.utils.stencils.openpose.body import (
+    find_connections,
+    find_peaks,
+    find_subsets,
+    limbSeq,
+    mapIdx,
+)
+
+
+def body_pose(heatmap_avg, paf_avg, img_height):
+    all_peaks = find_peaks(heatmap_avg, 0.1)
+    connection_all, special_k = find_connections(
+        paf_avg, all_peaks, img_height, 0.05
+    )
+    candidate = np.concatenate(all_peaks)
+    return candidate, find_subsets(candidate, connection_all, special_k)
+
+
+def reference_body_pose(heatmap_avg, paf_avg, img_height):
+    thre1 = 0.1
+    thre2 = 0.05
+    all_peaks = []
+    peak_counter = 0
+
+    for part in range(18):
+        map_ori = heatmap_avg[:, :, part]
+        one_heatmap = gaussian_filter(map_ori, sigma=3)
+
+        map_left = np.zeros(one_heatmap.shape)
+        map_left[1:, :] = one_heatmap[:-1, :]
+        map_right = np.zeros(one_heatmap.shape)
+        map_right[:-1, :] = one_heatmap[1:, :]
+        map_up = np.zeros(one_heatmap.shape)
+        map_up[:, 1:] = one_heatmap[:, :-1]
+        map_down = np.zeros(one_heatmap.shape)
+        map_down[:, :-1] = one_heatmap[:, 1:]
+
+        peaks_binary = np.logical_and.reduce(
+            (
+                one_heatmap >= map_left,
+                one_heatmap >= map_right,
+                one_heatmap >= map_up,
+                one_heatmap >= map_down,
+                one_heatmap > thre1,
+            )
+        )
+        peaks = list(
+            zip(np.nonzero(peaks_binary)[1], np.nonzero(peaks_binary)[0])
+        )
+        peaks_with_score = [x + (map_ori[x[1], x[0]],) for x in peaks]
+        peak_id = range(peak_counter, peak_counter + len(peaks))
+        peaks_with_score_and_id = [
+            peaks_with_score[i] + (peak_id[i],) for i in range(len(peak_id))
+        ]
+        all_peaks.append(peaks_with_score_and_id)
+        peak_counter += len(peaks)
+
+    connection_all = []
+    special_k = []
+    mid_num = 10
+
+    for k in range(len(mapIdx)):
+        score_mid = paf_avg[:, :, [x - 19 for x in mapIdx[k]]]
+        candA = all_peaks[limbSeq[k][0] - 1]
+        candB = all_peaks[limbSeq[k][1] - 1]
+        nA = len(candA)
+        nB = len(candB)
+        if nA != 0 and nB != 0:
+            connection_candidate = []
+            for i in range(nA):
+                for j in range(nB):
+                    vec = np.subtract(candB[j][:2], candA[i][:2])
+                    norm = math.sqrt(vec[0] * vec[0] + vec[1] * vec[1])
+                    norm = max(0.001, norm)
+                    vec = np.divide(vec, norm)
+
+                    startend = list(
+                        zip(
+                            np.linspace(candA[i][0], candB[j][0], num=mid_num),
+                            np.linspace(candA[i][1], candB[j][1], num=mid_num),
+                        )
+                    )
+                    vec_x = np.array(
+                        [
+                            score_mid[int(round(y)), int(round(x)), 0]
+                            for x, y in startend
+                        ]
+                    )
+                    vec_y = np.array(
+                        [
+                            score_mid[int(round(y)), int(round(x)), 1]
+                            for x, y in startend
+                        ]
+                    )
+                    score_midpts = np.multiply(vec_x, vec[0]) + np.multiply(
+                        vec_y, vec[1]
+                    )
+                    score_with_dist_prior = sum(score_midpts) / len(
+                        score_midpts
+                    ) + min(0.5 * img_height / norm - 1, 0)
+                    criterion1 = len(
+                        np.nonzero(score_midpts > thre2)[0]
+                    ) > 0.8 * len(score_midpts)
+                    criterion2 = score_with_dist_prior > 0
+                    if criterion1 and criterion2:
+                        connection_candidate.append(
+                            [
+                                i,
+                                j,
+                                score_with_dist_prior,
+                                score_with_dist_prior
+                                + candA[i][2]
+                                + candB[j][2],
+                            ]
+                        )
+
+            connection_candidate = sorted(
+                connection_candidate, key=lambda x: x[2], reverse=True
+            )
+            connection = np.zeros((0, 5))
+            for c in range(len(connection_candidate)):
+                i, j, s = connection_candidate[c][0:3]
+                if i not in connection[:, 3] and j not in connection[:, 4]:
+                    connection = np.vstack(
+                        [connection, [candA[i][3], candB[j][3], s, i, j]]
+                    )
+                    if len(connection) >= min(nA, nB):
+                        break
+            connection_all.append(connection)
+        else:
+            special_k.append(k)
+            connection_all.append([])
+
+    subset = -1 * np.ones((0, 20))
+    candidate = np.array([item for sublist in all_peaks for item in sublist])
+
+    for k in range(len(mapIdx)):
+        if k not in special_k:
+            partAs = connection_all[k][:, 0]
+            partBs = connection_all[k][:, 1]
+            indexA, indexB = np.array(limbSeq[k]) - 1
+
+            for i in range(len(connection_all[k])):
+                found = 0
+                subset_idx = [-1, -1]
+                for j in range(len(subset)):
+                    if (
+                        subset[j][indexA] == partAs[i]
+                        or subset[j][indexB] == partBs[i]
+                    ):
+                        subset_idx[found] = j
+                        found += 1
+
+                if found == 1:
+                    j = subset_idx[0]
+                    if subset[j][indexB] != partBs[i]:
+                        subset[j][indexB] = partBs[i]
+                        subset[j][-1] += 1
+                        subset[j][-2] += (
+                            candidate[partBs[i].astype(int), 2]
+                            + connection_all[k][i][2]
+                        )
+                elif found == 2:
+                    j1, j2 = subset_idx
+                    membership = (
+                        (subset[j1] >= 0).astype(int)
+                        + (subset[j2] >= 0).astype(int)
+                    )[:-2]
+                    if len(np.nonzero(membership == 2)[0]) == 0:
+                        subset[j1][:-2] += subset[j2][:-2] + 1
+                        subset[j1][-2:] += subset[j2][-2:]
+                        subset[j1][-2] += connection_all[k][i][2]
+                        subset = np.delete(subset, j2, 0)
+                    else:
+                        subset[j1][indexB] = partBs[i]
+                        subset[j1][-1] += 1
+                        subset[j1][-2] += (
+                            candidate[partBs[i].astype(int), 2]
+                            + connection_all[k][i][2]
+                        )
+                elif not found and k < 17:
+                    row = -1 * np.ones(20)
+                    row[indexA] = partAs[i]
+                    row[indexB] = partBs[i]
+                    row[-1] = 2
+                    row[-2] = (
+                        sum(candidate[connection_all[k][i, :2].astype(int), 2])
+                        + connection_all[k][i][2]
+                    )
+                    subset = np.vstack([subset, row])
+    deleteIdx = []
+    for i in range(len(subset)):
+        if subset[i][-1] < 4 or subset[i][-2] / subset[i][-1] < 0.4:
+            deleteIdx.append(i)
+    subset = np.delete(subset, deleteIdx, axis=0)
+    return candidate, subset
+
+
+def synthetic_maps(num_people, height=368, width=496, seed=0):
+    """
+    Heatmaps and PAFs of `num_people` randomly placed skeletons, plus some
+    spurious peaks, as the body model would roughly produce them.
+    """
+    rng = np.random.default_rng(seed)
+    heatmap = np.zeros((height, width, 19))
+    paf = np.zeros((height, width, 38))
+    ys, xs = np.mgrid[0:height, 0:width]
+
+    for _ in range(num_people):
+        center = rng.uniform([40, 40], [width - 40, height - 40])
+        joints = center + rng.normal(0, 25, size=(18, 2))
+        joints = np.clip(joints, 0, [width - 1, height - 1])
+        for part, (x, y) in enumerate(joints):
+            blob = np.exp(-((xs - x) ** 2 + (ys - y) ** 2) / (2 * 4.0**2))
+            heatmap[:, :, part] = np.maximum(
+                heatmap[:, :, part], rng.uniform(0.5, 1.0) * blob
+            )
+        for k, (a, b) in enumerate(limbSeq):
+            start, end = joints[a - 1], joints[b - 1]
+            length = max(np.linalg.norm(end - start), 1e-3)
+            direction = (end - start) / length
+            rel_x, rel_y = xs - start[0], ys - start[1]
+            along = rel_x * direction[0] + rel_y * direction[1]
+            across = np.abs(rel_x * direction[1] - rel_y * direction[0])
+            on_limb = (along >= 0) & (along <= length) & (across <= 4)
+            for c, value in zip(mapIdx[k], direction):
+                paf[:, :, c - 19][on_limb] = value
+
+    for _ in range(num_people):
+        part = rng.integers(0, 18)
+        x, y = rng.uniform(0, width), rng.uniform(0, height)
+        blob = np.exp(-((xs - x) ** 2 + (ys - y) ** 2) / (2 * 4.0**2))
+        heatmap[:, :, part] += 0.3 * blob
+    paf += rng.normal(0, 0.02, size=paf.shape)
+    return heatmap, paf
+
+
+@pytest.mark.parametrize("num_people", [0, 1, 4, 12])
+def test_body_pose_matches_reference(num_people):
+    heatmap, paf = synthetic_maps(num_people, seed=num_people)
+    candidate, subset = body_pose(heatmap, paf, heatmap.shape[0])
+    ref_candidate, ref_subset = reference_body_pose(
+        heatmap, paf, heatmap.shape[0]
+    )
+    if num_people:
+        assert len(subset) > 0
+        np.testing.assert_array_equal(candidate, ref_candidate)
+    else:
+        assert len(candidate) == len(ref_candidate) == 0
+    np.testing.assert_array_equal(subset, ref_subset)
+
+
+def _time(fn, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the OpenPose body post-processing on the "
+        "maps of the given images, or on synthetic crowds without images."
+    )
+    parser.add_argument("images", nargs="*")
+    args = parser.parse_args()
+
+    maps = {}
+    if args.images:
+        import cv2
+        from apps.stable_diffusion.src.utils.stencils.openpose import (
+            OpenposeDetector,
+        )
+
+        body = OpenposeDetector().body_estimation
+        for path in args.images:
+            maps[path] = body.get_maps(cv2.imread(path))
+    else:
+        for num_people in [1, 4, 12, 24]:
+            maps[f"{num_people} people"] = synthetic_maps(num_people)
+
+    for name, (heatmap, paf) in maps.items():
+        ref_time = _time(reference_body_pose, heatmap, paf, heatmap.shape[0])
+        new_time = _time(body_pose, heatmap, paf, heatmap.shape[0])
+        print(
+            f"{name}: loops {1000 * ref_time:.1f}ms, "
+            f"vectorized {1000 * new_time:.1f}ms "
+            f"({ref_time / new_time:.1f}x)"
+        )
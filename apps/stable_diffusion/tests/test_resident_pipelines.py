@@ -0,0 +1,85 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ast
+import types
+
+import pytest
+
+from apps.stable_diffusion.web.utils import global_obj
+
+src = pytest.importorskip("apps.stable_diffusion.src")
+
+
+def fake_pipeline(tmp_path, name, size):
+    # A pipeline with one loaded module, of a vmfb of `size` bytes.
+    vmfb_path = tmp_path / f"{name}.vmfb"
+    vmfb_path.write_bytes(b"\0" * size)
+    unet = types.SimpleNamespace(
+        shark_runner=object(), vmfb_path=str(vmfb_path)
+    )
+    return types.SimpleNamespace(unet=unet)
+
+
+def load(tmp_path, name, size):
+    # What the UI does on switching to a config that is not resident.
+    global_obj.clear_cache()
+    if global_obj.use_resident(name):
+        return False
+    global_obj.set_cfg_obj(name)
+    global_obj.set_sd_obj(fake_pipeline(tmp_path, name, size))
+    return True
+
+
+def resident():
+    keys = global_obj.get_residency_stats()["resident"]
+    return [ast.literal_eval(key) for key in keys]
+
+
+@pytest.fixture
+def residency(monkeypatch):
+    monkeypatch.setattr(src.args, "max_resident_pipelines", 3)
+    monkeypatch.setattr(src.args, "resident_pipelines_max_gb", None)
+    global_obj._init()
+    yield src.args
+    global_obj._init()
+
+
+def test_evicts_least_recently_used(tmp_path, residency):
+    assert load(tmp_path, "a", 100)
+    assert load(tmp_path, "b", 100)
+    # Switching back to "a" makes "b" the least recently used.
+    assert not load(tmp_path, "a", 100)
+    assert resident() == ["b"]
+    assert load(tmp_path, "c", 100)
+    assert resident() == ["b", "a"]
+    assert load(tmp_path, "d", 100)
+    assert resident() == ["a", "c"]
+    assert global_obj.get_residency_stats()["evictions"] == 1
+
+
+def test_budget_includes_incoming_pipeline(tmp_path, residency):
+    residency.resident_pipelines_max_gb = 250 / (1 << 30)
+    assert load(tmp_path, "a", 100)
+    assert load(tmp_path, "b", 100)
+    assert resident() == ["a"]
+    # "a" and "b" fit, but not together with another pipeline as large.
+    assert load(tmp_path, "c", 100)
+    assert resident() == ["b"]
+
+    # A pipeline larger than estimated is checked again once loaded.
+    residency.resident_pipelines_max_gb = 350 / (1 << 30)
+    assert load(tmp_path, "d", 300)
+    assert resident() == []
+    assert global_obj.get_residency_stats()["resident_bytes"] == 300
@@ -0,0 +1,205 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+utils = pytest.importorskip("apps.stable_diffusion.src.utils.utils")
+
+
+class Block(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.to_q = torch.nn.Linear(4, 4, bias=False)
+        self.proj_in = torch.nn.Conv2d(4, 4, 1)
+        self.conv_out = torch.nn.Conv2d(4, 4, 3)
+
+
+class TinyUnet(torch.nn.Module):
+    # Module names containing "_", as in the diffusers unet.
+    def __init__(self):
+        super().__init__()
+        self.down_blocks = torch.nn.ModuleList([Block(), Block()])
+
+
+def lora_state_dict(seed, rank=2):
+    generator = torch.Generator().manual_seed(seed)
+
+    def randn(*shape):
+        return torch.randn(*shape, generator=generator)
+
+    state_dict = {}
+    for i in range(2):
+        prefix = f"lora_unet_down_blocks_{i}_"
+        state_dict[prefix + "to_q.lora_down.weight"] = randn(rank, 4)
+        state_dict[prefix + "to_q.lora_up.weight"] = randn(4, rank)
+        state_dict[prefix + "to_q.alpha"] = torch.tensor(float(rank))
+        state_dict[prefix + "proj_in.lora_up.weight"] = randn(4, rank, 1, 1)
+        state_dict[prefix + "proj_in.lora_down.weight"] = randn(rank, 4, 1, 1)
+    # Keys of the text encoder are not for the unet.
+    state_dict["lora_te_text_model_fc1.lora_down.weight"] = randn(rank, 4)
+    state_dict["lora_te_text_model_fc1.lora_up.weight"] = randn(4, rank)
+    return state_dict
+
+
+def save_lora(tmp_path, seed):
+    path = tmp_path / f"lora_{seed}.pt"
+    torch.save(lora_state_dict(seed), path)
+    return str(path)
+
+
+def module_names(model):
+    return {name for name, _ in model.named_modules()}
+
+
+def test_resolve_lora_layer():
+    names = module_names(TinyUnet())
+    layer_infos = "down_blocks_1_proj_in".split("_")
+    assert utils._resolve_lora_layer(layer_infos, names) == (
+        "down_blocks.1.proj_in"
+    )
+
+
+def test_get_lora_deltas():
+    model = TinyUnet()
+    state_dict = lora_state_dict(0)
+    deltas = utils.get_lora_deltas(
+        state_dict, module_names(model), "lora_unet_", 0.5
+    )
+    assert sorted(deltas) == [
+        f"down_blocks.{i}.{layer}.weight"
+        for i in range(2)
+        for layer in ("proj_in", "to_q")
+    ]
+    params = dict(model.named_parameters())
+    for name, delta in deltas.items():
+        assert delta.shape == params[name].shape
+    prefix = "lora_unet_down_blocks_0_to_q"
+    expected = 0.5 * torch.mm(
+        state_dict[prefix + ".lora_up.weight"],
+        state_dict[prefix + ".lora_down.weight"],
+    )
+    assert torch.allclose(deltas["down_blocks.0.to_q.weight"], expected)
+
+
+def test_process_lora_matches_merge(tmp_path):
+    model = TinyUnet()
+    base = copy.deepcopy(model)
+    lora = save_lora(tmp_path, 0)
+    utils.processLoRA(model, lora, "lora_unet_")
+
+    state_dict = lora_state_dict(0)
+    params = dict(model.named_parameters())
+    for name, param in base.named_parameters():
+        layer = "lora_unet_" + name.rsplit(".", 1)[0].replace(".", "_")
+        up = state_dict.get(layer + ".lora_up.weight")
+        if up is None or not name.endswith(".weight"):
+            assert torch.equal(params[name], param)
+            continue
+        down = state_dict[layer + ".lora_down.weight"]
+        delta = torch.mm(up.flatten(1), down.flatten(1)).reshape(param.shape)
+        assert torch.allclose(params[name], param + 0.75 * delta)
+
+
+class FakeSharkModule:
+    def __call__(self, function_name, inputs, send_to_host=True):
+        return inputs
+
+
+@pytest.fixture
+def runtime_lora(monkeypatch):
+    uploads = []
+
+    def upload(self, weights):
+        uploads.append(sorted(weights))
+        return {
+            name: weight.to(self.dtype).clone()
+            for name, weight in weights.items()
+        }
+
+    monkeypatch.setattr(utils.RuntimeLoraModule, "_upload", upload)
+    monkeypatch.setattr(utils.args, "lora_weight_cache_size", 2)
+    model = TinyUnet()
+    params = dict(model.named_parameters())
+    base_weights = {
+        name: params[name].detach().clone()
+        for name in utils.get_lora_target_params(model, "down_blocks")
+    }
+    module = utils.RuntimeLoraModule(
+        FakeSharkModule(),
+        base_weights,
+        module_names(model),
+        "lora_unet_",
+        torch.float32,
+    )
+    uploads.clear()
+    return model, module, uploads
+
+
+def test_runtime_lora_matches_process_lora(tmp_path, runtime_lora):
+    model, module, uploads = runtime_lora
+    lora = save_lora(tmp_path, 0)
+    module.set_loras(lora)
+    utils.processLoRA(model, lora, "lora_unet_")
+
+    params = dict(model.named_parameters())
+    inputs = module("forward", ("x",))
+    assert inputs[0] == "x"
+    assert len(inputs) == 1 + len(module.param_names)
+    for name, weight in zip(module.param_names, inputs[1:]):
+        assert torch.allclose(weight, params[name])
+
+
+def test_set_loras_keys(tmp_path, runtime_lora):
+    _, module, uploads = runtime_lora
+    base = list(module.device_weights)
+    lora = save_lora(tmp_path, 0)
+    module.set_loras(lora)
+    assert module.lora_key == ((lora, 0.75),)
+    # Merging leaves the base weights as they were.
+    assert all(
+        torch.equal(module.base_weights[name], base_weight)
+        for name, base_weight in zip(module.param_names, base)
+    )
+    # The same LoRAs given another way are not merged again.
+    module.set_loras([(lora, 0.75)])
+    module.set_loras([lora])
+    assert len(uploads) == 1
+
+    for no_loras in ("", []):
+        module.set_loras(lora)
+        module.set_loras(no_loras)
+        assert module.lora_key == ()
+        assert all(
+            weight is base_weight
+            for weight, base_weight in zip(module.device_weights, base)
+        )
+    assert len(uploads) == 1
+
+
+def test_set_loras_evicts_least_recently_used(tmp_path, runtime_lora):
+    _, module, uploads = runtime_lora
+    a, b, c = (save_lora(tmp_path, seed) for seed in range(3))
+    module.set_loras(a)
+    module.set_loras(b)
+    # Switching back to "a" makes "b" the least recently used.
+    module.set_loras(a)
+    assert len(uploads) == 2
+    module.set_loras(c)
+    assert list(module.merged_cache) == [((a, 0.75),), ((c, 0.75),)]
+    module.set_loras(b)
+    assert len(uploads) == 4
+    assert list(module.merged_cache) == [((c, 0.75),), ((b, 0.75),)]
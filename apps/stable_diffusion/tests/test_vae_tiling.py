@@ -0,0 +1,131 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Checks that tiled VAE decoding and encoding match running the whole image
+# through stand-in VAEs: exactly for pixel-wise ones, and closely for ones
+# that, like the real VAE, look at a neighbourhood of every pixel.
+
+import numpy as np
+import pytest
+
+from apps.stable_diffusion.src.utils.vae_tiling import (
+    check_tile_args,
+    needs_tiling,
+    tile_starts,
+    tiled_decode,
+    tiled_encode,
+)
+
+
+def upsample(x):
+    return x.repeat(8, axis=-2).repeat(8, axis=-1)
+
+
+def downsample(x):
+    n, c, h, w = x.shape
+    return x.reshape(n, c, h // 8, 8, w // 8, 8).mean(axis=(3, 5))
+
+
+def blur(x, radius=2):
+    # A box filter with zero padding, whose result at the borders of a tile
+    # differs from the one on the whole image.
+    size = 2 * radius + 1
+    padded = np.pad(x, ((0, 0), (0, 0), (radius, radius), (radius, radius)))
+    out = np.zeros_like(x)
+    for dy in range(size):
+        for dx in range(size):
+            out += padded[:, :, dy : dy + x.shape[-2], dx : dx + x.shape[-1]]
+    return out / size**2
+
+
+def fake_decode(latents):
+    # 4 latent channels to 3 image channels, like the VAE decoder.
+    return upsample(np.tanh(latents[:, :3] + 0.5 * latents[:, 3:]))
+
+
+def smooth_latents(shape, seed=0):
+    # Latents of real images are spatially correlated, not white noise.
+    rng = np.random.default_rng(seed)
+    latents = rng.standard_normal(shape).astype(np.float32)
+    for _ in range(3):
+        latents = blur(latents)
+    return latents / latents.std()
+
+
+@pytest.mark.parametrize("size", [96, 100, 130, 160])
+def test_tile_starts_cover(size):
+    tile, overlap = 64, 8
+    starts = tile_starts(size, tile, overlap, align=2)
+    assert starts[0] == 0 and starts[-1] == size - tile
+    assert all(start % 2 == 0 for start in starts)
+    for a, b in zip(starts, starts[1:]):
+        assert a + tile - b >= overlap - 2
+
+
+@pytest.mark.parametrize("tile, overlap", [(512, 64), (128, 0), (136, 128)])
+def test_check_tile_args_accepts(tile, overlap):
+    check_tile_args(tile, overlap)
+
+
+@pytest.mark.parametrize(
+    "tile, overlap",
+    [(120, 64), (516, 64), (512, 60), (512, 512), (512, 600), (512, -8)],
+)
+def test_check_tile_args_rejects(tile, overlap):
+    with pytest.raises(ValueError):
+        check_tile_args(tile, overlap)
+
+
+def test_needs_tiling():
+    assert not needs_tiling(512, 512, 512)
+    assert needs_tiling(512, 768, 512)
+
+
+@pytest.mark.parametrize("shape", [(1, 4, 128, 96), (2, 4, 40, 150)])
+def test_decode_pixelwise_is_exact(shape):
+    latents = smooth_latents(shape)
+    tiled = tiled_decode(fake_decode, latents, 64, 8)
+    np.testing.assert_allclose(tiled, fake_decode(latents), atol=1e-5)
+
+
+def test_decode_neighbourhood_is_close():
+    latents = smooth_latents((1, 4, 160, 128))
+
+    def decode(x):
+        return blur(fake_decode(x), radius=4)
+
+    full = decode(latents)
+    tiled = tiled_decode(decode, latents, 64, 8)
+    assert tiled.shape == full.shape
+    # Tiles differ from the whole image within 4 pixels of their borders,
+    # the blending keeps that to a fraction of the 0..2 range.
+    error = np.abs(tiled - full)
+    assert error.mean() < 1e-3
+    assert error.max() < 0.1
+
+    # Hard seams, without blending, are far worse.
+    seams = tiled_decode(decode, latents, 64, 0)
+    assert np.abs(seams - full).mean() > 2 * error.mean()
+
+
+def test_encode_matches_whole_image():
+    rng = np.random.default_rng(1)
+    image = rng.uniform(-1, 1, (1, 3, 768, 1024)).astype(np.float32)
+
+    def encode(x):
+        return 0.18215 * downsample(x)
+
+    tiled = tiled_encode(encode, image, 512, 64)
+    assert tiled.shape == (1, 3, 96, 128)
+    np.testing.assert_allclose(tiled, encode(image), atol=1e-6)
@@ -0,0 +1,88 @@
+import threading
+import time
+
+from concurrent.futures import Future
+
+
+class _PendingItem:
+    def __init__(self, key, item):
+        self.key = key
+        self.item = item
+        self.future = Future()
+        self.enqueued = time.monotonic()
+
+
+class RequestBatcher:
+    """
+    Collects items submitted concurrently by api handlers and runs the ones
+    that share a batch key through a single `run_batch(key, items)` call,
+    which must return one result per item.
+
+    A batch is dispatched as soon as `max_batch_size` items with the key of
+    the oldest pending item are queued, or once that item has waited
+    `max_wait_ms`. Items with other keys stay queued, in order, for the
+    following batches. Batches run one at a time on a worker thread, as
+    there is only one pipeline to run them on.
+    """
+
+    def __init__(self, run_batch, max_batch_size: int, max_wait_ms: float):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.batches_run = 0
+        self.items_run = 0
+        self._queue = []
+        self._cond = threading.Condition()
+        self._worker = None
+
+    def submit(self, key, items: list):
+        """Queues `items` under `key` and returns one future per item."""
+        pending = [_PendingItem(key, item) for item in items]
+        with self._cond:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="sdapi_batcher", daemon=True
+                )
+                self._worker.start()
+            self._queue.extend(pending)
+            self._cond.notify()
+        return [p.future for p in pending]
+
+    def run(self, key, items: list):
+        """Blocking variant of `submit`, returns the results in order."""
+        return [future.result() for future in self.submit(key, items)]
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            key = self._queue[0].key
+            deadline = self._queue[0].enqueued + self.max_wait
+            while True:
+                batch = [p for p in self._queue if p.key == key]
+                batch = batch[: self.max_batch_size]
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            for p in batch:
+                self._queue.remove(p)
+        return key, batch
+
+    def _run(self):
+        while True:
+            key, batch = self._next_batch()
+            try:
+                results = self.run_batch(key, [p.item for p in batch])
+            except Exception as e:
+                for p in batch:
+                    p.future.set_exception(e)
+                continue
+            self.batches_run += 1
+            self.items_run += len(batch)
+            for p, result in zip(batch, results):
+                p.future.set_result(result)
+            for p in batch[len(results) :]:
+                p.future.set_exception(
+                    RuntimeError("Batch finished without a result.")
+                )
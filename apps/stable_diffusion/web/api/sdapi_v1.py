@@ -5,6 +5,7 @@ from enum import Enum
 from fastapi import FastAPI
 from pydantic import BaseModel, Field, conlist, model_validator
 
+from apps.stable_diffusion.web.api.batching import RequestBatcher
 from apps.stable_diffusion.web.api.utils import (
     frozen_args,
     sampler_aliases,
@@ -31,6 +32,7 @@ from apps.stable_diffusion.web.ui.img2img_ui import img2img_inf
 from apps.stable_diffusion.web.ui.inpaint_ui import inpaint_inf
 from apps.stable_diffusion.web.ui.outpaint_ui import outpaint_inf
 from apps.stable_diffusion.web.ui.upscaler_ui import upscaler_inf
+from apps.stable_diffusion.src.utils import batch_seeds
 
 sdapi = FastAPI()
 
@@ -149,6 +151,21 @@ def cmd_flags_api():
     return vars(frozen_args)
 
 
+# Rest API: /sdapi/v1/resident-models (lists loaded pipelines)
+@sdapi.get(
+    "/v1/resident-models",
+    summary="lists the pipelines currently kept loaded",
+    description=(
+        "Pipelines parked in the residency pool along with hit, miss and "
+        "eviction counts. The active pipeline is not listed."
+    ),
+)
+def resident_models_api():
+    import apps.stable_diffusion.web.utils.global_obj as global_obj
+
+    return global_obj.get_residency_stats()
+
+
 # Rest API: /sdapi/v1/txt2img (Text to image)
 class ModelOverrideSettings(BaseModel):
     sd_model_checkpoint: str = get_model_from_request(
@@ -165,6 +182,58 @@ class Txt2ImgInputData(GenerationInputData):
         default=frozen_args.hiresfix_width, ge=128, le=768, multiple_of=8
     )
     override_settings: ModelOverrideSettings = None
+    batch_size: int = Field(default=1, ge=1)
+
+
+def txt2img_batch(batch_key, items):
+    # Runs (prompt, negative_prompt, seed) items that share a batch key as a
+    # single txt2img batch, padded to --api_max_batch_size.
+    (model_id, height, width, steps, cfg_scale, scheduler) = batch_key
+    (lora_weights, lora_hf_id) = get_lora_params(frozen_args.use_lora)
+    seeds = [seed for _, _, seed in items]
+
+    res = txt2img_inf(
+        [prompt for prompt, _, _ in items],
+        [negative_prompt for _, negative_prompt, _ in items],
+        height,
+        width,
+        steps,
+        cfg_scale,
+        seeds[0],
+        batch_count=1,
+        batch_size=frozen_args.api_max_batch_size,
+        scheduler=scheduler,
+        model_id=model_id,
+        custom_vae=frozen_args.custom_vae or "None",
+        precision="fp16",
+        device=get_device(frozen_args.device),
+        max_length=frozen_args.max_length,
+        save_metadata_to_json=frozen_args.save_metadata_to_json,
+        save_metadata_to_png=frozen_args.write_metadata_to_png,
+        lora_weights=lora_weights,
+        lora_hf_id=lora_hf_id,
+        ondemand=frozen_args.ondemand,
+        repeatable_seeds=False,
+        use_hiresfix=False,
+        hiresfix_height=frozen_args.hiresfix_height,
+        hiresfix_width=frozen_args.hiresfix_width,
+        hiresfix_strength=frozen_args.hiresfix_strength,
+        resample_type=frozen_args.resample_type,
+        per_image_seeds=seeds,
+    )
+
+    # Since we're not streaming we just want the last generator result
+    for items_so_far in res:
+        batch_items = items_so_far
+
+    return batch_items[0]
+
+
+txt2img_batcher = RequestBatcher(
+    txt2img_batch,
+    frozen_args.api_max_batch_size,
+    frozen_args.api_max_batch_wait_ms,
+)
 
 
 @sdapi.post(
@@ -190,6 +259,42 @@ def txt2img_api(InputData: Txt2ImgInputData):
         f"Scheduler: {scheduler}. "
     )
 
+    # Hires fix swaps in an img2img pipeline mid-request, so those requests
+    # are not batched with others.
+    if frozen_args.api_max_batch_size > 1 and not InputData.enable_hr:
+        # Every image of every iteration is its own item of the batches.
+        seeds = batch_seeds(
+            InputData.seed, InputData.n_iter * InputData.batch_size
+        )
+        batch_key = (
+            model_id,
+            InputData.height,
+            InputData.width,
+            InputData.steps,
+            InputData.cfg_scale,
+            scheduler,
+        )
+        images = txt2img_batcher.run(
+            batch_key,
+            [
+                (InputData.prompt, InputData.negative_prompt, seed)
+                for seed in seeds
+            ],
+        )
+        return {
+            "images": encode_pil_to_base64(images),
+            "parameters": InputData.model_dump(),
+            "info": (
+                f"prompt={InputData.prompt}\n"
+                f"negative prompt={InputData.negative_prompt}\n"
+                f"model_id={model_id}\n"
+                f"scheduler={scheduler}\n"
+                f"steps={InputData.steps}, "
+                f"guidance_scale={InputData.cfg_scale}, seed={seeds}\n"
+                f"size={InputData.height}x{InputData.width}"
+            ),
+        }
+
     res = txt2img_inf(
         InputData.prompt,
         InputData.negative_prompt,
@@ -199,7 +304,7 @@ def txt2img_api(InputData: Txt2ImgInputData):
         InputData.cfg_scale,
         InputData.seed,
         batch_count=InputData.n_iter,
-        batch_size=1,
+        batch_size=InputData.batch_size,
         scheduler=scheduler,
         model_id=model_id,
         custom_vae=frozen_args.custom_vae or "None",
@@ -225,7 +330,7 @@ def txt2img_api(InputData: Txt2ImgInputData):
 
     return {
         "images": encode_pil_to_base64(items[0]),
-        "parameters": {},
+        "parameters": InputData.model_dump(),
         "info": items[1],
     }
 
@@ -102,7 +102,7 @@ class GenerationInputData(BaseModel):
 
 class GenerationResponseData(BaseModel):
     images: list[str] = Field(description="Generated images, Base64 encoded")
-    properties: dict = {}
+    parameters: dict = {}
     info: str
 
 
@@ -31,6 +31,7 @@ from apps.stable_diffusion.src import (
     set_init_device_flags,
     utils,
     save_output_img,
+    get_img_save_info,
 )
 from apps.stable_diffusion.src.utils import (
     get_generated_imgs_path,
@@ -192,64 +193,66 @@ def img2img_inf(
         args.use_tuned = init_use_tuned
         args.import_mlir = init_import_mlir
         set_init_device_flags()
-        model_id = (
-            args.hf_model_id
-            if args.hf_model_id
-            else "stabilityai/stable-diffusion-1-5-base"
-        )
-        global_obj.set_schedulers(get_schedulers(model_id))
-        scheduler_obj = global_obj.get_scheduler(args.scheduler)
-
-        if stencil_count > 0:
-            args.use_tuned = False
-            global_obj.set_sd_obj(
-                StencilPipeline.from_pretrained(
-                    scheduler_obj,
-                    args.import_mlir,
-                    args.hf_model_id,
-                    args.ckpt_loc,
-                    args.custom_vae,
-                    args.precision,
-                    args.max_length,
-                    args.batch_size,
-                    args.height,
-                    args.width,
-                    args.use_base_vae,
-                    args.use_tuned,
-                    low_cpu_mem_usage=args.low_cpu_mem_usage,
-                    stencils=stencils,
-                    debug=args.import_debug if args.import_mlir else False,
-                    use_lora=args.use_lora,
-                    ondemand=args.ondemand,
-                )
+        if not global_obj.use_resident(new_config_obj):
+            model_id = (
+                args.hf_model_id
+                if args.hf_model_id
+                else "stabilityai/stable-diffusion-1-5-base"
             )
-        else:
-            global_obj.set_sd_obj(
-                Image2ImagePipeline.from_pretrained(
-                    scheduler_obj,
-                    args.import_mlir,
-                    args.hf_model_id,
-                    args.ckpt_loc,
-                    args.custom_vae,
-                    args.precision,
-                    args.max_length,
-                    args.batch_size,
-                    args.height,
-                    args.width,
-                    args.use_base_vae,
-                    args.use_tuned,
-                    low_cpu_mem_usage=args.low_cpu_mem_usage,
-                    debug=args.import_debug if args.import_mlir else False,
-                    use_lora=args.use_lora,
-                    ondemand=args.ondemand,
+            global_obj.set_schedulers(get_schedulers(model_id))
+            scheduler_obj = global_obj.get_scheduler(args.scheduler)
+
+            if stencil_count > 0:
+                args.use_tuned = False
+                global_obj.set_sd_obj(
+                    StencilPipeline.from_pretrained(
+                        scheduler_obj,
+                        args.import_mlir,
+                        args.hf_model_id,
+                        args.ckpt_loc,
+                        args.custom_vae,
+                        args.precision,
+                        args.max_length,
+                        args.batch_size,
+                        args.height,
+                        args.width,
+                        args.use_base_vae,
+                        args.use_tuned,
+                        low_cpu_mem_usage=args.low_cpu_mem_usage,
+                        stencils=stencils,
+                        debug=args.import_debug if args.import_mlir else False,
+                        use_lora=args.use_lora,
+                        ondemand=args.ondemand,
+                    )
+                )
+            else:
+                global_obj.set_sd_obj(
+                    Image2ImagePipeline.from_pretrained(
+                        scheduler_obj,
+                        args.import_mlir,
+                        args.hf_model_id,
+                        args.ckpt_loc,
+                        args.custom_vae,
+                        args.precision,
+                        args.max_length,
+                        args.batch_size,
+                        args.height,
+                        args.width,
+                        args.use_base_vae,
+                        args.use_tuned,
+                        low_cpu_mem_usage=args.low_cpu_mem_usage,
+                        debug=args.import_debug if args.import_mlir else False,
+                        use_lora=args.use_lora,
+                        ondemand=args.ondemand,
+                    )
                 )
-            )
 
     global_obj.set_sd_scheduler(args.scheduler)
 
     start_time = time.time()
     global_obj.get_sd_obj().log = ""
     generated_imgs = []
+    saves = []
     extra_info = {"STRENGTH": strength}
     text_output = ""
     try:
@@ -289,11 +292,14 @@ def img2img_inf(
         if global_obj.get_sd_status() == SD_STATE_CANCEL:
             break
         else:
-            save_output_img(
-                out_imgs[0],
-                seeds[current_batch],
-                extra_info,
+            saves.append(
+                save_output_img(
+                    out_imgs[0],
+                    seeds[current_batch],
+                    extra_info,
+                )
             )
+            text_output += get_img_save_info(saves)
             generated_imgs.extend(out_imgs)
             yield generated_imgs, text_output, status_label(
                 "Image-to-Image", current_batch + 1, batch_count, batch_size
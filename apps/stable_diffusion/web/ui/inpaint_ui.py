@@ -23,6 +23,7 @@ from apps.stable_diffusion.src import (
     utils,
     clear_all,
     save_output_img,
+    get_img_save_info,
 )
 from apps.stable_diffusion.src.utils import (
     get_generated_imgs_path,
@@ -142,39 +143,41 @@ def inpaint_inf(
         args.use_tuned = init_use_tuned
         args.import_mlir = init_import_mlir
         set_init_device_flags()
-        model_id = (
-            args.hf_model_id
-            if args.hf_model_id
-            else "stabilityai/stable-diffusion-2-inpainting"
-        )
-        global_obj.set_schedulers(get_schedulers(model_id))
-        scheduler_obj = global_obj.get_scheduler(scheduler)
-        global_obj.set_sd_obj(
-            InpaintPipeline.from_pretrained(
-                scheduler=scheduler_obj,
-                import_mlir=args.import_mlir,
-                model_id=args.hf_model_id,
-                ckpt_loc=args.ckpt_loc,
-                custom_vae=args.custom_vae,
-                precision=args.precision,
-                max_length=args.max_length,
-                batch_size=args.batch_size,
-                height=args.height,
-                width=args.width,
-                use_base_vae=args.use_base_vae,
-                use_tuned=args.use_tuned,
-                low_cpu_mem_usage=args.low_cpu_mem_usage,
-                debug=args.import_debug if args.import_mlir else False,
-                use_lora=args.use_lora,
-                ondemand=args.ondemand,
+        if not global_obj.use_resident(new_config_obj):
+            model_id = (
+                args.hf_model_id
+                if args.hf_model_id
+                else "stabilityai/stable-diffusion-2-inpainting"
+            )
+            global_obj.set_schedulers(get_schedulers(model_id))
+            scheduler_obj = global_obj.get_scheduler(scheduler)
+            global_obj.set_sd_obj(
+                InpaintPipeline.from_pretrained(
+                    scheduler=scheduler_obj,
+                    import_mlir=args.import_mlir,
+                    model_id=args.hf_model_id,
+                    ckpt_loc=args.ckpt_loc,
+                    custom_vae=args.custom_vae,
+                    precision=args.precision,
+                    max_length=args.max_length,
+                    batch_size=args.batch_size,
+                    height=args.height,
+                    width=args.width,
+                    use_base_vae=args.use_base_vae,
+                    use_tuned=args.use_tuned,
+                    low_cpu_mem_usage=args.low_cpu_mem_usage,
+                    debug=args.import_debug if args.import_mlir else False,
+                    use_lora=args.use_lora,
+                    ondemand=args.ondemand,
+                )
             )
-        )
 
     global_obj.set_sd_scheduler(scheduler)
 
     start_time = time.time()
     global_obj.get_sd_obj().log = ""
     generated_imgs = []
+    saves = []
     image = image_dict["image"]
     mask_image = image_dict["mask"]
     text_output = ""
@@ -213,7 +216,8 @@ def inpaint_inf(
         if global_obj.get_sd_status() == SD_STATE_CANCEL:
             break
         else:
-            save_output_img(out_imgs[0], seeds[current_batch])
+            saves.append(save_output_img(out_imgs[0], seeds[current_batch]))
+            text_output += get_img_save_info(saves)
             generated_imgs.extend(out_imgs)
             yield generated_imgs, text_output, status_label(
                 "Inpaint", current_batch + 1, batch_count, batch_size
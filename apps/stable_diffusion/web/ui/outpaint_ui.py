@@ -21,6 +21,7 @@ from apps.stable_diffusion.src import (
     set_init_device_flags,
     utils,
     save_output_img,
+    get_img_save_info,
 )
 from apps.stable_diffusion.src.utils import (
     get_generated_imgs_path,
@@ -141,37 +142,39 @@ def outpaint_inf(
         args.use_tuned = init_use_tuned
         args.import_mlir = init_import_mlir
         set_init_device_flags()
-        model_id = (
-            args.hf_model_id
-            if args.hf_model_id
-            else "stabilityai/stable-diffusion-2-inpainting"
-        )
-        global_obj.set_schedulers(get_schedulers(model_id))
-        scheduler_obj = global_obj.get_scheduler(scheduler)
-        global_obj.set_sd_obj(
-            OutpaintPipeline.from_pretrained(
-                scheduler_obj,
-                args.import_mlir,
-                args.hf_model_id,
-                args.ckpt_loc,
-                args.custom_vae,
-                args.precision,
-                args.max_length,
-                args.batch_size,
-                args.height,
-                args.width,
-                args.use_base_vae,
-                args.use_tuned,
-                use_lora=args.use_lora,
-                ondemand=args.ondemand,
+        if not global_obj.use_resident(new_config_obj):
+            model_id = (
+                args.hf_model_id
+                if args.hf_model_id
+                else "stabilityai/stable-diffusion-2-inpainting"
+            )
+            global_obj.set_schedulers(get_schedulers(model_id))
+            scheduler_obj = global_obj.get_scheduler(scheduler)
+            global_obj.set_sd_obj(
+                OutpaintPipeline.from_pretrained(
+                    scheduler_obj,
+                    args.import_mlir,
+                    args.hf_model_id,
+                    args.ckpt_loc,
+                    args.custom_vae,
+                    args.precision,
+                    args.max_length,
+                    args.batch_size,
+                    args.height,
+                    args.width,
+                    args.use_base_vae,
+                    args.use_tuned,
+                    use_lora=args.use_lora,
+                    ondemand=args.ondemand,
+                )
             )
-        )
 
     global_obj.set_sd_scheduler(scheduler)
 
     start_time = time.time()
     global_obj.get_sd_obj().log = ""
     generated_imgs = []
+    saves = []
     try:
         seeds = utils.batch_seeds(seed, batch_count, repeatable_seeds)
     except TypeError as error:
@@ -218,7 +221,8 @@ def outpaint_inf(
         if global_obj.get_sd_status() == SD_STATE_CANCEL:
             break
         else:
-            save_output_img(out_imgs[0], seeds[current_batch])
+            saves.append(save_output_img(out_imgs[0], seeds[current_batch]))
+            text_output += get_img_save_info(saves)
             generated_imgs.extend(out_imgs)
             yield generated_imgs, text_output, status_label(
                 "Outpaint", current_batch + 1, batch_count, batch_size
@@ -149,6 +149,7 @@ def chat(
     config_file,
     cli=False,
     progress=gr.Progress(),
+    request: gr.Request = None,
 ):
     global past_key_values
     global model_vmfb_key
@@ -249,12 +250,17 @@ def chat(
                 load_mlir_from_shark_tank=True,
                 extra_args_cmd=_extra_args,
                 device_id=device_id,
+                prefix_cache_gb=args.chat_prefix_cache_gb,
             )
 
     if vicuna_model is None:
         sys.exit("Unable to instantiate the model object, exiting.")
 
     prompt = create_prompt(model_name, history, prompt_prefix)
+    generate_kwargs = {}
+    if not sharded and request is not None:
+        # Every browser session keeps the kv cache of its conversation.
+        generate_kwargs["session_id"] = request.session_hash
 
     partial_text = ""
     token_count = 0
@@ -265,7 +271,9 @@ def chat(
     #    vicuna_model.generate(prompt, cli=cli),
     #    desc="generating response",
     # ):
-    for text, msg, exec_time in vicuna_model.generate(prompt, cli=cli):
+    for text, msg, exec_time in vicuna_model.generate(
+        prompt, cli=cli, **generate_kwargs
+    ):
         if msg is None:
             if is_first:
                 prefill_time = exec_time / 1000
@@ -25,6 +25,7 @@ from apps.stable_diffusion.src import (
     set_init_device_flags,
     utils,
     save_output_img,
+    get_img_save_info,
     prompt_examples,
     Image2ImagePipeline,
 )
@@ -145,42 +146,44 @@ def txt2img_sdxl_inf(
         args.import_mlir = init_import_mlir
         args.img_path = None
         set_init_device_flags()
-        model_id = (
-            args.hf_model_id
-            if args.hf_model_id
-            else "stabilityai/stable-diffusion-xl-base-1.0"
-        )
-        global_obj.set_schedulers(get_schedulers(model_id))
-        scheduler_obj = global_obj.get_scheduler(scheduler)
-        if global_obj.get_cfg_obj().ondemand:
-            print("Running txt2img in memory efficient mode.")
-        global_obj.set_sd_obj(
-            Text2ImageSDXLPipeline.from_pretrained(
-                scheduler=scheduler_obj,
-                import_mlir=args.import_mlir,
-                model_id=args.hf_model_id,
-                ckpt_loc=args.ckpt_loc,
-                precision=precision,
-                max_length=max_length,
-                batch_size=batch_size,
-                height=height,
-                width=width,
-                use_base_vae=args.use_base_vae,
-                use_tuned=args.use_tuned,
-                custom_vae=args.custom_vae,
-                low_cpu_mem_usage=args.low_cpu_mem_usage,
-                debug=args.import_debug if args.import_mlir else False,
-                use_lora=args.use_lora,
-                use_quantize=args.use_quantize,
-                ondemand=global_obj.get_cfg_obj().ondemand,
+        if not global_obj.use_resident(new_config_obj):
+            model_id = (
+                args.hf_model_id
+                if args.hf_model_id
+                else "stabilityai/stable-diffusion-xl-base-1.0"
+            )
+            global_obj.set_schedulers(get_schedulers(model_id))
+            scheduler_obj = global_obj.get_scheduler(scheduler)
+            if global_obj.get_cfg_obj().ondemand:
+                print("Running txt2img in memory efficient mode.")
+            global_obj.set_sd_obj(
+                Text2ImageSDXLPipeline.from_pretrained(
+                    scheduler=scheduler_obj,
+                    import_mlir=args.import_mlir,
+                    model_id=args.hf_model_id,
+                    ckpt_loc=args.ckpt_loc,
+                    precision=precision,
+                    max_length=max_length,
+                    batch_size=batch_size,
+                    height=height,
+                    width=width,
+                    use_base_vae=args.use_base_vae,
+                    use_tuned=args.use_tuned,
+                    custom_vae=args.custom_vae,
+                    low_cpu_mem_usage=args.low_cpu_mem_usage,
+                    debug=args.import_debug if args.import_mlir else False,
+                    use_lora=args.use_lora,
+                    use_quantize=args.use_quantize,
+                    ondemand=global_obj.get_cfg_obj().ondemand,
+                )
             )
-        )
 
     global_obj.set_sd_scheduler(scheduler)
 
     start_time = time.time()
     global_obj.get_sd_obj().log = ""
     generated_imgs = []
+    saves = []
     text_output = ""
     try:
         seeds = utils.batch_seeds(seed, batch_count, repeatable_seeds)
@@ -214,7 +217,8 @@ def txt2img_sdxl_inf(
         if global_obj.get_sd_status() == SD_STATE_CANCEL:
             break
         else:
-            save_output_img(out_imgs[0], seeds[current_batch])
+            saves.append(save_output_img(out_imgs[0], seeds[current_batch]))
+            text_output += get_img_save_info(saves)
             generated_imgs.extend(out_imgs)
             yield generated_imgs, text_output, status_label(
                 "Text-to-Image-SDXL",
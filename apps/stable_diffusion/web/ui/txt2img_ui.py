@@ -26,6 +26,7 @@ from apps.stable_diffusion.src import (
     set_init_device_flags,
     utils,
     save_output_img,
+    get_img_save_info,
     prompt_examples,
     Image2ImagePipeline,
 )
@@ -69,7 +70,12 @@ def txt2img_inf(
     hiresfix_width: int,
     hiresfix_strength: float,
     resample_type: str,
+    per_image_seeds: list = None,
 ):
+    # With `per_image_seeds`, a single batch is generated in which image i
+    # uses per_image_seeds[i] and, if `prompt`/`negative_prompt` are lists,
+    # the i-th prompt. Batches with fewer seeds than `batch_size` are padded
+    # with copies of the last image, which are discarded.
     from apps.stable_diffusion.web.ui.utils import (
         get_custom_model_pathfile,
         get_custom_vae_or_lora_weights,
@@ -80,8 +86,12 @@ def txt2img_inf(
         SD_STATE_CANCEL,
     )
 
-    args.prompts = [prompt]
-    args.negative_prompts = [negative_prompt]
+    args.prompts = prompt if isinstance(prompt, list) else [prompt]
+    args.negative_prompts = (
+        negative_prompt
+        if isinstance(negative_prompt, list)
+        else [negative_prompt]
+    )
     args.guidance_scale = guidance_scale
     args.steps = steps
     args.scheduler = scheduler
@@ -112,6 +122,9 @@ def txt2img_inf(
         lora_weights, lora_hf_id, "lora"
     )
 
+    # With --runtime_lora switching the LoRA does not need a new pipeline.
+    config_lora = "" if args.runtime_lora else args.use_lora
+
     dtype = torch.float32 if precision == "fp32" else torch.half
     cpu_scheduling = not scheduler.startswith("Shark")
     new_config_obj = Config(
@@ -125,7 +138,7 @@ def txt2img_inf(
         height,
         width,
         device,
-        use_lora=args.use_lora,
+        use_lora=config_lora,
         stencils=[],
         ondemand=ondemand,
     )
@@ -153,44 +166,57 @@ def txt2img_inf(
         args.import_mlir = init_import_mlir
         args.img_path = None
         set_init_device_flags()
-        model_id = (
-            args.hf_model_id
-            if args.hf_model_id
-            else "stabilityai/stable-diffusion-2-1-base"
-        )
-        global_obj.set_schedulers(get_schedulers(model_id))
-        scheduler_obj = global_obj.get_scheduler(scheduler)
-        global_obj.set_sd_obj(
-            Text2ImagePipeline.from_pretrained(
-                scheduler=scheduler_obj,
-                import_mlir=args.import_mlir,
-                model_id=args.hf_model_id,
-                ckpt_loc=args.ckpt_loc,
-                precision=args.precision,
-                max_length=args.max_length,
-                batch_size=args.batch_size,
-                height=args.height,
-                width=args.width,
-                use_base_vae=args.use_base_vae,
-                use_tuned=args.use_tuned,
-                custom_vae=args.custom_vae,
-                low_cpu_mem_usage=args.low_cpu_mem_usage,
-                debug=args.import_debug if args.import_mlir else False,
-                use_lora=args.use_lora,
-                ondemand=args.ondemand,
+        if not global_obj.use_resident(new_config_obj):
+            model_id = (
+                args.hf_model_id
+                if args.hf_model_id
+                else "stabilityai/stable-diffusion-2-1-base"
+            )
+            global_obj.set_schedulers(get_schedulers(model_id))
+            scheduler_obj = global_obj.get_scheduler(scheduler)
+            global_obj.set_sd_obj(
+                Text2ImagePipeline.from_pretrained(
+                    scheduler=scheduler_obj,
+                    import_mlir=args.import_mlir,
+                    model_id=args.hf_model_id,
+                    ckpt_loc=args.ckpt_loc,
+                    precision=args.precision,
+                    max_length=args.max_length,
+                    batch_size=args.batch_size,
+                    height=args.height,
+                    width=args.width,
+                    use_base_vae=args.use_base_vae,
+                    use_tuned=args.use_tuned,
+                    custom_vae=args.custom_vae,
+                    low_cpu_mem_usage=args.low_cpu_mem_usage,
+                    debug=args.import_debug if args.import_mlir else False,
+                    use_lora=args.use_lora,
+                    ondemand=args.ondemand,
+                )
             )
-        )
 
     global_obj.set_sd_scheduler(scheduler)
+    if args.runtime_lora:
+        global_obj.get_sd_obj().set_lora(args.use_lora)
 
     start_time = time.time()
     global_obj.get_sd_obj().log = ""
     generated_imgs = []
+    saves = []
     text_output = ""
-    try:
-        seeds = utils.batch_seeds(seed, batch_count, repeatable_seeds)
-    except TypeError as error:
-        raise gr.Error(str(error)) from None
+    if per_image_seeds is not None:
+        pad = batch_size - len(per_image_seeds)
+        seeds = [per_image_seeds + per_image_seeds[-1:] * pad]
+        if isinstance(prompt, list):
+            prompt = prompt + prompt[-1:] * pad
+        if isinstance(negative_prompt, list):
+            negative_prompt = negative_prompt + negative_prompt[-1:] * pad
+        batch_count = 1
+    else:
+        try:
+            seeds = utils.batch_seeds(seed, batch_count, repeatable_seeds)
+        except TypeError as error:
+            raise gr.Error(str(error)) from None
 
     for current_batch in range(batch_count):
         out_imgs = global_obj.get_sd_obj().generate_images(
@@ -225,7 +251,7 @@ def txt2img_inf(
                 height,
                 width,
                 device,
-                use_lora=args.use_lora,
+                use_lora=config_lora,
                 stencils=[],
                 ondemand=ondemand,
             )
@@ -233,36 +259,39 @@ def txt2img_inf(
             global_obj.clear_cache()
             global_obj.set_cfg_obj(new_config_obj)
             set_init_device_flags()
-            model_id = (
-                args.hf_model_id
-                if args.hf_model_id
-                else "stabilityai/stable-diffusion-2-1-base"
-            )
-            global_obj.set_schedulers(get_schedulers(model_id))
-            scheduler_obj = global_obj.get_scheduler(args.scheduler)
-
-            global_obj.set_sd_obj(
-                Image2ImagePipeline.from_pretrained(
-                    scheduler_obj,
-                    args.import_mlir,
-                    args.hf_model_id,
-                    args.ckpt_loc,
-                    args.custom_vae,
-                    args.precision,
-                    args.max_length,
-                    1,
-                    hiresfix_height,
-                    hiresfix_width,
-                    args.use_base_vae,
-                    args.use_tuned,
-                    low_cpu_mem_usage=args.low_cpu_mem_usage,
-                    debug=args.import_debug if args.import_mlir else False,
-                    use_lora=args.use_lora,
-                    ondemand=args.ondemand,
+            if not global_obj.use_resident(new_config_obj):
+                model_id = (
+                    args.hf_model_id
+                    if args.hf_model_id
+                    else "stabilityai/stable-diffusion-2-1-base"
+                )
+                global_obj.set_schedulers(get_schedulers(model_id))
+                scheduler_obj = global_obj.get_scheduler(args.scheduler)
+
+                global_obj.set_sd_obj(
+                    Image2ImagePipeline.from_pretrained(
+                        scheduler_obj,
+                        args.import_mlir,
+                        args.hf_model_id,
+                        args.ckpt_loc,
+                        args.custom_vae,
+                        args.precision,
+                        args.max_length,
+                        1,
+                        hiresfix_height,
+                        hiresfix_width,
+                        args.use_base_vae,
+                        args.use_tuned,
+                        low_cpu_mem_usage=args.low_cpu_mem_usage,
+                        debug=args.import_debug if args.import_mlir else False,
+                        use_lora=args.use_lora,
+                        ondemand=args.ondemand,
+                    )
                 )
-            )
 
             global_obj.set_sd_scheduler(args.scheduler)
+            if args.runtime_lora:
+                global_obj.get_sd_obj().set_lora(args.use_lora)
 
             out_imgs = global_obj.get_sd_obj().generate_images(
                 prompt,
@@ -294,7 +323,28 @@ def txt2img_inf(
         if global_obj.get_sd_status() == SD_STATE_CANCEL:
             break
         else:
-            save_output_img(out_imgs[0], seeds[current_batch])
+            if per_image_seeds is not None:
+                out_imgs = out_imgs[: len(per_image_seeds)]
+                for i, (img, img_seed) in enumerate(
+                    zip(out_imgs, per_image_seeds)
+                ):
+                    saves.append(
+                        save_output_img(
+                            img,
+                            img_seed,
+                            prompt=prompt[i]
+                            if isinstance(prompt, list)
+                            else None,
+                            negative_prompt=negative_prompt[i]
+                            if isinstance(negative_prompt, list)
+                            else None,
+                        )
+                    )
+            else:
+                saves.append(
+                    save_output_img(out_imgs[0], seeds[current_batch])
+                )
+            text_output += get_img_save_info(saves)
             generated_imgs.extend(out_imgs)
             yield generated_imgs, text_output, status_label(
                 "Text-to-Image", current_batch + 1, batch_count, batch_size
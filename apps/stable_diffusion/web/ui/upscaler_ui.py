@@ -22,6 +22,7 @@ from apps.stable_diffusion.src import (
     set_init_device_flags,
     utils,
     save_output_img,
+    get_img_save_info,
 )
 from apps.stable_diffusion.src.utils import get_generated_imgs_path
 
@@ -136,32 +137,33 @@ def upscaler_inf(
         args.use_tuned = init_use_tuned
         args.import_mlir = init_import_mlir
         set_init_device_flags()
-        model_id = (
-            args.hf_model_id
-            if args.hf_model_id
-            else "stabilityai/stable-diffusion-2-1-base"
-        )
-        global_obj.set_schedulers(get_schedulers(model_id))
-        scheduler_obj = global_obj.get_scheduler(scheduler)
-        global_obj.set_sd_obj(
-            UpscalerPipeline.from_pretrained(
-                scheduler_obj,
-                args.import_mlir,
-                args.hf_model_id,
-                args.ckpt_loc,
-                args.custom_vae,
-                args.precision,
-                args.max_length,
-                args.batch_size,
-                args.height,
-                args.width,
-                args.use_base_vae,
-                args.use_tuned,
-                low_cpu_mem_usage=args.low_cpu_mem_usage,
-                use_lora=args.use_lora,
-                ondemand=args.ondemand,
+        if not global_obj.use_resident(new_config_obj):
+            model_id = (
+                args.hf_model_id
+                if args.hf_model_id
+                else "stabilityai/stable-diffusion-2-1-base"
+            )
+            global_obj.set_schedulers(get_schedulers(model_id))
+            scheduler_obj = global_obj.get_scheduler(scheduler)
+            global_obj.set_sd_obj(
+                UpscalerPipeline.from_pretrained(
+                    scheduler_obj,
+                    args.import_mlir,
+                    args.hf_model_id,
+                    args.ckpt_loc,
+                    args.custom_vae,
+                    args.precision,
+                    args.max_length,
+                    args.batch_size,
+                    args.height,
+                    args.width,
+                    args.use_base_vae,
+                    args.use_tuned,
+                    low_cpu_mem_usage=args.low_cpu_mem_usage,
+                    use_lora=args.use_lora,
+                    ondemand=args.ondemand,
+                )
             )
-        )
 
     global_obj.set_sd_scheduler(scheduler)
     global_obj.get_sd_obj().low_res_scheduler = global_obj.get_scheduler(
@@ -171,6 +173,7 @@ def upscaler_inf(
     start_time = time.time()
     global_obj.get_sd_obj().log = ""
     generated_imgs = []
+    saves = []
     extra_info = {"NOISE LEVEL": noise_level}
     try:
         seeds = utils.batch_seeds(seed, batch_count, repeatable_seeds)
@@ -236,7 +239,10 @@ def upscaler_inf(
         if global_obj.get_sd_status() == SD_STATE_CANCEL:
             break
         else:
-            save_output_img(high_res_img, seeds[current_batch], extra_info)
+            saves.append(
+                save_output_img(high_res_img, seeds[current_batch], extra_info)
+            )
+            text_output += get_img_save_info(saves)
             generated_imgs.append(high_res_img)
             global_obj.get_sd_obj().log += "\n"
             yield generated_imgs, text_output, status_label(
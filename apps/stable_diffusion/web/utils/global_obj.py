@@ -1,10 +1,18 @@
 import gc
+import os
+
+from collections import OrderedDict
 
 
 """
 The global objects include SD pipeline and config.
 Maintaining the global objects would avoid creating extra pipeline objects when switching modes.
 Also we could avoid memory leak when switching models by clearing the cache.
+
+Pipelines that are switched away from are parked in a residency pool
+instead of being dropped, up to --max_resident_pipelines pipelines and
+--resident_pipelines_max_gb of loaded modules. Switching back to a parked
+config is then just a lookup, see use_resident().
 """
 
 
@@ -12,14 +20,20 @@ def _init():
     global _sd_obj
     global _config_obj
     global _schedulers
+    global _resident
+    global _residency_stats
     _sd_obj = None
     _config_obj = None
     _schedulers = None
+    _resident = OrderedDict()
+    _residency_stats = {"hits": 0, "misses": 0, "evictions": 0}
 
 
 def set_sd_obj(value):
     global _sd_obj
     _sd_obj = value
+    # The new pipeline is loaded now, so its real size counts.
+    _evict_resident()
 
 
 def set_sd_scheduler(key):
@@ -62,14 +76,106 @@ def get_scheduler(key):
     return _schedulers[key]
 
 
+def _pipeline_modules(sd_obj):
+    # Loaded SharkInference modules of a pipeline (clip, unet, vae, ...).
+    modules = []
+    for value in vars(sd_obj).values():
+        for module in value if isinstance(value, list) else [value]:
+            if hasattr(module, "shark_runner"):
+                modules.append(module)
+    return modules
+
+
+def _size_bytes(pipelines):
+    # Modules shared between pipelines (see utils._load_vmfb) count once.
+    modules = {
+        id(module): module
+        for sd_obj in pipelines
+        for module in _pipeline_modules(sd_obj)
+    }
+    return sum(
+        os.path.getsize(module.vmfb_path)
+        for module in modules.values()
+        if os.path.isfile(getattr(module, "vmfb_path", ""))
+    )
+
+
+def _resident_size_bytes():
+    pipelines = [sd_obj for sd_obj, _, _ in _resident.values()]
+    if _sd_obj is not None:
+        pipelines.append(_sd_obj)
+    return _size_bytes(pipelines)
+
+
+def _evict_resident(incoming_bytes=0):
+    from apps.stable_diffusion.src import args
+
+    max_bytes = (
+        args.resident_pipelines_max_gb * (1 << 30)
+        if args.resident_pipelines_max_gb is not None
+        else None
+    )
+    # The active pipeline takes one of the resident slots, and
+    # `incoming_bytes` are reserved for a pipeline about to be loaded.
+    while _resident and (
+        len(_resident) >= args.max_resident_pipelines
+        or (
+            max_bytes is not None
+            and _resident_size_bytes() + incoming_bytes > max_bytes
+        )
+    ):
+        key, entry = _resident.popitem(last=False)
+        del entry
+        _residency_stats["evictions"] += 1
+        print(f"Evicted resident pipeline: {key}")
+    gc.collect()
+
+
+def use_resident(config):
+    """
+    Makes the parked pipeline built for `config` the active one.
+    Returns False if no such pipeline is resident.
+    """
+    global _sd_obj
+    global _config_obj
+    global _schedulers
+    entry = _resident.pop(repr(config), None)
+    if entry is None:
+        _residency_stats["misses"] += 1
+        return False
+    _residency_stats["hits"] += 1
+    _sd_obj, _config_obj, _schedulers = entry
+    return True
+
+
+def get_residency_stats():
+    return dict(
+        _residency_stats,
+        resident=list(_resident.keys()),
+        resident_bytes=_resident_size_bytes(),
+    )
+
+
 def clear_cache():
     global _sd_obj
     global _config_obj
     global _schedulers
-    del _sd_obj
-    del _config_obj
-    del _schedulers
-    gc.collect()
+    if _sd_obj is not None and _config_obj is not None:
+        _resident[repr(_config_obj)] = (_sd_obj, _config_obj, _schedulers)
     _sd_obj = None
     _config_obj = None
     _schedulers = None
+    # Until it is loaded, the next pipeline is taken to be as large as the
+    # largest resident one; set_sd_obj checks again with its real size.
+    _evict_resident(
+        max(
+            (_size_bytes([sd_obj]) for sd_obj, _, _ in _resident.values()),
+            default=0,
+        )
+    )
+
+
+def clear_resident():
+    clear_cache()
+    _resident.clear()
+    gc.collect()
@@ -0,0 +1,476 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## History of benchmark results and detection of regressions across runs.
+#
+# Usage:
+#   python -m shark.benchmark_history ingest bench_results.csv
+#   python -m shark.benchmark_history report --models tank/all_models.csv \
+#       --html bench_history.html
+#   python -m shark.benchmark_history check  # exits with 1 on regressions
+import argparse
+import csv
+import html
+import json
+import math
+import sqlite3
+import statistics
+import subprocess
+import sys
+from typing import Optional
+
+# Runs of the same series are comparable with each other.
+SERIES_COLUMNS = [
+    "model",
+    "engine",
+    "dialect",
+    "device",
+    "shape_type",
+    "data_type",
+    "batch_size",
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    model TEXT NOT NULL,
+    engine TEXT NOT NULL,
+    dialect TEXT NOT NULL,
+    device TEXT NOT NULL,
+    shape_type TEXT NOT NULL,
+    data_type TEXT NOT NULL,
+    batch_size TEXT NOT NULL,
+    datetime TEXT NOT NULL,
+    revision TEXT,
+    iree_version TEXT,
+    flags TEXT,
+    ms_per_iter REAL,
+    iter_per_sec REAL,
+    host_memory_mb REAL,
+    device_memory_mb REAL,
+    iterations INTEGER,
+    stddev_ms REAL,
+    stats TEXT,
+    UNIQUE (model, engine, dialect, device, shape_type, data_type,
+            batch_size, datetime)
+);
+CREATE INDEX IF NOT EXISTS runs_by_series ON runs (
+    model, engine, dialect, device, shape_type, data_type, batch_size,
+    datetime
+);
+"""
+
+_SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+
+def get_git_revision(path: str = ".") -> Optional[str]:
+    # None outside of a git checkout, stored as an unknown revision.
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=path,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class BenchmarkHistory:
+    """
+    SQLite store of benchmark runs, one row per bench_results.csv row,
+    tagged with the git revision, IREE version and compile flags it ran
+    with.
+    """
+
+    def __init__(self, path: str = "bench_history.db"):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add_run(
+        self,
+        row: dict,
+        revision: str = None,
+        iree_version: str = None,
+        flags: str = "",
+        stats: dict = None,
+    ) -> bool:
+        """
+        Stores `row`, a bench_results.csv row. Returns False if the run was
+        stored before. `revision` and `iree_version` are those the run was
+        benchmarked with; they are stored as NULL (unknown) if not given,
+        since a row may be older than the checkout ingesting it.
+        """
+        values = {column: str(row[column]) for column in SERIES_COLUMNS}
+        values.update(
+            {
+                "datetime": str(row["datetime"]),
+                "revision": revision,
+                "iree_version": iree_version,
+                "flags": flags,
+                "ms_per_iter": _to_float(row.get("ms/iter")),
+                "iter_per_sec": _to_float(row.get("iter/sec")),
+                "host_memory_mb": _to_float(row.get("host_memory_mb")),
+                "device_memory_mb": _to_float(row.get("device_memory_mb")),
+                "iterations": _to_int(row.get("iterations")),
+                "stddev_ms": None if stats is None else stats["stddev_ms"],
+                "stats": None if stats is None else json.dumps(stats),
+            }
+        )
+        columns = ", ".join(values)
+        placeholders = ", ".join(f":{column}" for column in values)
+        cursor = self.db.execute(
+            f"INSERT OR IGNORE INTO runs ({columns}) VALUES ({placeholders})",
+            values,
+        )
+        self.db.commit()
+        return cursor.rowcount == 1
+
+    def ingest_csv(
+        self,
+        csv_path: str,
+        stats_path: str = None,
+        revision: str = None,
+        iree_version: str = None,
+        flags: str = "",
+    ) -> int:
+        """
+        Stores the rows of a bench_results.csv, with the statistics of the
+        --statistical_benchmark sidecar at `stats_path` if given, and the
+        revision and IREE version they were benchmarked with if known.
+        Returns the number of new runs.
+        """
+        stats_by_run = {}
+        if stats_path is not None:
+            with open(stats_path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    key = (entry["model"], entry["engine"], entry["datetime"])
+                    stats_by_run[key] = entry["stats"]
+        added = 0
+        with open(csv_path, newline="") as f:
+            for row in csv.DictReader(f):
+                if not row.get("ms/iter") or not row.get("datetime"):
+                    continue
+                stats = stats_by_run.get(
+                    (row["model"], row["engine"], row["datetime"])
+                )
+                added += self.add_run(
+                    row, revision, iree_version, flags, stats
+                )
+        return added
+
+    def get_series(self, models: list = None) -> dict:
+        """Returns the runs of every series, oldest first, by series key."""
+        query = "SELECT * FROM runs"
+        params = []
+        if models is not None:
+            query += f" WHERE model IN ({', '.join('?' * len(models))})"
+            params = list(models)
+        query += f" ORDER BY {', '.join(SERIES_COLUMNS)}, datetime"
+        series = {}
+        for run in self.db.execute(query, params):
+            key = tuple(run[column] for column in SERIES_COLUMNS)
+            series.setdefault(key, []).append(dict(run))
+        return series
+
+
+def _one_sided_p(z: float) -> float:
+    # P(Z > z) for a standard normal Z.
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def check_series(
+    runs: list,
+    window: int = 10,
+    threshold: float = 0.05,
+    alpha: float = 0.01,
+    memory_threshold: float = 0.1,
+) -> list:
+    """
+    Compares the latest run of a series with a rolling baseline of the
+    `window` runs before it. A slowdown is flagged if ms/iter grew by more
+    than `threshold` (relative) and is significant at `alpha` against the
+    run to run spread of the baseline (one sided, normal prediction
+    interval). With fewer than 3 baseline runs only `threshold` applies.
+    Memory growth is flagged beyond `memory_threshold` over the baseline
+    median. Returns a list of findings (dicts).
+    """
+    if len(runs) < 2:
+        return []
+    latest = runs[-1]
+    baseline = runs[-window - 1 : -1]
+    findings = []
+    # Unknown (NULL) revisions and versions are not reported as changes.
+    changes = {
+        name: (baseline[-1][name], latest[name])
+        for name in ("revision", "iree_version", "flags")
+        if baseline[-1][name] != latest[name]
+        and None not in (baseline[-1][name], latest[name])
+    }
+
+    times = [run["ms_per_iter"] for run in baseline if run["ms_per_iter"]]
+    if times and latest["ms_per_iter"]:
+        base_ms = statistics.mean(times)
+        change = latest["ms_per_iter"] / base_ms - 1
+        p_value = None
+        if len(times) >= 3:
+            spread = statistics.stdev(times) * math.sqrt(1 + 1 / len(times))
+            if spread > 0:
+                p_value = _one_sided_p(
+                    (latest["ms_per_iter"] - base_ms) / spread
+                )
+            else:
+                p_value = 0.0 if change > 0 else 1.0
+        if change > threshold and (p_value is None or p_value < alpha):
+            findings.append(
+                {
+                    "kind": "slowdown",
+                    "metric": "ms_per_iter",
+                    "baseline": base_ms,
+                    "latest": latest["ms_per_iter"],
+                    "change": change,
+                    "p_value": p_value,
+                    "changes": changes,
+                }
+            )
+
+    for metric in ("host_memory_mb", "device_memory_mb"):
+        values = [run[metric] for run in baseline if run[metric]]
+        if not values or not latest[metric]:
+            continue
+        base_mb = statistics.median(values)
+        change = latest[metric] / base_mb - 1
+        if change > memory_threshold:
+            findings.append(
+                {
+                    "kind": "memory_growth",
+                    "metric": metric,
+                    "baseline": base_mb,
+                    "latest": latest[metric],
+                    "change": change,
+                    "p_value": None,
+                    "changes": changes,
+                }
+            )
+    return findings
+
+
+def sparkline(values: list) -> str:
+    values = [v for v in values if v is not None]
+    if not values:
+        return ""
+    low, high = min(values), max(values)
+    scale = (len(_SPARK_CHARS) - 1) / (high - low) if high > low else 0
+    return "".join(_SPARK_CHARS[int((v - low) * scale)] for v in values)
+
+
+def _series_name(key) -> str:
+    return " ".join(str(part) for part in key[1:])
+
+
+def _describe_finding(finding: dict) -> str:
+    text = (
+        f"{finding['kind']} {finding['metric']}: "
+        f"{finding['baseline']:.3f} -> {finding['latest']:.3f} "
+        f"({finding['change']:+.1%}"
+    )
+    if finding["p_value"] is not None:
+        text += f", p={finding['p_value']:.2g}"
+    text += ")"
+    for name, (before, after) in finding["changes"].items():
+        text += f"; {name} {before} -> {after}"
+    return text
+
+
+def build_report(series: dict, model_flags: dict = None, **check_args):
+    """
+    Returns the per model trend report of `series`, see get_series, as a
+    list of (model, flags, [entry per series]) with the runs and
+    findings of every series.
+    """
+    model_flags = model_flags or {}
+    models = {}
+    for key, runs in series.items():
+        models.setdefault(key[0], []).append(
+            {
+                "name": _series_name(key),
+                "runs": runs,
+                "findings": check_series(runs, **check_args),
+            }
+        )
+    return [
+        (model, model_flags.get(model, ""), entries)
+        for model, entries in sorted(models.items())
+    ]
+
+
+def render_text_report(report, last: int = 30) -> str:
+    lines = []
+    for model, flags, entries in report:
+        lines.append(f"{model}" + (f" [{flags}]" if flags else ""))
+        for entry in entries:
+            runs = entry["runs"][-last:]
+            latest = runs[-1]
+            lines.append(
+                f"  {entry['name']}: {latest['ms_per_iter']} ms/iter "
+                f"@{latest['revision'] or 'unknown'} "
+                f"{sparkline([run['ms_per_iter'] for run in runs])}"
+            )
+            for finding in entry["findings"]:
+                lines.append(f"    ! {_describe_finding(finding)}")
+    return "\n".join(lines)
+
+
+def _svg_sparkline(values: list, width: int = 160, height: int = 30) -> str:
+    values = [v for v in values if v is not None]
+    if len(values) < 2:
+        return ""
+    low, high = min(values), max(values)
+    span = high - low or 1
+    points = " ".join(
+        f"{i * width / (len(values) - 1):.1f},"
+        f"{height - (v - low) * height / span:.1f}"
+        for i, v in enumerate(values)
+    )
+    return (
+        f'<svg width="{width}" height="{height}">'
+        f'<polyline fill="none" stroke="steelblue" points="{points}"/></svg>'
+    )
+
+
+def render_html_report(report, last: int = 30) -> str:
+    rows = []
+    for model, flags, entries in report:
+        for entry in entries:
+            runs = entry["runs"][-last:]
+            latest = runs[-1]
+            findings = "<br>".join(
+                html.escape(_describe_finding(f)) for f in entry["findings"]
+            )
+            style = ' style="background:#fdd"' if entry["findings"] else ""
+            rows.append(
+                f"<tr{style}><td>{html.escape(model)}</td>"
+                f"<td>{html.escape(flags)}</td>"
+                f"<td>{html.escape(entry['name'])}</td>"
+                f"<td>{latest['ms_per_iter']}</td>"
+                f"<td>{html.escape(latest['revision'] or 'unknown')}</td>"
+                f"<td>{_svg_sparkline([r['ms_per_iter'] for r in runs])}</td>"
+                f"<td>{findings}</td></tr>"
+            )
+    return (
+        "<!DOCTYPE html><html><head><meta charset='utf-8'>"
+        "<title>SHARK benchmark history</title></head><body>"
+        "<h1>SHARK benchmark history</h1><table border='1'>"
+        "<tr><th>model</th><th>flags</th><th>series</th><th>ms/iter</th>"
+        "<th>revision</th><th>trend</th><th>findings</th></tr>"
+        + "".join(rows)
+        + "</table></body></html>"
+    )
+
+
+def load_model_list(path: str) -> dict:
+    # Models and their flags column from a tank/all_models.csv style file.
+    with open(path, newline="") as f:
+        return {
+            row[0]: row[6] if len(row) > 6 and row[6] != "None" else ""
+            for row in csv.reader(f)
+            if row
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Stores benchmark results and reports regressions."
+    )
+    parser.add_argument("command", choices=["ingest", "report", "check"])
+    parser.add_argument("csv_path", nargs="?", default="bench_results.csv")
+    parser.add_argument("--db", default="bench_history.db")
+    parser.add_argument(
+        "--stats_path",
+        default=None,
+        help="--statistical_benchmark sidecar of the ingested csv.",
+    )
+    parser.add_argument(
+        "--revision",
+        default=None,
+        help="Git revision the ingested csv was benchmarked at. Stored as "
+        "unknown if not given.",
+    )
+    parser.add_argument(
+        "--iree_version",
+        default=None,
+        help="IREE compiler version the ingested csv was benchmarked with. "
+        "Stored as unknown if not given.",
+    )
+    parser.add_argument("--flags", default="")
+    parser.add_argument(
+        "--models",
+        default=None,
+        help="Only report the models of this tank/all_models.csv style file.",
+    )
+    parser.add_argument("--window", type=int, default=10)
+    parser.add_argument("--threshold", type=float, default=0.05)
+    parser.add_argument("--alpha", type=float, default=0.01)
+    parser.add_argument("--memory_threshold", type=float, default=0.1)
+    parser.add_argument("--html", default=None, help="Writes an html report.")
+    args = parser.parse_args()
+
+    history = BenchmarkHistory(args.db)
+    if args.command == "ingest":
+        added = history.ingest_csv(
+            args.csv_path,
+            args.stats_path,
+            args.revision,
+            args.iree_version,
+            flags=args.flags,
+        )
+        print(f"Added {added} runs to {args.db}")
+        sys.exit(0)
+
+    model_flags = load_model_list(args.models) if args.models else None
+    report = build_report(
+        history.get_series(None if model_flags is None else list(model_flags)),
+        model_flags,
+        window=args.window,
+        threshold=args.threshold,
+        alpha=args.alpha,
+        memory_threshold=args.memory_threshold,
+    )
+    print(render_text_report(report))
+    if args.html is not None:
+        with open(args.html, "w", encoding="utf-8") as f:
+            f.write(render_html_report(report))
+    if args.command == "check" and any(
+        entry["findings"] for _, _, entries in report for entry in entries
+    ):
+        sys.exit(1)
@@ -0,0 +1,188 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Statistics of per iteration benchmark latencies.
+import time
+
+import numpy as np
+
+# Two sided 95% quantiles of the t distribution by degrees of freedom, the
+# normal quantile is used beyond the table.
+_T_95 = {
+    1: 12.706,
+    2: 4.303,
+    3: 3.182,
+    4: 2.776,
+    5: 2.571,
+    6: 2.447,
+    7: 2.365,
+    8: 2.306,
+    9: 2.262,
+    10: 2.228,
+    15: 2.131,
+    20: 2.086,
+    30: 2.042,
+    60: 2.000,
+    120: 1.980,
+}
+
+
+def t_quantile_95(dof: int) -> float:
+    # Uses the closest tabulated degrees of freedom at or below `dof`, which
+    # errs on the wide side.
+    if dof > 120:
+        return 1.960
+    return _T_95[max(d for d in _T_95 if d <= max(dof, 1))]
+
+
+def mser_truncation(samples, batch_size: int = 5) -> int:
+    """
+    Returns how many leading samples are warmup, by the MSER-5 rule: the
+    cut that minimizes the standard error of the mean of what remains,
+    over batch means of `batch_size` samples. Cuts beyond half of the
+    samples are not considered.
+    """
+    num_batches = len(samples) // batch_size
+    if num_batches < 4:
+        return 0
+    batches = (
+        np.asarray(samples[: num_batches * batch_size], dtype=np.float64)
+        .reshape(num_batches, batch_size)
+        .mean(axis=1)
+    )
+    best_cut, best_score = 0, None
+    for cut in range(num_batches // 2 + 1):
+        rest = batches[cut:]
+        score = rest.var() / len(rest)
+        if best_score is None or score < best_score:
+            best_cut, best_score = cut, score
+    return best_cut * batch_size
+
+
+def outlier_mask(samples, threshold: float = 3.5):
+    """
+    Marks samples whose modified z-score (median and MAD based) exceeds
+    `threshold`, the usual Iglewicz-Hoaglin rule.
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    median = np.median(samples)
+    mad = np.median(np.abs(samples - median))
+    if mad == 0:
+        return np.zeros(len(samples), dtype=bool)
+    return 0.6745 * np.abs(samples - median) / mad > threshold
+
+
+def summarize_latencies(samples_ns) -> dict:
+    """
+    Summarizes latencies in nanoseconds as milliseconds: median, p90, p99,
+    mean, stddev and the 95% confidence interval of the mean, relative to
+    it.
+    """
+    samples = np.asarray(samples_ns, dtype=np.float64) / 1e6
+    n = len(samples)
+    mean = samples.mean()
+    stddev = samples.std(ddof=1) if n > 1 else 0.0
+    ci = t_quantile_95(n - 1) * stddev / np.sqrt(n) if n > 1 else np.inf
+    return {
+        "n": n,
+        "median_ms": float(np.median(samples)),
+        "p90_ms": float(np.percentile(samples, 90)),
+        "p99_ms": float(np.percentile(samples, 99)),
+        "mean_ms": float(mean),
+        "stddev_ms": float(stddev),
+        "min_ms": float(samples.min()),
+        "max_ms": float(samples.max()),
+        "ci95_rel": float(ci / mean) if mean > 0 else float("inf"),
+    }
+
+
+class LatencySampler:
+    """
+    Collects per iteration latencies until the mean is known to within
+    `ci_target` (relative half width of its 95% confidence interval),
+    after discarding warmup and outliers.
+
+    Iterations report their latency split into named phases, e.g.
+    host to device copies, invocation and device to host copies; the
+    confidence target applies to their total.
+    """
+
+    def __init__(
+        self,
+        ci_target: float = 0.02,
+        min_iterations: int = 10,
+        max_iterations: int = 10000,
+        max_seconds: float = 60,
+    ):
+        self.ci_target = ci_target
+        self.min_iterations = min_iterations
+        self.max_iterations = max_iterations
+        self.max_seconds = max_seconds
+        self.phases = {}
+        self.totals = []
+
+    def add(self, **phase_ns):
+        for phase, ns in phase_ns.items():
+            self.phases.setdefault(phase, []).append(ns)
+        self.totals.append(sum(phase_ns.values()))
+
+    def _kept(self):
+        # Indices of the samples past warmup that are not outliers.
+        warmup = mser_truncation(self.totals)
+        totals = np.asarray(self.totals[warmup:])
+        kept = np.nonzero(~outlier_mask(totals))[0] + warmup
+        return warmup, kept
+
+    def converged(self) -> bool:
+        if len(self.totals) < self.min_iterations:
+            return False
+        _, kept = self._kept()
+        if len(kept) < self.min_iterations:
+            return False
+        totals = np.asarray(self.totals)[kept]
+        return summarize_latencies(totals)["ci95_rel"] <= self.ci_target
+
+    def run(self, iteration):
+        """
+        Calls `iteration`, which returns a dict of phase latencies in
+        nanoseconds, until converged or out of iterations or time.
+        Returns the result of summary().
+        """
+        begin = time.perf_counter()
+        while len(self.totals) < self.max_iterations:
+            self.add(**iteration())
+            # Checking every iteration is quadratic, every 10th is enough.
+            if len(self.totals) % 10 == 0 and self.converged():
+                break
+            if time.perf_counter() - begin > self.max_seconds:
+                break
+        return self.summary()
+
+    def summary(self) -> dict:
+        warmup, kept = self._kept()
+        summary = summarize_latencies(np.asarray(self.totals)[kept])
+        summary.update(
+            {
+                "iterations": len(self.totals),
+                "warmup_discarded": warmup,
+                "outliers": len(self.totals) - warmup - len(kept),
+                "ci_target": self.ci_target,
+                "converged": summary["ci95_rel"] <= self.ci_target,
+                "phases": {
+                    phase: summarize_latencies(np.asarray(samples)[kept])
+                    for phase, samples in self.phases.items()
+                },
+            }
+        )
+        return summary
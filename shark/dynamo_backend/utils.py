@@ -1,5 +1,7 @@
 import functools
+import hashlib
 from typing import List, Optional
+import numpy as np
 import torch
 from torch.fx.experimental.proxy_tensor import make_fx
 from torch._functorch.compile_utils import strip_overloads
@@ -9,6 +11,9 @@ from torch.func import functionalize
 import io
 import torch_mlir
 
+# Graphs compiled in this process, by graph fingerprint.
+_compiled_graphs = {}
+
 
 # TODO: Control decompositions.
 def default_decompositions():
@@ -93,6 +98,51 @@ def _unwrap_single_tuple_return(fx_g: torch.fx.GraphModule) -> bool:
     return unwrapped_tuple
 
 
+def _graph_fingerprint(
+    fx_g: torch.fx.GraphModule, inputs: tuple, device: str
+) -> str:
+    """
+    Hash identifying the compiled form of a graph: its generated code, the
+    values of the tensors it holds, the shapes and dtypes of its inputs and
+    the device.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(fx_g.code.encode("utf-8"))
+    tensors = dict(fx_g.named_parameters())
+    tensors.update(fx_g.named_buffers())
+    for node in fx_g.graph.nodes:
+        if node.op == "get_attr":
+            attr = fx_g
+            for atom in node.target.split("."):
+                attr = getattr(attr, atom)
+            if isinstance(attr, torch.Tensor):
+                tensors[node.target] = attr
+    for name in sorted(tensors):
+        tensor = tensors[name].detach().cpu().contiguous()
+        hasher.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+        hasher.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    for x in inputs:
+        hasher.update(f"input:{tuple(x.shape)}:{x.dtype}".encode())
+    hasher.update(f"{device}:{torch.__version__}".encode())
+    return hasher.hexdigest()
+
+
+def _to_numpy(x: torch.Tensor) -> np.ndarray:
+    # Contiguous cpu tensors are handed over as views, without a copy.
+    x = x.detach()
+    if x.device.type != "cpu":
+        x = x.cpu()
+    return x.contiguous().numpy()
+
+
+def _to_torch(x) -> torch.Tensor:
+    # Results stay IREE device arrays until here, the host mapping of the
+    # buffer is wrapped, which does not copy host visible memory.
+    if hasattr(x, "to_host"):
+        x = x.to_host()
+    return torch.from_numpy(np.asarray(x))
+
+
 class SharkBackend:
     def __init__(
         self, fx_g: torch.fx.GraphModule, inputs: tuple, options: dict
@@ -104,13 +154,20 @@ class SharkBackend:
         self.was_unwrapped: bool = False
         self.none_indices: list = []
         self._modify_fx_g()
-        self.compile()
+        self.fingerprint = _graph_fingerprint(
+            self.fx_g, self.inputs, self.device
+        )
+        if self.fingerprint in _compiled_graphs:
+            self.shark_module = _compiled_graphs[self.fingerprint]
+        else:
+            self.compile()
+            _compiled_graphs[self.fingerprint] = self.shark_module
 
     def _modify_fx_g(self):
         self.none_indices = _remove_nones(self.fx_g)
         self.was_unwrapped = _unwrap_single_tuple_return(self.fx_g)
 
-    def compile(self):
+    def _lower_to_bytecode(self):
         gm = make_fx(
             functionalize(self.fx_g),
             decomposition_table=default_decompositions(),
@@ -124,30 +181,74 @@ class SharkBackend:
         )
         bytecode_stream = io.BytesIO()
         mlir_module.operation.write_bytecode(bytecode_stream)
-        bytecode = bytecode_stream.getvalue()
-        from shark.shark_inference import SharkInference
+        return bytecode_stream.getvalue()
+
+    def compile(self):
+        from shark.iree_utils._common import iree_target_map
+        from shark.iree_utils.compile_cache import get_vmfb_cache
+        from shark.iree_utils.compile_utils import (
+            compile_module_to_flatbuffer,
+            get_iree_compile_args,
+        )
 
+        # With the persistent compile cache, the vmfb is stored under the
+        # graph fingerprint, so that a hit skips the lowering to MLIR too.
+        compile_cache = get_vmfb_cache()
+        cache_key = None
+        if compile_cache is not None:
+            compile_args = get_iree_compile_args(self.device, "tm_tensor")
+            cache_key = compile_cache.make_key(
+                self.fingerprint.encode("utf-8"),
+                iree_target_map(self.device),
+                *compile_args,
+            )
+        if cache_key is None:
+            shark_module = SharkInference(
+                mlir_module=self._lower_to_bytecode(),
+                device=self.device,
+                mlir_dialect="tm_tensor",
+            )
+            shark_module.compile(extra_args=[])
+            self.shark_module = shark_module
+            return
+
+        vmfb_path = compile_cache.lookup(cache_key)
+        if vmfb_path is None:
+            flatbuffer_blob = compile_module_to_flatbuffer(
+                self._lower_to_bytecode(),
+                self.device,
+                "tm_tensor",
+                None,
+                [],
+                compile_str=True,
+                compile_args=compile_args,
+            )
+            vmfb_path = compile_cache.store(
+                cache_key,
+                flatbuffer_blob,
+                metadata={"frontend": "dynamo", "graph": self.fingerprint},
+            )
         shark_module = SharkInference(
-            mlir_module=bytecode,
+            mlir_module=None,
             device=self.device,
             mlir_dialect="tm_tensor",
+            mmap=True,
         )
-        shark_module.compile(extra_args=[])
+        shark_module.load_module(vmfb_path)
         self.shark_module = shark_module
 
     def __call__(self, *inputs):
-        np_inputs = [x.contiguous().detach().cpu().numpy() for x in inputs]
-        np_outs = self.shark_module("forward", np_inputs)
+        np_inputs = [_to_numpy(x) for x in inputs]
+        outs = self.shark_module("forward", np_inputs, send_to_host=False)
         if self.was_unwrapped:
-            np_outs = [
-                np_outs,
+            outs = [
+                outs,
             ]
 
-        if not isinstance(np_outs, list):
-            res = torch.from_numpy(np_outs)
-            return res
+        if not isinstance(outs, list):
+            return _to_torch(outs)
 
-        result = [torch.from_numpy(x) for x in np_outs]
+        result = [_to_torch(x) for x in outs]
         for r_in in self.none_indices:
             result.insert(r_in, None)
         result = tuple(result)
@@ -11,6 +11,10 @@
 # -t --token_count: the number of tokens you want to generate
 # -pr --prompt: the prompt you want to feed to the model
 # -m --model_name: the name of the model, e.g. bloom-560m
+# -kv --kv_cache: set to true to decode one token at a time, reusing the keys and values of the previous tokens.
+#                 Needs the mlir files made by --create_mlirs.
+# -ml --max_length: the most tokens, prompt included, the kv cache modules made by --create_mlirs can hold.
+# -b --benchmark: set to true to compare the tokens/s of generating the prompt with and without the kv cache.
 #
 # If you don't specify a prompt when you run this example, you will be able to give prompts through the terminal.  Run the
 # example in this way if you want to run multiple examples without reinitializing the model
@@ -31,6 +35,8 @@ import argparse
 import json
 import urllib.request
 import subprocess
+import time
+import numpy as np
 
 from torch.fx.experimental.proxy_tensor import make_fx
 from torch._decomp import get_decompositions
@@ -69,6 +75,13 @@ class ShardedBloom:
         except KeyError:
             self.n_head = config["n_head"]
 
+        # Written by create_mlirs along with the kv cache modules.
+        self.kv_cache_config = None
+        if os.path.exists(f"{src_folder}/kv_cache.json"):
+            with open(f"{src_folder}/kv_cache.json") as f:
+                self.kv_cache_config = json.load(f)
+        self.block_with_past_modules = None
+
     def _init_layer(self, layer_name, device, replace, device_idx):
         if replace or not os.path.exists(
             f"{self.src_folder}/{layer_name}.vmfb"
@@ -101,7 +114,9 @@ class ShardedBloom:
 
         return shark_module
 
-    def init_layers(self, device, replace=False, device_idx=[0]):
+    def init_layers(
+        self, device, replace=False, device_idx=[0], kv_cache=False
+    ):
         if device_idx is not None:
             n_devices = len(device_idx)
 
@@ -140,6 +155,24 @@ class ShardedBloom:
             )
             for i in range(self.n_layer)
         ]
+        if kv_cache:
+            if self.kv_cache_config is None:
+                raise ValueError(
+                    f"No kv cache modules in {self.src_folder}, create them "
+                    "with --create_mlirs"
+                )
+            # On the same devices as the blocks, which own their caches.
+            self.block_with_past_modules = [
+                self._init_layer(
+                    f"bloom_block_{i}_with_past",
+                    device,
+                    replace,
+                    device_idx
+                    if device_idx is None
+                    else device_idx[(i + 4) % n_devices],
+                )
+                for i in range(self.n_layer)
+            ]
 
         self.layers_initialized = True
 
@@ -156,8 +189,13 @@ class ShardedBloom:
             block_module.load_module(f"{self.src_folder}/bloom_block_{i}.vmfb")
         self.ln_f_module.load_module(f"{self.src_folder}/ln_f.vmfb")
         self.lm_head_module.load_module(f"{self.src_folder}/lm_head.vmfb")
+        if self.block_with_past_modules is not None:
+            for i, block_module in enumerate(self.block_with_past_modules):
+                block_module.load_module(
+                    f"{self.src_folder}/bloom_block_{i}_with_past.vmfb"
+                )
 
-    def forward_pass(self, input_ids, device):
+    def embed(self, input_ids):
         if IS_CUDA:
             cudaSetDevice(self.word_embeddings_module.device_idx)
 
@@ -172,7 +210,27 @@ class ShardedBloom:
             inputs=(input_embeds,), function_name="forward"
         )
 
-        hidden_states = torch.tensor(hidden_states).float()
+        return torch.tensor(hidden_states).float(), input_embeds
+
+    def next_token(self, hidden_states):
+        if IS_CUDA:
+            cudaSetDevice(self.ln_f_module.device_idx)
+
+        hidden_states = self.ln_f_module(
+            inputs=(hidden_states,), function_name="forward"
+        )
+        if IS_CUDA:
+            cudaSetDevice(self.lm_head_module.device_idx)
+
+        logits = self.lm_head_module(
+            inputs=(hidden_states,), function_name="forward"
+        )
+        logits = torch.tensor(logits).float()
+
+        return torch.argmax(logits[:, -1, :], dim=-1)
+
+    def forward_pass(self, input_ids, device, return_presents=False):
+        hidden_states, input_embeds = self.embed(input_ids)
 
         attention_mask = torch.ones(
             [hidden_states.shape[0], len(input_ids[0])]
@@ -214,21 +272,101 @@ class ShardedBloom:
                     )
                 ),
             )
-        if IS_CUDA:
-            cudaSetDevice(self.ln_f_module.device_idx)
 
-        hidden_states = self.ln_f_module(
-            inputs=(hidden_states,), function_name="forward"
+        next_token = self.next_token(hidden_states)
+        if return_presents:
+            return next_token, presents
+        return next_token
+
+    def _pad_cache(self, present, axis):
+        # Pads the keys or values of the prompt to the length of the cache.
+        present = np.asarray(present)
+        padding = [(0, 0)] * present.ndim
+        padding[axis] = (
+            0,
+            self.kv_cache_config["max_length"] - present.shape[axis],
         )
-        if IS_CUDA:
-            cudaSetDevice(self.lm_head_module.device_idx)
-
-        logits = self.lm_head_module(
-            inputs=(hidden_states,), function_name="forward"
+        return np.pad(present, padding)
+
+    def generate_with_cache(self, input_ids, token_count):
+        """
+        Runs the prompt through the blocks once, then every new token alone,
+        attending to the keys and values of the tokens before it. These are
+        kept in caches of `max_length` slots, one per block, which stay on
+        the device of the block.
+        """
+        max_length = self.kv_cache_config["max_length"]
+        batch_size, prompt_length = input_ids.shape
+        if prompt_length + token_count - 1 > max_length:
+            raise ValueError(
+                f"{prompt_length} prompt tokens and {token_count} new "
+                f"tokens do not fit in a kv cache of {max_length} tokens"
+            )
+        next_token, presents = self.forward_pass(
+            input_ids, None, return_presents=True
         )
-        logits = torch.tensor(logits).float()
+        new_tokens = [next_token]
+        caches = [
+            [
+                self._pad_cache(key, self.kv_cache_config["key_axis"]),
+                self._pad_cache(value, self.kv_cache_config["value_axis"]),
+            ]
+            for key, value in presents
+        ]
 
-        return torch.argmax(logits[:, -1, :], dim=-1)
+        # The keys are the cache slots followed by the new token. Slots
+        # 0..max_length - 1 hold positions 0..max_length - 1, and are
+        # masked until they do.
+        attention_mask = torch.zeros([batch_size, max_length + 1])
+        attention_mask[:, :prompt_length] = 1
+        attention_mask[:, -1] = 1
+        causal_mask = _expand_mask(attention_mask, torch.float32, tgt_len=1)
+        causal_mask = causal_mask.detach().numpy().copy()
+        alibi_positions = build_alibi_tensor(
+            torch.ones([batch_size, max_length + 1]),
+            self.n_head,
+            torch.float32,
+            "cpu",
+        ).numpy()
+        alibi = alibi_positions.copy()
+
+        for position in range(prompt_length, prompt_length + token_count - 1):
+            # The new token is at `position`, and its key and value are
+            # written to that slot.
+            alibi[..., -1] = alibi_positions[..., position]
+            slot = np.zeros(max_length, dtype=np.float32)
+            slot[position] = 1
+
+            hidden_states, _ = self.embed(next_token[:, None])
+            hidden_states = hidden_states.detach().numpy()
+            for block_module, cache in zip(
+                self.block_with_past_modules, caches
+            ):
+                if IS_CUDA:
+                    cudaSetDevice(block_module.device_idx)
+                output = block_module(
+                    inputs=(hidden_states, alibi, causal_mask, *cache, slot),
+                    function_name="forward",
+                    send_to_host=False,
+                )
+                hidden_states = output[0].to_host()
+                cache[:] = output[1:]
+
+            next_token = self.next_token(hidden_states)
+            new_tokens.append(next_token)
+            causal_mask[..., position] = 0
+
+        return torch.cat([input_ids, torch.stack(new_tokens, dim=-1)], dim=-1)
+
+    def generate(self, input_ids, token_count, use_cache=False):
+        if use_cache:
+            return self.generate_with_cache(input_ids, token_count)
+        for _ in range(token_count):
+            next_token = self.forward_pass(input_ids, None)
+            input_ids = torch.cat(
+                [input_ids, next_token.unsqueeze(-1)], dim=-1
+            )
+        return input_ids
 
 
 def _make_causal_mask(
@@ -474,6 +612,59 @@ def compile_to_mlir(
     return
 
 
+def write_slot(cache, present, slot, axis):
+    # Writes the last key or value of `present` to the slot of `cache` that
+    # is 1 in the one-hot `slot`, with elementwise ops only.
+    new = present.narrow(axis, present.shape[axis] - 1, 1)
+    shape = [1] * cache.dim()
+    shape[axis] = -1
+    slot = slot.view(shape)
+    return cache * (1 - slot) + new * slot
+
+
+def find_seq_axis(shape, shorter_shape):
+    # The one axis that grows with the number of tokens.
+    (axis,) = [
+        i for i, (a, b) in enumerate(zip(shape, shorter_shape)) if a != b
+    ]
+    return axis
+
+
+def compile_with_past_to_mlir(bblock, inputs, path):
+    # Unlike the prompt blocks, the kv cache blocks have static shapes.
+    fx_g = make_fx(
+        bblock,
+        decomposition_table=get_decompositions(
+            [
+                torch.ops.aten.split.Tensor,
+                torch.ops.aten.split_with_sizes,
+            ]
+        ),
+        tracing_mode="real",
+        _allow_non_fake_inputs=False,
+    )(*inputs)
+
+    fx_g.graph.set_codegen(torch.fx.graph.CodeGen())
+    fx_g.recompile()
+
+    strip_overloads(fx_g)
+
+    ts_g = torch.jit.script(fx_g)
+
+    module = torch_mlir.compile(
+        ts_g,
+        inputs,
+        torch_mlir.OutputType.LINALG_ON_TENSORS,
+        use_tracing=False,
+        verbose=False,
+    )
+
+    f_ = open(path, "w+")
+    f_.write(str(module))
+    f_.close()
+    return
+
+
 def compile_ln_f(ln_f, hidden_layers, path):
     hidden_layers_placeholder = torch_mlir.TensorPlaceholder.like(
         hidden_layers, dynamic_axes=[1]
@@ -518,7 +709,7 @@ def compile_lm_head(lm_head, hidden_layers, path):
     return
 
 
-def create_mlirs(destination_folder, model_name):
+def create_mlirs(destination_folder, model_name, max_length=256):
     model_config = "bigscience/" + model_name
     sample_input_ids = torch.ones([1, 17], dtype=torch.int64)
 
@@ -554,6 +745,34 @@ def create_mlirs(destination_folder, model_name):
             )
             return (output[0], output[1][0], output[1][1])
 
+    class HuggingFaceBlockWithPast(torch.nn.Module):
+        # One token through the block, attending to the key/value caches
+        # and then writing its own key and value to the slot of the caches
+        # selected by `slot`.
+        def __init__(self, block, key_axis, value_axis):
+            super().__init__()
+            self.model = block
+            self.key_axis = key_axis
+            self.value_axis = value_axis
+
+        def forward(
+            self, tokens, alibi, attention_mask, past_key, past_value, slot
+        ):
+            output = self.model(
+                hidden_states=tokens,
+                layer_past=(past_key, past_value),
+                alibi=alibi,
+                attention_mask=attention_mask,
+                use_cache=True,
+                output_attentions=False,
+            )
+            key, value = output[1]
+            return (
+                output[0],
+                write_slot(past_key, key, slot, self.key_axis),
+                write_slot(past_value, value, slot, self.value_axis),
+            )
+
     model = HuggingFaceLanguage()
 
     compile_embeddings(
@@ -602,6 +821,50 @@ def create_mlirs(destination_folder, model_name):
 
     all_hidden_states = ()
 
+    # The layout of the keys and values depends on the transformers
+    # version, find their token axes from a block run on fewer tokens.
+    n_head = model.model.transformer.n_head
+    first_block = HuggingFaceBlock(model.model.transformer.h[0])
+    _, key, value = first_block(hidden_states, alibi, causal_mask)
+    shorter_mask = attention_mask[:, :-1]
+    _, shorter_key, shorter_value = first_block(
+        hidden_states[:, :-1],
+        build_alibi_tensor(shorter_mask, n_head, hidden_states.dtype, "cpu"),
+        _prepare_attn_mask(
+            shorter_mask, shorter_mask.size(), inputs_embeds, 0
+        ),
+    )
+    kv_cache_config = {
+        "max_length": max_length,
+        "key_axis": find_seq_axis(key.shape, shorter_key.shape),
+        "value_axis": find_seq_axis(value.shape, shorter_value.shape),
+    }
+
+    def empty_cache(present, axis):
+        shape = list(present.shape)
+        shape[axis] = max_length
+        return torch.zeros(shape, dtype=present.dtype)
+
+    # The keys are `max_length` cache slots followed by the new token.
+    past_attention_mask = torch.ones(
+        (hidden_states.shape[0], max_length + 1), device="cpu"
+    )
+    past_inputs = (
+        hidden_states[:, -1:].detach(),
+        build_alibi_tensor(
+            past_attention_mask, n_head, hidden_states.dtype, "cpu"
+        ),
+        _prepare_attn_mask(
+            past_attention_mask,
+            (hidden_states.shape[0], 1),
+            inputs_embeds,
+            max_length,
+        ),
+        empty_cache(key, kv_cache_config["key_axis"]),
+        empty_cache(value, kv_cache_config["value_axis"]),
+        torch.zeros(max_length),
+    )
+
     for i, (block, layer_past) in enumerate(
         zip(model.model.transformer.h, past_key_values)
     ):
@@ -621,6 +884,18 @@ def create_mlirs(destination_folder, model_name):
             block_index=i,
             path=f"{destination_folder}/bloom_block_{i}.mlir",
         )
+        compile_with_past_to_mlir(
+            HuggingFaceBlockWithPast(
+                block,
+                kv_cache_config["key_axis"],
+                kv_cache_config["value_axis"],
+            ),
+            past_inputs,
+            path=f"{destination_folder}/bloom_block_{i}_with_past.mlir",
+        )
+
+    with open(f"{destination_folder}/kv_cache.json", "w") as f:
+        json.dump(kv_cache_config, f)
 
     compile_ln_f(
         model.model.transformer.ln_f,
@@ -635,6 +910,28 @@ def create_mlirs(destination_folder, model_name):
     )
 
 
+def benchmark_generation(shardedbloom, input_ids, token_count):
+    # Tokens/s of generating `token_count` tokens, rerunning the blocks on
+    # the whole sequence for every token, and with the kv cache.
+    results = {}
+    for use_cache in [False, True]:
+        # Warms up the devices and every module the run uses.
+        shardedbloom.generate(input_ids, 2, use_cache=use_cache)
+        begin = time.perf_counter()
+        output_ids = shardedbloom.generate(
+            input_ids, token_count, use_cache=use_cache
+        )
+        seconds = time.perf_counter() - begin
+        results[use_cache] = output_ids
+        print(
+            f"{'kv cache' if use_cache else 'full sequence':>14}: "
+            f"{token_count / seconds:.2f} tokens/s ({seconds:.2f} s)"
+        )
+    if not torch.equal(results[False], results[True]):
+        print("WARNING: the kv cache generated different tokens")
+    return results[True]
+
+
 def run_large_model(
     token_count,
     recompile,
@@ -714,6 +1011,9 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--token_count", default=10, type=int)
     parser.add_argument("-m", "--model_name", default="bloom-560m")
     parser.add_argument("-cm", "--create_mlirs", default=False, type=bool)
+    parser.add_argument("-kv", "--kv_cache", default=False, type=bool)
+    parser.add_argument("-ml", "--max_length", default=256, type=int)
+    parser.add_argument("-b", "--benchmark", default=False, type=bool)
 
     parser.add_argument(
         "-lm", "--large_model_memory_efficient", default=False, type=bool
@@ -747,7 +1047,7 @@ if __name__ == "__main__":
     if args.download:
         download_model(args.model_path, args.model_name)
     if args.create_mlirs:
-        create_mlirs(args.model_path, args.model_name)
+        create_mlirs(args.model_path, args.model_name, args.max_length)
     from transformers import AutoTokenizer, AutoModelForCausalLM, BloomConfig
 
     tokenizer = AutoTokenizer.from_pretrained(args.model_path)
@@ -802,17 +1102,19 @@ if __name__ == "__main__":
             device=args.device,
             replace=args.recompile,
             device_idx=args.device_list,
+            kv_cache=args.kv_cache or args.benchmark,
         )
         shardedbloom.load_layers()
 
-        if args.prompt is not None:
-            for _ in range(args.token_count):
-                next_token = shardedbloom.forward_pass(
-                    torch.tensor(input_ids), device=args.device
-                )
-                input_ids = torch.cat(
-                    [input_ids, next_token.unsqueeze(-1)], dim=-1
-                )
+        if args.benchmark:
+            if args.prompt is None:
+                sys.exit("--benchmark needs a --prompt")
+            benchmark_generation(shardedbloom, input_ids, args.token_count)
+
+        elif args.prompt is not None:
+            input_ids = shardedbloom.generate(
+                input_ids, args.token_count, use_cache=args.kv_cache
+            )
 
             print(tokenizer.decode(input_ids.squeeze()))
 
@@ -830,13 +1132,8 @@ if __name__ == "__main__":
                     token_count = 10
 
                 input_ids = tokenizer.encode(prompt, return_tensors="pt")
-
-                for _ in range(token_count):
-                    next_token = shardedbloom.forward_pass(
-                        torch.tensor(input_ids), device=args.device
-                    )
-                    input_ids = torch.cat(
-                        [input_ids, next_token.unsqueeze(-1)], dim=-1
-                    )
+                input_ids = shardedbloom.generate(
+                    input_ids, token_count, use_cache=args.kv_cache
+                )
 
                 print(tokenizer.decode(input_ids.squeeze()))
@@ -0,0 +1,173 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Memory mapped inputs and golden outputs of shark_tank models.
+#
+# The arrays saved under a name, e.g. "inputs", are kept as uncompressed
+# `inputs.<i>.npy` files, whose data numpy aligns to 64 bytes, next to an
+# `inputs.index.json` listing them. They are opened with mmap, so processes
+# share the page cache instead of each holding a copy. Legacy `inputs.npz`
+# archives are converted on first use, or ahead of time with
+#
+#   python -m shark.golden_arrays <tank_dir> [--remove_npz]
+import argparse
+import json
+import os
+import tempfile
+
+import numpy as np
+
+GOLDEN_ARRAY_NAMES = ("inputs", "golden_out")
+
+
+def _index_path(model_dir, name):
+    return os.path.join(model_dir, f"{name}.index.json")
+
+
+def _array_path(model_dir, name, i):
+    return os.path.join(model_dir, f"{name}.{i}.npy")
+
+
+def _file_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _write_atomic(path, write):
+    # Readers in other processes never see a partially written file.
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def has_arrays(model_dir, name):
+    return os.path.isfile(_index_path(model_dir, name)) or os.path.isfile(
+        os.path.join(model_dir, f"{name}.npz")
+    )
+
+
+def save_arrays(model_dir, name, arrays, source=None):
+    """
+    Saves `arrays`, an iterable of array-likes, as `name` in `model_dir`.
+    `source` is the stat of the .npz archive they were converted from.
+    """
+    count = 0
+    for i, array in enumerate(arrays):
+        array = np.asarray(array)
+        _write_atomic(
+            _array_path(model_dir, name, i),
+            lambda f: np.save(f, array),
+        )
+        count += 1
+    index = {"count": count, "source": source}
+    _write_atomic(
+        _index_path(model_dir, name),
+        lambda f: f.write(json.dumps(index).encode("utf-8")),
+    )
+
+
+def convert_npz(model_dir, name, remove_npz=False):
+    # Converts one array at a time, so at most one is in memory.
+    npz_path = os.path.join(model_dir, f"{name}.npz")
+    source = _file_stat(npz_path)
+    with np.load(npz_path) as npz:
+        save_arrays(
+            model_dir, name, (npz[key] for key in npz.files), source=source
+        )
+    if remove_npz:
+        os.remove(npz_path)
+
+
+def _load_index(model_dir, name):
+    try:
+        with open(_index_path(model_dir, name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _load_array(path, mmap_mode):
+    try:
+        return np.load(path, mmap_mode=mmap_mode)
+    except ValueError:
+        # Arrays of Python objects can not be mapped.
+        return np.load(path, allow_pickle=True)
+
+
+def load_arrays(model_dir, name, mmap_mode="r"):
+    """
+    Returns the arrays saved as `name` in `model_dir` as a tuple of read
+    only memory maps, converting `name`.npz first if it is newer.
+    """
+    index = _load_index(model_dir, name)
+    npz_stat = _file_stat(os.path.join(model_dir, f"{name}.npz"))
+    if npz_stat is not None and (index is None or index["source"] != npz_stat):
+        convert_npz(model_dir, name)
+        index = _load_index(model_dir, name)
+    if index is None:
+        raise FileNotFoundError(f"No {name} arrays found in {model_dir}")
+    return tuple(
+        _load_array(_array_path(model_dir, name, i), mmap_mode)
+        for i in range(index["count"])
+    )
+
+
+def migrate_tank(tank_dir, remove_npz=False):
+    """
+    Converts the .npz archives of every model directory in `tank_dir`.
+    Returns the number of archives converted.
+    """
+    converted = 0
+    for root, _, files in os.walk(tank_dir):
+        for name in GOLDEN_ARRAY_NAMES:
+            if f"{name}.npz" not in files:
+                continue
+            index = _load_index(root, name)
+            npz_stat = _file_stat(os.path.join(root, f"{name}.npz"))
+            if index is None or index["source"] != npz_stat:
+                print(f"Converting {os.path.join(root, name)}.npz")
+                convert_npz(root, name, remove_npz)
+                converted += 1
+            elif remove_npz:
+                os.remove(os.path.join(root, f"{name}.npz"))
+    return converted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Converts the inputs.npz and golden_out.npz archives of "
+        "a shark_tank directory into memory mappable .npy files."
+    )
+    parser.add_argument("tank_dirs", nargs="+")
+    parser.add_argument(
+        "--remove_npz",
+        default=False,
+        action="store_true",
+        help="Remove the archives once converted. Only for tank directories "
+        "that are not updated from upstream, which would download them "
+        "again.",
+    )
+    args = parser.parse_args()
+    converted = sum(migrate_tank(d, args.remove_npz) for d in args.tank_dirs)
+    print(f"Converted {converted} archives.")
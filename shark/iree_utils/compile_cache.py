@@ -0,0 +1,220 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Content-addressed on-disk cache of compiled .vmfb flatbuffers.
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Compiler flags that make iree-compile write side artifacts. A cache hit
+# would silently skip producing them, so such compiles are never cached.
+_UNCACHEABLE_FLAG_PREFIXES = (
+    "--iree-hal-dump-executable",
+    "--mlir-print-ir",
+    "--iree-hal-benchmark-dispatch-repeat-count",
+)
+
+
+@functools.cache
+def get_iree_compiler_version():
+    try:
+        from iree.compiler.version import VERSION, REVISIONS
+
+        return f"{VERSION}:{REVISIONS}"
+    except ImportError:
+        pass
+    try:
+        from importlib.metadata import version
+
+        return version("iree-compiler")
+    except Exception:
+        return "unknown"
+
+
+def _hash_module(module, hasher):
+    if isinstance(module, bytes):
+        hasher.update(module)
+    elif isinstance(module, str) and os.path.isfile(module):
+        with open(module, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(chunk)
+    elif isinstance(module, str):
+        hasher.update(module.encode("utf-8"))
+    else:
+        # MLIR python objects etc. have no stable byte representation.
+        return False
+    return True
+
+
+class VmfbCache:
+    """
+    Size-bounded LRU cache of compiled flatbuffers on disk.
+
+    Entries are keyed by a hash of the MLIR contents, the target backend,
+    the input type, the fully resolved compile flags and the compiler
+    version. Each entry is stored as `<key>.vmfb` next to a `<key>.json`
+    describing how it was produced; recency is tracked through the vmfb
+    mtime so that it survives process restarts.
+    """
+
+    def __init__(self, cache_dir: str, max_size_bytes: int = None):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def make_key(self, module, target_backend, input_type, compile_args):
+        """Returns the cache key for a compile, or None if uncacheable."""
+        if any(
+            flag.startswith(_UNCACHEABLE_FLAG_PREFIXES)
+            for flag in compile_args
+        ):
+            return None
+        hasher = hashlib.sha256()
+        if not _hash_module(module, hasher):
+            return None
+        hasher.update(b"\0")
+        hasher.update(
+            json.dumps(
+                {
+                    "target_backend": target_backend,
+                    "input_type": str(input_type),
+                    "compile_args": list(compile_args),
+                    "compiler_version": get_iree_compiler_version(),
+                },
+                sort_keys=True,
+            ).encode("utf-8")
+        )
+        return hasher.hexdigest()
+
+    def _vmfb_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.vmfb")
+
+    def _meta_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def lookup(self, key):
+        """Returns the path of the cached vmfb for `key`, or None."""
+        path = self._vmfb_path(key)
+        with self._lock:
+            if os.path.isfile(path):
+                self.hits += 1
+                # Bump recency for LRU eviction.
+                os.utime(path, None)
+                print(f"[compile cache] hit: {path}")
+                return path
+            self.misses += 1
+        return None
+
+    def store(self, key, flatbuffer_blob, metadata: dict = None):
+        """Writes `flatbuffer_blob` under `key` and returns its path."""
+        path = self._vmfb_path(key)
+        # Write to a temporary file first so that concurrent readers never
+        # observe a partially written vmfb.
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(flatbuffer_blob)
+        os.replace(tmp_path, path)
+        meta = dict(metadata or {})
+        meta["size"] = len(flatbuffer_blob)
+        meta["created"] = time.time()
+        with open(self._meta_path(key), "w") as f:
+            json.dump(meta, f, indent=2)
+        print(f"[compile cache] stored: {path}")
+        self.evict()
+        return path
+
+    def entries(self):
+        """Returns (mtime, size, key) for every entry, oldest first."""
+        entries = []
+        for f_ in os.listdir(self.cache_dir):
+            if not f_.endswith(".vmfb"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, f_))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, f_[: -len(".vmfb")]))
+        return sorted(entries)
+
+    def size_bytes(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def remove(self, key):
+        for path in (self._vmfb_path(key), self._meta_path(key)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def evict(self):
+        """Drops least recently used entries until under the size bound."""
+        if self.max_size_bytes is None:
+            return
+        with self._lock:
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            # Always keep the most recent entry, even if it alone is larger
+            # than the budget, so that the caller can still load it.
+            for _, size, key in entries[:-1]:
+                if total <= self.max_size_bytes:
+                    break
+                self.remove(key)
+                total -= size
+                self.evictions += 1
+                print(f"[compile cache] evicted: {key}")
+
+    def clear(self):
+        for _, _, key in self.entries():
+            self.remove(key)
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "size_bytes": sum(size for _, size, _ in entries),
+            "max_size_bytes": self.max_size_bytes,
+        }
+
+
+_vmfb_cache = None
+
+
+def get_vmfb_cache():
+    """Returns the process-wide cache configured via shark_args, if any."""
+    global _vmfb_cache
+    from shark.parser import shark_args
+
+    cache_dir = shark_args.compile_cache_dir
+    if cache_dir is None:
+        return None
+    max_size_bytes = (
+        int(shark_args.compile_cache_max_size_gb * (1 << 30))
+        if shark_args.compile_cache_max_size_gb is not None
+        else None
+    )
+    if _vmfb_cache is None or _vmfb_cache.cache_dir != os.path.abspath(
+        os.path.expanduser(cache_dir)
+    ):
+        _vmfb_cache = VmfbCache(cache_dir, max_size_bytes)
+    _vmfb_cache.max_size_bytes = max_size_bytes
+    return _vmfb_cache
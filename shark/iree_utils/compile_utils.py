@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import functools
 import numpy as np
 import os
@@ -25,6 +26,14 @@ from shark.parser import shark_args
 from .trace import DetailLogger
 from ._common import iree_device_map, iree_target_map
 from .cpu_utils import get_iree_cpu_rt_args
+from .compile_cache import get_vmfb_cache, get_iree_compiler_version
+from .dispatch_benchmarks import (
+    DispatchBenchmarkCache,
+    build_dispatch_report,
+    get_dispatch_hash,
+    load_dispatch_report,
+    write_dispatch_report,
+)
 from .benchmark_utils import *
 
 
@@ -148,7 +157,12 @@ def get_model_specific_args():
 
 
 def create_dispatch_dirs(bench_dir, device):
-    protected_files = ["ordered-dispatches.txt"]
+    protected_files = [
+        "ordered-dispatches.txt",
+        "dispatch-report.json",
+        "dispatch-report.csv",
+        "dispatch-benchmark-cache.json",
+    ]
     bench_dir_path = bench_dir.split("/")
     bench_dir_path[-1] = "temp_" + bench_dir_path[-1]
     tmp_bench_dir = "/".join(bench_dir_path)
@@ -182,8 +196,95 @@ def dump_isas(bench_dir):
                     )
 
 
+def _compile_dispatch_dir(bench_dir, d_, device):
+    # Compiles the sources dumped for one dispatch, and returns whether it
+    # has a benchmark module. Runs on the compile_benchmark_dirs pool.
+    has_benchmark = False
+    for f_ in os.listdir(f"{bench_dir}/{d_}"):
+        if "benchmark.mlir" in f_:
+            dispatch_file = open(f"{bench_dir}/{d_}/{f_}", "r")
+            module = dispatch_file.read()
+            dispatch_file.close()
+
+            flatbuffer_blob = ireec.compile_str(
+                module, target_backends=[iree_target_map(device)]
+            )
+
+            vmfb_file = open(f"{bench_dir}/{d_}/{d_}_benchmark.vmfb", "wb")
+            vmfb_file.write(flatbuffer_blob)
+            vmfb_file.close()
+            has_benchmark = True
+
+        elif ".mlir" in f_ and "benchmark" not in f_:
+            dispatch_file = open(f"{bench_dir}/{d_}/{f_}", "r")
+            module = dispatch_file.read()
+            dispatch_file.close()
+
+            module = re.sub(
+                "hal.executable private",
+                "hal.executable public",
+                module,
+            )
+
+            flatbuffer_blob = ireec.compile_str(
+                module,
+                target_backends=[iree_target_map(device)],
+                extra_args=["--compile-mode=hal-executable"],
+            )
+
+            spirv_file = open(f"{bench_dir}/{d_}/{d_}_spirv.vmfb", "wb")
+            spirv_file.write(flatbuffer_blob)
+            spirv_file.close()
+    return has_benchmark
+
+
+def _run_dispatch_benchmark(bench_dir, d_, device):
+    # Returns the runtime of the dispatch in ms.
+    benchmark_cl = build_benchmark_args_non_tensor_input(
+        input_file=f"{bench_dir}/{d_}/{d_}_benchmark.vmfb",
+        device=device,
+        inputs=(0,),
+        mlir_dialect="linalg",
+        function_name="",
+    )
+
+    benchmark_bash = open(f"{bench_dir}/{d_}/{d_}_benchmark.sh", "w+")
+    benchmark_bash.write("#!/bin/bash\n")
+    benchmark_bash.write(" ".join(benchmark_cl))
+    benchmark_bash.close()
+
+    iter_per_second, _, _ = run_benchmark_module(benchmark_cl)
+    return 1 / (iter_per_second * 0.001)
+
+
+def _write_dispatch_data(bench_dir, d_, runtime_ms):
+    benchmark_file = open(f"{bench_dir}/{d_}/{d_}_data.txt", "w+")
+    benchmark_file.write(f"DISPATCH: {d_}\n")
+    benchmark_file.write(str(1 / (runtime_ms * 0.001)) + "\n")
+    benchmark_file.write("SHARK BENCHMARK RESULT: " + str(runtime_ms) + "\n")
+    benchmark_file.close()
+
+
+def _read_dispatch_benchmark_source(bench_dir, d_):
+    for f_ in os.listdir(f"{bench_dir}/{d_}"):
+        if "benchmark.mlir" in f_:
+            with open(f"{bench_dir}/{d_}/{f_}", "r") as dispatch_file:
+                return dispatch_file.read()
+    return None
+
+
 def compile_benchmark_dirs(bench_dir, device, dispatch_benchmarks):
-    benchmark_runtimes = {}
+    """
+    Compiles and benchmarks the dispatches dumped to `bench_dir`, and writes
+    dispatch-report.json/.csv and ordered-dispatches.txt with the dispatches
+    ordered by runtime.
+
+    Dispatches are compiled on a pool of --dispatch_benchmarks_jobs
+    iree-compile processes. The benchmarks themselves run one at a time, as
+    they would disturb each others timings. Runtimes are cached by the hash
+    of the dispatch benchmark source, dispatches that did not change since
+    an earlier build are neither compiled nor benchmarked again.
+    """
     dispatch_list = []
     all_dispatches = False
 
@@ -198,114 +299,84 @@ def compile_benchmark_dirs(bench_dir, device, dispatch_benchmarks):
         except:
             print("ERROR: Invalid dispatch benchmarks")
             return None
+
+    cache = DispatchBenchmarkCache(
+        shark_args.dispatch_benchmarks_cache
+        or f"{bench_dir}/dispatch-benchmark-cache.json"
+    )
+    results = []
+    to_compile = []
     for d_ in os.listdir(bench_dir):
         if os.path.isdir(f"{bench_dir}/{d_}"):
             in_dispatches = False
             for dispatch in dispatch_list:
                 if str(dispatch) in d_:
                     in_dispatches = True
-            if all_dispatches or in_dispatches:
-                for f_ in os.listdir(f"{bench_dir}/{d_}"):
-                    if "benchmark.mlir" in f_:
-                        dispatch_file = open(f"{bench_dir}/{d_}/{f_}", "r")
-                        module = dispatch_file.read()
-                        dispatch_file.close()
-
-                        flatbuffer_blob = ireec.compile_str(
-                            module, target_backends=[iree_target_map(device)]
-                        )
-
-                        vmfb_file = open(
-                            f"{bench_dir}/{d_}/{d_}_benchmark.vmfb", "wb"
-                        )
-                        vmfb_file.write(flatbuffer_blob)
-                        vmfb_file.close()
-
-                        config = get_iree_runtime_config(device)
-                        vm_module = ireert.VmModule.from_buffer(
-                            config.vm_instance,
-                            flatbuffer_blob,
-                            warn_if_copy=False,
-                        )
-
-                        benchmark_cl = build_benchmark_args_non_tensor_input(
-                            input_file=f"{bench_dir}/{d_}/{d_}_benchmark.vmfb",
-                            device=device,
-                            inputs=(0,),
-                            mlir_dialect="linalg",
-                            function_name="",
-                        )
-
-                        benchmark_bash = open(
-                            f"{bench_dir}/{d_}/{d_}_benchmark.sh", "w+"
-                        )
-                        benchmark_bash.write("#!/bin/bash\n")
-                        benchmark_bash.write(" ".join(benchmark_cl))
-                        benchmark_bash.close()
-
-                        iter_per_second, _, _ = run_benchmark_module(
-                            benchmark_cl
-                        )
-
-                        benchmark_file = open(
-                            f"{bench_dir}/{d_}/{d_}_data.txt", "w+"
-                        )
-                        benchmark_file.write(f"DISPATCH: {d_}\n")
-                        benchmark_file.write(str(iter_per_second) + "\n")
-                        benchmark_file.write(
-                            "SHARK BENCHMARK RESULT: "
-                            + str(1 / (iter_per_second * 0.001))
-                            + "\n"
-                        )
-                        benchmark_file.close()
-
-                        benchmark_runtimes[d_] = 1 / (iter_per_second * 0.001)
-
-                    elif ".mlir" in f_ and "benchmark" not in f_:
-                        dispatch_file = open(f"{bench_dir}/{d_}/{f_}", "r")
-                        module = dispatch_file.read()
-                        dispatch_file.close()
-
-                        module = re.sub(
-                            "hal.executable private",
-                            "hal.executable public",
-                            module,
-                        )
-
-                        flatbuffer_blob = ireec.compile_str(
-                            module,
-                            target_backends=[iree_target_map(device)],
-                            extra_args=["--compile-mode=hal-executable"],
-                        )
-
-                        spirv_file = open(
-                            f"{bench_dir}/{d_}/{d_}_spirv.vmfb", "wb"
-                        )
-                        spirv_file.write(flatbuffer_blob)
-                        spirv_file.close()
-
-    ordered_dispatches = [
-        (k, v)
-        for k, v in sorted(
-            benchmark_runtimes.items(), key=lambda item: item[1]
+            if not (all_dispatches or in_dispatches):
+                continue
+            source = _read_dispatch_benchmark_source(bench_dir, d_)
+            key = None if source is None else get_dispatch_hash(source, device)
+            runtime_ms = None if key is None else cache.lookup(key)
+            if runtime_ms is None:
+                to_compile.append((d_, key))
+                continue
+            _write_dispatch_data(bench_dir, d_, runtime_ms)
+            results.append(
+                {
+                    "dispatch": d_,
+                    "hash": key,
+                    "runtime_ms": runtime_ms,
+                    "cached": True,
+                }
+            )
+
+    print(
+        f"Dispatch benchmarks: {len(results)} cached, "
+        f"{len(to_compile)} to compile"
+    )
+    with ThreadPoolExecutor(
+        shark_args.dispatch_benchmarks_jobs or os.cpu_count()
+    ) as executor:
+        futures = {
+            executor.submit(_compile_dispatch_dir, bench_dir, d_, device): (
+                d_,
+                key,
+            )
+            for d_, key in to_compile
+        }
+        for future in as_completed(futures):
+            d_, key = futures[future]
+            if not future.result():
+                continue
+            runtime_ms = _run_dispatch_benchmark(bench_dir, d_, device)
+            _write_dispatch_data(bench_dir, d_, runtime_ms)
+            cache.store(key, d_, runtime_ms)
+            results.append(
+                {
+                    "dispatch": d_,
+                    "hash": key,
+                    "runtime_ms": runtime_ms,
+                    "cached": False,
+                }
+            )
+    cache.save()
+
+    report = build_dispatch_report(
+        results,
+        load_dispatch_report(shark_args.dispatch_benchmarks_baseline),
+        shark_args.dispatch_benchmarks_regression_threshold,
+    )
+    write_dispatch_report(report, bench_dir)
+    if report["regressions"]:
+        print(
+            f"[WARNING] {len(report['regressions'])} dispatches regressed "
+            f"against the baseline: {', '.join(report['regressions'])}"
         )
-    ][::-1]
-    f_ = open(f"{bench_dir}/ordered-dispatches.txt", "w+")
-    for dispatch in ordered_dispatches:
-        f_.write(f"{dispatch[0]}: {dispatch[1]}ms\n")
-    f_.close()
+    return report
 
 
-def compile_module_to_flatbuffer(
-    module,
-    device,
-    frontend,
-    model_config_path,
-    extra_args,
-    model_name="None",
-    debug=False,
-    compile_str=False,
-):
+# Get the fully resolved iree-compile arguments and input type.
+def get_iree_compile_args(device, frontend, extra_args=[], debug=False):
     # Setup Compile arguments wrt to frontends.
     input_type = "auto"
     args = get_iree_frontend_args(frontend)
@@ -325,6 +396,27 @@ def compile_module_to_flatbuffer(
         input_type = ireec.InputType.TM_TENSOR
     elif frontend in ["torch", "pytorch"]:
         input_type = "torch"
+    return args, input_type
+
+
+def compile_module_to_flatbuffer(
+    module,
+    device,
+    frontend,
+    model_config_path,
+    extra_args,
+    model_name="None",
+    debug=False,
+    compile_str=False,
+    compile_args=None,
+):
+    # `compile_args` lets callers pass the (args, input_type) pair they
+    # already resolved through `get_iree_compile_args`.
+    if compile_args is None:
+        compile_args = get_iree_compile_args(
+            device, frontend, extra_args, debug=debug
+        )
+    args, input_type = compile_args
 
     if compile_str:
         flatbuffer_blob = ireec.compile_str(
@@ -352,18 +444,8 @@ def get_iree_module(
     for flag in rt_flags:
         ireert.flags.parse_flag(flag)
     if device_idx is not None:
-        device = iree_device_map(device)
         print("registering device id: ", device_idx)
-        haldriver = ireert.get_driver(device)
-        hal_device_id = haldriver.query_available_devices()[device_idx][
-            "device_id"
-        ]
-        haldevice = haldriver.create_device(
-            hal_device_id,
-            allocators=shark_args.device_allocator,
-        )
-        config = ireert.Config(device=haldevice)
-        config.id = hal_device_id
+        config = get_iree_indexed_device_config(device, device_idx)
     else:
         config = get_iree_runtime_config(device)
     vm_module = ireert.VmModule.from_buffer(
@@ -399,19 +481,7 @@ def load_vmfb_using_mmap(
         if device_idx is not None:
             dl.log(f"Mapping device id: {device_idx}")
             device = iree_device_map(device)
-            haldriver = ireert.get_driver(device)
-            dl.log(f"ireert.get_driver()")
-
-            hal_device_id = haldriver.query_available_devices()[device_idx][
-                "device_id"
-            ]
-            haldevice = haldriver.create_device(
-                hal_device_id,
-                allocators=shark_args.device_allocator,
-            )
-            dl.log(f"ireert.create_device()")
-            config = ireert.Config(device=haldevice)
-            config.id = hal_device_id
+            config = get_iree_indexed_device_config(device, device_idx)
             dl.log(f"ireert.Config()")
         else:
             config = get_iree_runtime_config(device)
@@ -477,6 +547,48 @@ def get_iree_compiled_module(
     compile_str: bool = False,
 ):
     """Given a module returns the compiled .vmfb and configs"""
+    compile_cache = get_vmfb_cache()
+    if compile_cache is not None:
+        compile_args = get_iree_compile_args(
+            device, frontend, extra_args, debug=debug
+        )
+        cache_key = compile_cache.make_key(
+            module, iree_target_map(device), *compile_args
+        )
+        if cache_key is not None:
+            # Cached modules are always mmapped straight from the cache.
+            vmfb_path = compile_cache.lookup(cache_key)
+            if vmfb_path is None:
+                flatbuffer_blob = compile_module_to_flatbuffer(
+                    module=module,
+                    device=device,
+                    frontend=frontend,
+                    model_config_path=model_config_path,
+                    extra_args=extra_args,
+                    debug=debug,
+                    compile_str=compile_str,
+                    compile_args=compile_args,
+                )
+                vmfb_path = compile_cache.store(
+                    cache_key,
+                    flatbuffer_blob,
+                    metadata={
+                        "target_backend": iree_target_map(device),
+                        "frontend": frontend,
+                        "compile_args": compile_args[0],
+                        "compiler_version": get_iree_compiler_version(),
+                    },
+                )
+                del flatbuffer_blob
+            vmfb, config, temp_file_to_unlink = load_vmfb_using_mmap(
+                vmfb_path, device, device_idx, rt_flags
+            )
+            return {
+                "vmfb": vmfb,
+                "config": config,
+                "temp_file_to_unlink": temp_file_to_unlink,
+            }
+
     flatbuffer_blob = compile_module_to_flatbuffer(
         module=module,
         device=device,
@@ -613,28 +725,64 @@ def get_results(
         dl.log(f"Invoke function: {function_name}")
         result = compiled_vm[function_name](*device_inputs)
         dl.log(f"Invoke complete")
-        result_tensors = []
-        if isinstance(result, tuple):
-            if send_to_host:
-                for val in result:
-                    dl.log(f"Result to host: {val.shape}")
-                    result_tensors.append(np.asarray(val, val.dtype))
-            else:
-                for val in result:
-                    result_tensors.append(val)
-            return result_tensors
-        elif isinstance(result, dict):
-            data = list(result.items())
-            if send_to_host:
-                res = np.array(data, dtype=object)
-                return np.copy(res)
-            return data
+        return results_to_host(result, send_to_host, dl)
+
+
+def results_to_host(result, send_to_host=True, dl=None):
+    """Converts the raw results of an invocation to what get_results returns."""
+    log = dl.log if dl is not None else lambda msg: None
+    result_tensors = []
+    if isinstance(result, tuple):
+        if send_to_host:
+            for val in result:
+                log(f"Result to host: {val.shape}")
+                result_tensors.append(np.asarray(val, val.dtype))
         else:
-            if send_to_host and result is not None:
-                dl.log("Result to host")
-                return result.to_host()
-            return result
-        dl.log("Execution complete")
+            for val in result:
+                result_tensors.append(val)
+        return result_tensors
+    elif isinstance(result, dict):
+        data = list(result.items())
+        if send_to_host:
+            res = np.array(data, dtype=object)
+            return np.copy(res)
+        return data
+    else:
+        if send_to_host and result is not None:
+            log("Result to host")
+            return result.to_host()
+        return result
+
+
+def get_iree_indexed_device_config(device, device_idx):
+    # Returns the config for the `device_idx`-th device of the driver.
+    device = iree_device_map(device)
+    haldriver = ireert.get_driver(device)
+    available_devices = haldriver.query_available_devices()
+    if device_idx >= len(available_devices) and device.startswith("local"):
+        return get_iree_local_device_instance_config(device, device_idx)
+    hal_device_id = available_devices[device_idx]["device_id"]
+    haldevice = haldriver.create_device(
+        hal_device_id,
+        allocators=shark_args.device_allocator,
+    )
+    config = ireert.Config(device=haldevice)
+    config.id = hal_device_id
+    return config
+
+
+@functools.cache
+def get_iree_local_device_instance_config(device, device_idx):
+    # The local (cpu) drivers expose a single device. Further device indices
+    # each get their own instance of it, shared by all modules mapped to that
+    # index, which allows running multi-device setups on cpu.
+    haldriver = ireert.get_driver(device)
+    haldevice = haldriver.create_default_device(
+        allocators=shark_args.device_allocator,
+    )
+    config = ireert.Config(device=haldevice)
+    config.id = device_idx
+    return config
 
 
 @functools.cache
@@ -649,9 +797,9 @@ def get_iree_runtime_config(device):
     haldevice = haldriver.create_device_by_uri(
         device,
         # metal devices have a failure with caching allocators atm. blcking this util it gets fixed upstream.
-        allocators=shark_args.device_allocator
-        if "metal" not in device
-        else None,
+        allocators=(
+            shark_args.device_allocator if "metal" not in device else None
+        ),
     )
     config = ireert.Config(device=haldevice)
     return config
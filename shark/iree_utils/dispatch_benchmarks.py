@@ -0,0 +1,140 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Caching and reporting of per dispatch benchmark results.
+import csv
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from .compile_cache import get_iree_compiler_version
+
+REPORT_FIELDS = [
+    "dispatch",
+    "runtime_ms",
+    "share",
+    "cached",
+    "baseline_ms",
+    "change",
+    "regression",
+    "hash",
+]
+
+
+def get_dispatch_hash(module, device):
+    # Identifies the benchmark of one dispatch across builds.
+    hasher = hashlib.sha256()
+    for part in (module, device, get_iree_compiler_version()):
+        hasher.update(part.encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+class DispatchBenchmarkCache:
+    """
+    JSON file mapping dispatch hashes to their measured runtime, so that
+    dispatches that did not change are not compiled and benchmarked again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                print(f"Ignoring unreadable dispatch benchmark cache {path}")
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        return None if entry is None else entry["runtime_ms"]
+
+    def store(self, key, dispatch, runtime_ms):
+        self.entries[key] = {
+            "dispatch": dispatch,
+            "runtime_ms": runtime_ms,
+            "time": time.time(),
+        }
+
+    def save(self):
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def build_dispatch_report(results, baseline=None, regression_threshold=0.05):
+    """
+    Builds the report for `results`, a list of dicts with the "dispatch",
+    "hash", "runtime_ms" and "cached" of every benchmarked dispatch.
+
+    `baseline` is a report of an earlier build. A dispatch regressed if it
+    got slower than its baseline runtime by more than `regression_threshold`
+    (relative). The share of a dispatch is relative to the summed runtime
+    of all benchmarked dispatches.
+    """
+    baseline_ms = {}
+    if baseline is not None:
+        baseline_ms = {
+            entry["dispatch"]: entry["runtime_ms"]
+            for entry in baseline["dispatches"]
+        }
+    total_ms = sum(result["runtime_ms"] for result in results)
+    dispatches = []
+    for result in sorted(results, key=lambda r: r["runtime_ms"], reverse=True):
+        entry = {
+            "dispatch": result["dispatch"],
+            "runtime_ms": result["runtime_ms"],
+            "share": result["runtime_ms"] / total_ms if total_ms else 0.0,
+            "cached": result["cached"],
+            "baseline_ms": baseline_ms.get(result["dispatch"]),
+            "change": None,
+            "regression": False,
+            "hash": result["hash"],
+        }
+        if entry["baseline_ms"]:
+            entry["change"] = entry["runtime_ms"] / entry["baseline_ms"] - 1
+            entry["regression"] = entry["change"] > regression_threshold
+        dispatches.append(entry)
+    return {
+        "compiler_version": get_iree_compiler_version(),
+        "total_ms": total_ms,
+        "regression_threshold": regression_threshold,
+        "regressions": [d["dispatch"] for d in dispatches if d["regression"]],
+        "dispatches": dispatches,
+    }
+
+
+def write_dispatch_report(report, bench_dir):
+    with open(f"{bench_dir}/dispatch-report.json", "w") as f:
+        json.dump(report, f, indent=1)
+    with open(f"{bench_dir}/dispatch-report.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(report["dispatches"])
+    with open(f"{bench_dir}/ordered-dispatches.txt", "w+") as f:
+        for dispatch in report["dispatches"]:
+            f.write(f"{dispatch['dispatch']}: {dispatch['runtime_ms']}ms\n")
+
+
+def load_dispatch_report(path):
+    if path is None:
+        return None
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,126 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Asynchronous, pipelined invocation of compiled IREE modules.
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import numpy as np
+import iree.runtime as ireert
+
+from .compile_utils import results_to_host
+
+
+def is_host_mappable(device_array):
+    # to_host() of any other array returns a host copy, so writing to it
+    # would not reach the device buffer. That is the case for device local
+    # memory, and for arrays converted from another dtype on the host.
+    is_mappable = getattr(device_array, "_is_mappable", None)
+    if is_mappable is None or not is_mappable():
+        return False
+    override_dtype = getattr(device_array, "_override_dtype", None)
+    return (
+        override_dtype is None
+        or override_dtype == device_array._get_raw_dtype()
+    )
+
+
+class DeviceBufferPool:
+    """
+    Pool of device input buffers keyed by (argument index, shape, dtype).
+
+    A buffer is handed out by `acquire` and only becomes reusable once it
+    is given back through `release`, i.e. after the invocation that read
+    it has completed. Only host mappable buffers are pooled and refilled
+    in place; inputs that cannot be mapped are uploaded anew every time.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.reused = 0
+        self.allocated = 0
+        self._free = defaultdict(list)
+        self._unmappable = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, index, host_array):
+        host_array = np.ascontiguousarray(host_array)
+        key = (index, host_array.shape, host_array.dtype.str)
+        with self._lock:
+            device_array = self._free[key].pop() if self._free[key] else None
+        if device_array is not None:
+            # A view over the device buffer, so this updates it in place.
+            np.copyto(device_array.to_host(), host_array)
+            self.reused += 1
+            return key, device_array
+        self.allocated += 1
+        device_array = ireert.asdevicearray(self.device, host_array)
+        if not is_host_mappable(device_array):
+            with self._lock:
+                self._unmappable.add(key)
+        return key, device_array
+
+    def release(self, staged):
+        with self._lock:
+            for key, device_array in staged:
+                if key not in self._unmappable:
+                    self._free[key].append(device_array)
+
+
+class PipelinedInvoker:
+    """
+    Runs invocations of a compiled module through a three stage pipeline.
+
+    Every `submit` call returns a `concurrent.futures.Future`. Inputs of
+    a request are copied to the device on the upload thread while the
+    previous request is still executing, and its outputs are copied back
+    to host on the download thread while the next one executes. Requests
+    complete in submission order.
+    """
+
+    def __init__(self, compiled_vm, config):
+        self.compiled_vm = compiled_vm
+        self.config = config
+        self.buffer_pool = DeviceBufferPool(config.device)
+        self._upload = ThreadPoolExecutor(1, "shark_upload")
+        self._invoke = ThreadPoolExecutor(1, "shark_invoke")
+        self._download = ThreadPoolExecutor(1, "shark_download")
+
+    def _stage_inputs(self, inputs):
+        return [
+            self.buffer_pool.acquire(index, input_array)
+            for index, input_array in enumerate(inputs)
+        ]
+
+    def _run(self, function_name, staged_future):
+        staged = staged_future.result()
+        try:
+            return self.compiled_vm[function_name](
+                *[device_array for _, device_array in staged]
+            )
+        finally:
+            self.buffer_pool.release(staged)
+
+    def _fetch(self, invoke_future, send_to_host):
+        return results_to_host(invoke_future.result(), send_to_host)
+
+    def submit(self, function_name, inputs, send_to_host=True):
+        staged = self._upload.submit(self._stage_inputs, inputs)
+        invoked = self._invoke.submit(self._run, function_name, staged)
+        return self._download.submit(self._fetch, invoked, send_to_host)
+
+    def shutdown(self, wait=True):
+        for executor in (self._upload, self._invoke, self._download):
+            executor.shutdown(wait=wait)
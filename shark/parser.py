@@ -75,6 +75,49 @@ parser.add_argument(
     default=100,
     help="Run the model for the specified number of iterations.",
 )
+parser.add_argument(
+    "--statistical_benchmark",
+    default=False,
+    action=argparse.BooleanOptionalAction,
+    help="Benchmark shark_python per iteration until the mean latency is "
+    "known within --benchmark_ci_target, reporting median/p90/p99 and the "
+    "host to device, invoke and device to host phases. --num_iterations is "
+    "then the minimum number of iterations.",
+)
+parser.add_argument(
+    "--benchmark_ci_target",
+    type=float,
+    default=0.02,
+    help="Relative half width of the 95% confidence interval of the mean "
+    "latency at which --statistical_benchmark stops.",
+)
+parser.add_argument(
+    "--benchmark_max_iterations",
+    type=int,
+    default=10000,
+    help="Maximum number of iterations of --statistical_benchmark.",
+)
+parser.add_argument(
+    "--benchmark_max_seconds",
+    type=float,
+    default=60,
+    help="Maximum number of seconds --statistical_benchmark runs a model.",
+)
+parser.add_argument(
+    "--benchmark_stats_path",
+    type=str,
+    default="bench_results_stats.jsonl",
+    help="JSON lines file the --statistical_benchmark statistics are "
+    "appended to, next to the bench_results.csv rows.",
+)
+parser.add_argument(
+    "--benchmark_history_db",
+    type=str,
+    default=None,
+    help="SQLite benchmark history (see shark/benchmark_history.py) that "
+    "every bench_results.csv row is also added to, with the git revision "
+    "and compile flags.",
+)
 parser.add_argument(
     "--onnx_bench",
     default=False,
@@ -103,6 +146,18 @@ parser.add_argument(
     default=None,
     help="Specify where to save downloaded shark_tank artifacts. If this is not set, the default is ~/.local/shark_tank/.",
 )
+parser.add_argument(
+    "--tank_download_workers",
+    type=int,
+    default=8,
+    help="Number of threads downloading shark_tank artifacts in parallel.",
+)
+parser.add_argument(
+    "--tank_manifest_ttl",
+    type=float,
+    default=86400,
+    help="Seconds for which shark_tank artifacts checked against upstream are used without checking again. Set to 0 to check on every download_model call.",
+)
 
 parser.add_argument(
     "--dispatch_benchmarks",
@@ -116,6 +171,45 @@ parser.add_argument(
     help='directory where you want to store dispatch data generated with "--dispatch_benchmarks"',
 )
 
+parser.add_argument(
+    "--dispatch_benchmarks_jobs",
+    type=int,
+    default=None,
+    help='Number of dispatches compiled in parallel with "--dispatch_benchmarks". Defaults to the number of cpus.',
+)
+
+parser.add_argument(
+    "--dispatch_benchmarks_cache",
+    default=None,
+    help='JSON file caching dispatch benchmark results across builds. Defaults to dispatch-benchmark-cache.json in "--dispatch_benchmarks_dir".',
+)
+
+parser.add_argument(
+    "--dispatch_benchmarks_baseline",
+    default=None,
+    help="dispatch-report.json of an earlier build to report dispatch regressions against.",
+)
+
+parser.add_argument(
+    "--dispatch_benchmarks_regression_threshold",
+    type=float,
+    default=0.05,
+    help="Relative slowdown against the baseline above which a dispatch is reported as regressed.",
+)
+
+parser.add_argument(
+    "--compile_cache_dir",
+    default=None,
+    help="Directory of the persistent compile cache. Compiled .vmfb files are reused across processes when the MLIR, target and compile flags match. Disabled if not set.",
+)
+
+parser.add_argument(
+    "--compile_cache_max_size_gb",
+    type=float,
+    default=None,
+    help="Size bound of the compile cache in GB. Least recently used entries are evicted beyond it. Unbounded if not set.",
+)
+
 parser.add_argument(
     "--enable_conv_transform",
     default=False,
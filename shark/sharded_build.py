@@ -0,0 +1,360 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Parallel, resumable builds of the layers of sharded models.
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Compiled flatbuffers carry this identifier at byte offset 4.
+_VMFB_IDENTIFIER = b"IREE"
+
+
+def is_valid_vmfb(path):
+    try:
+        with open(path, "rb") as f:
+            header = f.read(8)
+    except OSError:
+        return False
+    return len(header) == 8 and header[4:] == _VMFB_IDENTIFIER
+
+
+class LayerBuild:
+    """
+    One layer of a sharded model. `import_fn(path)` writes the MLIR of the
+    layer to `path`; it is only called if `mlir_path` does not exist. The
+    MLIR is then compiled to `vmfb_path` for `device`.
+    """
+
+    def __init__(
+        self,
+        name,
+        mlir_path,
+        vmfb_path,
+        import_fn=None,
+        device="cpu",
+        mlir_dialect="linalg",
+        extra_args=[],
+        debug=False,
+    ):
+        self.name = name
+        self.mlir_path = str(mlir_path)
+        self.vmfb_path = str(vmfb_path)
+        self.import_fn = import_fn
+        self.device = device
+        self.mlir_dialect = mlir_dialect
+        self.extra_args = list(extra_args)
+        self.debug = debug
+
+
+def _set_memory_limit(memory_limit_gb):
+    if memory_limit_gb is None:
+        return
+    try:
+        import resource
+    except ImportError:
+        print("[build] Memory limits are not supported on this platform")
+        return
+    limit = int(memory_limit_gb * (1 << 30))
+    # Also inherited by the iree-compile processes the worker starts.
+    kind = getattr(resource, "RLIMIT_DATA", resource.RLIMIT_AS)
+    resource.setrlimit(kind, (limit, limit))
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # Bytes on macOS, kilobytes elsewhere.
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def _compile_layer(mlir_path, vmfb_path, target_backend, compile_args):
+    import iree.compiler as ireec
+
+    args, input_type = compile_args
+    begin = time.perf_counter()
+    flatbuffer_blob = ireec.compile_file(
+        mlir_path,
+        input_type=input_type,
+        target_backends=[target_backend],
+        extra_args=args,
+    )
+    _write_atomic(vmfb_path, flatbuffer_blob)
+    return time.perf_counter() - begin, _peak_rss_mb()
+
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp"
+    )
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _file_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _hash_file(path, hasher):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+
+
+class ShardedBuilder:
+    """
+    Imports the layers of a sharded model in order, in this process, while
+    a pool of `num_workers` processes compiles the layers already imported.
+    Every compile worker, and the compiler it runs, is limited to
+    `memory_limit_gb` of memory.
+
+    Layers whose MLIR and compile flags are identical to another layer's
+    are compiled once and the vmfb copied. Layers whose vmfb was built
+    before, as recorded in the build manifest of `build_dir`, are neither
+    imported nor compiled again, so a crashed build resumes where it
+    stopped. Valid vmfbs the manifest does not know of are used as well,
+    unless `trust_unrecorded` is unset.
+    """
+
+    # Runs in the workers: compile_fn(mlir_path, vmfb_path, target_backend,
+    # compile_args) returns the compile time and peak RSS in MB.
+    compile_fn = staticmethod(_compile_layer)
+
+    def __init__(
+        self,
+        build_dir,
+        num_workers=4,
+        memory_limit_gb=None,
+        trust_unrecorded=True,
+    ):
+        self.build_dir = build_dir
+        self.trust_unrecorded = trust_unrecorded
+        self.num_workers = max(1, num_workers)
+        self.memory_limit_gb = memory_limit_gb
+        self.manifest_path = os.path.join(build_dir, "build_manifest.json")
+        self.manifest = {}
+        if os.path.isfile(self.manifest_path):
+            try:
+                with open(self.manifest_path) as f:
+                    self.manifest = json.load(f)
+            except (OSError, ValueError):
+                print(f"[build] Ignoring unreadable {self.manifest_path}")
+
+    def _save_manifest(self):
+        _write_atomic(
+            self.manifest_path,
+            json.dumps(self.manifest, indent=1).encode("utf-8"),
+        )
+
+    def _record(self, build, key):
+        stat = os.stat(build.vmfb_path)
+        self.manifest[os.path.abspath(build.vmfb_path)] = {
+            "key": key,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "mlir": _file_stat(build.mlir_path),
+        }
+        self._save_manifest()
+
+    def is_built(self, build):
+        if not is_valid_vmfb(build.vmfb_path):
+            return False
+        entry = self.manifest.get(os.path.abspath(build.vmfb_path))
+        if entry is None:
+            # Not built here, e.g. downloaded or from before the manifest.
+            return self.trust_unrecorded
+        # Neither the vmfb nor the MLIR it was built from may have changed.
+        stat = os.stat(build.vmfb_path)
+        mlir_stat = _file_stat(build.mlir_path)
+        return (
+            stat.st_size == entry["size"]
+            and stat.st_mtime_ns == entry["mtime_ns"]
+            and (mlir_stat is None or mlir_stat == entry["mlir"])
+        )
+
+    def _import(self, build):
+        if os.path.isfile(build.mlir_path):
+            return 0.0
+        print(f"[build] Importing {build.name} to {build.mlir_path}")
+        begin = time.perf_counter()
+        tmp_path = build.mlir_path + ".tmp"
+        build.import_fn(tmp_path)
+        os.replace(tmp_path, build.mlir_path)
+        return time.perf_counter() - begin
+
+    def get_compile_args(self, build):
+        # Resolved here, so that the workers need not parse shark_args.
+        from shark.iree_utils.compile_utils import get_iree_compile_args
+        from shark.iree_utils._common import iree_target_map
+
+        args, input_type = get_iree_compile_args(
+            build.device, build.mlir_dialect, build.extra_args, build.debug
+        )
+        return iree_target_map(build.device), (args, input_type)
+
+    def _make_key(self, build, target_backend, compile_args):
+        hasher = hashlib.sha256()
+        _hash_file(build.mlir_path, hasher)
+        args, input_type = compile_args
+        hasher.update(
+            json.dumps([target_backend, str(input_type), list(args)]).encode(
+                "utf-8"
+            )
+        )
+        return hasher.hexdigest()
+
+    def _make_pool(self):
+        kwargs = {}
+        if sys.version_info >= (3, 11):
+            # A fresh worker per layer frees the compiler's memory and
+            # makes the peak RSS per layer.
+            kwargs["max_tasks_per_child"] = 1
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            initializer=_set_memory_limit,
+            initargs=(self.memory_limit_gb,),
+            **kwargs,
+        )
+
+    def build(self, builds):
+        """
+        Builds the vmfbs of `builds`, a list of LayerBuild. Returns the
+        status, import and compile time and peak RSS of every layer, and
+        raises RuntimeError if any layer failed, once the others are built.
+        """
+        report = {
+            build.name: {
+                "status": "cached",
+                "import_s": 0.0,
+                "compile_s": 0.0,
+                "peak_rss_mb": None,
+                "reused_from": None,
+            }
+            for build in builds
+        }
+        # Key to the build compiling it, and the builds waiting for it.
+        compiling = {}
+        pending = {}
+        errors = {}
+
+        def finish(future):
+            # Records the layers of a finished compile as soon as possible,
+            # for an interrupted build to resume from.
+            key = pending.pop(future)
+            first, waiting = compiling[key]
+            try:
+                compile_s, peak_rss_mb = future.result()
+            except Exception as e:
+                for build in [first] + waiting:
+                    errors[build.name] = e
+                    report[build.name]["status"] = "failed"
+                return
+            report[first.name].update(
+                status="built", compile_s=compile_s, peak_rss_mb=peak_rss_mb
+            )
+            self._record(first, key)
+            for build in waiting:
+                shutil.copyfile(first.vmfb_path, build.vmfb_path)
+                self._record(build, key)
+
+        with self._make_pool() as pool:
+            for build in builds:
+                for future in [f for f in pending if f.done()]:
+                    finish(future)
+                if self.is_built(build):
+                    print(f"[build] {build.name} is up to date")
+                    continue
+                try:
+                    report[build.name]["import_s"] = self._import(build)
+                except Exception as e:
+                    errors[build.name] = e
+                    report[build.name]["status"] = "failed"
+                    continue
+                target_backend, compile_args = self.get_compile_args(build)
+                key = self._make_key(build, target_backend, compile_args)
+                if key in compiling:
+                    first, waiting = compiling[key]
+                    report[build.name]["reused_from"] = first.name
+                    if first.name in errors:
+                        errors[build.name] = errors[first.name]
+                        report[build.name]["status"] = "failed"
+                    elif report[first.name]["status"] == "built":
+                        shutil.copyfile(first.vmfb_path, build.vmfb_path)
+                        self._record(build, key)
+                        report[build.name]["status"] = "reused"
+                    else:
+                        waiting.append(build)
+                        report[build.name]["status"] = "reused"
+                    continue
+                print(f"[build] Compiling {build.name} to {build.vmfb_path}")
+                future = pool.submit(
+                    self.compile_fn,
+                    build.mlir_path,
+                    build.vmfb_path,
+                    target_backend,
+                    compile_args,
+                )
+                compiling[key] = (build, [])
+                pending[future] = key
+
+            for future in concurrent.futures.as_completed(list(pending)):
+                finish(future)
+
+        print_build_report(report)
+        self.write_report(report)
+        if errors:
+            raise RuntimeError(
+                "Failed to build "
+                + ", ".join(f"{name} ({e})" for name, e in errors.items())
+            )
+        return report
+
+    def write_report(self, report):
+        _write_atomic(
+            os.path.join(self.build_dir, "build_report.json"),
+            json.dumps(report, indent=1).encode("utf-8"),
+        )
+
+
+def print_build_report(report):
+    print(
+        f"{'layer':<24}{'status':>8}{'import s':>10}{'compile s':>11}"
+        f"{'peak MB':>9}"
+    )
+    for name, entry in report.items():
+        peak = entry["peak_rss_mb"]
+        peak = "" if peak is None else f"{peak:.0f}"
+        status = entry["status"]
+        if entry["reused_from"] is not None:
+            status = f"= {entry['reused_from']}"
+        print(
+            f"{name:<24}{status:>8}{entry['import_s']:>10.1f}"
+            f"{entry['compile_s']:>11.1f}{peak:>9}"
+        )
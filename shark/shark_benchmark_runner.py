@@ -22,11 +22,15 @@ from shark.iree_utils.benchmark_utils import (
     build_benchmark_args,
     run_benchmark_module,
 )
+from shark.iree_utils.compile_utils import results_to_host
+from shark.benchmark_stats import LatencySampler
 from shark.parser import shark_args
 from datetime import datetime
+import iree.runtime as ireert
 import time
 from typing import Optional
 import csv
+import json
 import os
 
 TF_CPU_DEVICE = "/CPU:0"
@@ -37,6 +41,15 @@ def _bytes_to_mb_str(bytes_: Optional[int]) -> str:
     return "" if bytes_ is None else f"{bytes_ / 1e6:.6f}"
 
 
+def write_benchmark_stats(bench_info: dict, stats: dict):
+    # Appends the detailed statistics of a bench_results.csv row to its
+    # JSON lines sidecar.
+    entry = {k: str(v) for k, v in bench_info.items()}
+    entry["stats"] = stats
+    with open(shark_args.benchmark_stats_path, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
 class OnnxFusionOptions(object):
     def __init__(self):
         self.disable_gelu = False
@@ -256,7 +269,69 @@ class SharkBenchmarkRunner(SharkRunner):
             _bytes_to_mb_str(device_peak_b),
         ]
 
+    def _run_phases(self, function_name, inputs):
+        # One invocation, timed as host to device copies, the call and
+        # device to host copies. On asynchronous devices the wait for the
+        # call to finish is part of the device to host phase.
+        begin = time.perf_counter_ns()
+        device_inputs = [
+            ireert.asdevicearray(self.iree_config.device, x) for x in inputs
+        ]
+        uploaded = time.perf_counter_ns()
+        result = self.iree_compilation_module[function_name](*device_inputs)
+        invoked = time.perf_counter_ns()
+        results_to_host(result)
+        end = time.perf_counter_ns()
+        return {
+            "host_to_device": uploaded - begin,
+            "invoke": invoked - uploaded,
+            "device_to_host": end - invoked,
+        }
+
+    def benchmark_python_statistical(self, inputs):
+        """
+        Runs forward until the 95% confidence interval of its mean latency
+        is within --benchmark_ci_target, after warmup and outliers are
+        discarded. Returns the summary, see LatencySampler.
+        """
+        input_list = [x for x in inputs]
+        for i in range(shark_args.num_warmup_iterations):
+            self.run("forward", input_list)
+
+        sampler = LatencySampler(
+            ci_target=shark_args.benchmark_ci_target,
+            min_iterations=min(
+                shark_args.num_iterations, shark_args.benchmark_max_iterations
+            ),
+            max_iterations=shark_args.benchmark_max_iterations,
+            max_seconds=shark_args.benchmark_max_seconds,
+        )
+        stats = sampler.run(lambda: self._run_phases("forward", input_list))
+        print(
+            f"Shark-IREE Python benchmark: median {stats['median_ms']:.4f}ms, "
+            f"p90 {stats['p90_ms']:.4f}ms, p99 {stats['p99_ms']:.4f}ms, "
+            f"stddev {stats['stddev_ms']:.4f}ms, "
+            f"CI95 +-{100 * stats['ci95_rel']:.2f}%, "
+            f"Total Iterations:{stats['iterations']} "
+            f"({stats['warmup_discarded']} warmup, "
+            f"{stats['outliers']} outliers discarded)"
+        )
+        if not stats["converged"]:
+            print(
+                f"Warning: CI target {100 * stats['ci_target']:.2f}% not met "
+                "within --benchmark_max_iterations/--benchmark_max_seconds."
+            )
+        return stats
+
     def benchmark_python(self, inputs):
+        if shark_args.statistical_benchmark:
+            stats = self.benchmark_python_statistical(inputs)
+            self.python_benchmark_stats = stats
+            return [
+                f"{1000 / stats['median_ms']}",
+                f"{stats['median_ms']}",
+            ]
+
         input_list = [x for x in inputs]
         for i in range(shark_args.num_warmup_iterations):
             self.run("forward", input_list)
@@ -372,6 +447,28 @@ for currently supported models. Exiting benchmark ONNX."
 
         return comp_str
 
+    def add_to_history(self, row):
+        from shark.benchmark_history import BenchmarkHistory, get_git_revision
+        from shark.iree_utils.compile_cache import get_iree_compiler_version
+
+        stats = None
+        if (
+            row["engine"] == "shark_python"
+            and shark_args.statistical_benchmark
+        ):
+            stats = self.python_benchmark_stats
+        history = BenchmarkHistory(shark_args.benchmark_history_db)
+        # The run just happened, so it ran with this checkout and compiler.
+        iree_version = get_iree_compiler_version()
+        history.add_run(
+            row,
+            revision=get_git_revision(),
+            iree_version=None if iree_version == "unknown" else iree_version,
+            flags=" ".join(self.extra_args),
+            stats=stats,
+        )
+        history.close()
+
     def benchmark_all_csv(
         self,
         inputs: tuple,
@@ -468,6 +565,15 @@ for currently supported models. Exiting benchmark ONNX."
                         engine_result["iter/sec"],
                         engine_result["ms/iter"],
                     ) = self.benchmark_python(inputs)
+                    if shark_args.statistical_benchmark:
+                        stats = self.python_benchmark_stats
+                        engine_result["iterations"] = stats["iterations"]
+                        # The sidecar entry is keyed by the datetime of
+                        # the csv row, so it is set here once for both.
+                        engine_result["datetime"] = str(datetime.now())
+                        write_benchmark_stats(
+                            bench_info | engine_result, stats
+                        )
 
                     engine_result[
                         "vs. PyTorch/TF"
@@ -497,5 +603,7 @@ for currently supported models. Exiting benchmark ONNX."
                         engine_result["ms/iter"],
                     ) = self.benchmark_onnx(modelname, inputs)
 
-                engine_result["datetime"] = str(datetime.now())
+                engine_result.setdefault("datetime", str(datetime.now()))
                 writer.writerow(bench_info | engine_result)
+                if shark_args.benchmark_history_db is not None:
+                    self.add_to_history(bench_info | engine_result)
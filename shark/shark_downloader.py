@@ -14,10 +14,11 @@
 
 import numpy as np
 import os
-from tqdm.std import tqdm
 import sys
 from pathlib import Path
+from shark.golden_arrays import has_arrays, load_arrays
 from shark.parser import shark_args
+from shark.tank_sync import fetch_file, manifest_is_current, sync_directory
 from google.cloud import storage
 
 
@@ -28,47 +29,19 @@ def download_public_file(
     # bucket_name = "gs://your-bucket-name/path/to/file"
     # destination_file_name = "local/path/to/file"
 
-    storage_client = storage.Client.create_anonymous_client()
-    bucket_name = full_gs_url.split("/")[2]
-    source_blob_name = None
-    dest_filename = None
-    desired_file = None
+    # Files already downloaded and verified are skipped.
     if single_file:
-        desired_file = full_gs_url.split("/")[-1]
-        source_blob_name = "/".join(full_gs_url.split("/")[3:-1])
-        destination_folder_name, dest_filename = os.path.split(
-            destination_folder_name
+        fetch_file(
+            full_gs_url,
+            destination_folder_name,
+            num_workers=shark_args.tank_download_workers,
         )
     else:
-        source_blob_name = "/".join(full_gs_url.split("/")[3:])
-    bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=source_blob_name)
-    if not os.path.exists(destination_folder_name):
-        os.mkdir(destination_folder_name)
-    for blob in blobs:
-        blob_name = blob.name.split("/")[-1]
-        if single_file:
-            if blob_name == desired_file:
-                destination_filename = os.path.join(
-                    destination_folder_name, dest_filename
-                )
-                with open(destination_filename, "wb") as f:
-                    with tqdm.wrapattr(
-                        f, "write", total=blob.size
-                    ) as file_obj:
-                        storage_client.download_blob_to_file(blob, file_obj)
-            else:
-                continue
-
-        else:
-            destination_filename = os.path.join(
-                destination_folder_name, blob_name
-            )
-            if os.path.isdir(destination_filename):
-                continue
-            with open(destination_filename, "wb") as f:
-                with tqdm.wrapattr(f, "write", total=blob.size) as file_obj:
-                    storage_client.download_blob_to_file(blob, file_obj)
+        sync_directory(
+            full_gs_url,
+            destination_folder_name,
+            num_workers=shark_args.tank_download_workers,
+        )
 
 
 input_type_to_np_dtype = {
@@ -126,8 +99,8 @@ def check_dir_exists(model_name, frontend="torch", dynamic=""):
         if (
             os.path.isfile(os.path.join(model_dir, model_mlir_file_name))
             and os.path.isfile(os.path.join(model_dir, "function_name.npy"))
-            and os.path.isfile(os.path.join(model_dir, "inputs.npz"))
-            and os.path.isfile(os.path.join(model_dir, "golden_out.npz"))
+            and has_arrays(model_dir, "inputs")
+            and has_arrays(model_dir, "golden_out")
             and os.path.isfile(os.path.join(model_dir, "hash.npy"))
         ):
             print(
@@ -192,6 +165,57 @@ def get_sharktank_prefix():
     return tank_prefix
 
 
+def _sync_model_dir(
+    model_name, model_dir_name, model_dir, tank_url, frontend, dyn_str
+):
+    shark_args.shark_prefix = get_sharktank_prefix()
+    if not tank_url:
+        tank_url = "gs://shark_tank/" + shark_args.shark_prefix
+
+    full_gs_url = tank_url.rstrip("/") + "/" + model_dir_name
+    if not check_dir_exists(
+        model_dir_name, frontend=frontend, dynamic=dyn_str
+    ):
+        print(
+            f"Downloading artifacts for model {model_name} from: {full_gs_url}"
+        )
+        download_public_file(full_gs_url, model_dir)
+
+    elif shark_args.force_update_tank == True:
+        print(
+            f"Force-updating artifacts for model {model_name} from: {full_gs_url}"
+        )
+        sync_directory(
+            full_gs_url,
+            model_dir,
+            verify=True,
+            num_workers=shark_args.tank_download_workers,
+        )
+    elif shark_args.shark_prefix == "none":
+        print(
+            "No internet connection. Using the model already present in the tank."
+        )
+    else:
+        outdated = sync_directory(
+            full_gs_url,
+            model_dir,
+            update=shark_args.update_tank,
+            num_workers=shark_args.tank_download_workers,
+        )
+        if not outdated:
+            print(
+                "Local and upstream hashes match. Using cached model artifacts."
+            )
+        elif shark_args.update_tank == True:
+            print(
+                f"Updated artifacts {outdated} for model {model_name} from: {full_gs_url}"
+            )
+        else:
+            print(
+                "Hash does not match upstream in gs://shark_tank/. If you want to use locally generated artifacts, this is working as intended. Otherwise, run with --update_tank."
+            )
+
+
 # Downloads the torch model from gs://shark_tank dir.
 def download_model(
     model_name,
@@ -204,7 +228,6 @@ def download_model(
     model_name = model_name.replace("/", "_")
     dyn_str = "_dynamic" if dynamic else ""
     os.makedirs(WORKDIR, exist_ok=True)
-    shark_args.shark_prefix = get_sharktank_prefix()
     if import_args["batch_size"] and import_args["batch_size"] != 1:
         model_dir_name = (
             model_name
@@ -220,57 +243,21 @@ def download_model(
         model_dir_name = model_name + "_" + frontend
     model_dir = os.path.join(WORKDIR, model_dir_name)
 
-    if not tank_url:
-        tank_url = "gs://shark_tank/" + shark_args.shark_prefix
-
-    full_gs_url = tank_url.rstrip("/") + "/" + model_dir_name
-    if not check_dir_exists(
-        model_dir_name, frontend=frontend, dynamic=dyn_str
+    # Artifacts checked against upstream less than --tank_manifest_ttl
+    # seconds ago are used without going to the network.
+    manifest_url = None
+    if tank_url:
+        manifest_url = tank_url.rstrip("/") + "/" + model_dir_name
+    if not shark_args.force_update_tank and manifest_is_current(
+        model_dir, shark_args.tank_manifest_ttl, manifest_url
     ):
         print(
-            f"Downloading artifacts for model {model_name} from: {full_gs_url}"
+            f"Model artifacts for {model_name} are up to date with upstream. Using cached model artifacts."
         )
-        download_public_file(full_gs_url, model_dir)
-
-    elif shark_args.force_update_tank == True:
-        print(
-            f"Force-updating artifacts for model {model_name} from: {full_gs_url}"
-        )
-        download_public_file(full_gs_url, model_dir)
     else:
-        if not _internet_connected():
-            print(
-                "No internet connection. Using the model already present in the tank."
-            )
-        else:
-            local_hash = str(np.load(os.path.join(model_dir, "hash.npy")))
-            gs_hash_url = (
-                tank_url.rstrip("/") + "/" + model_dir_name + "/hash.npy"
-            )
-            download_public_file(
-                gs_hash_url,
-                os.path.join(model_dir, "upstream_hash.npy"),
-                single_file=True,
-            )
-            try:
-                upstream_hash = str(
-                    np.load(os.path.join(model_dir, "upstream_hash.npy"))
-                )
-            except FileNotFoundError:
-                print(f"Model artifact hash not found at {model_dir}.")
-                upstream_hash = None
-            if local_hash != upstream_hash and shark_args.update_tank == True:
-                print(f"Updating artifacts for model {model_name}...")
-                download_public_file(full_gs_url, model_dir)
-
-            elif local_hash != upstream_hash:
-                print(
-                    "Hash does not match upstream in gs://shark_tank/. If you want to use locally generated artifacts, this is working as intended. Otherwise, run with --update_tank."
-                )
-            else:
-                print(
-                    "Local and upstream hashes match. Using cached model artifacts."
-                )
+        _sync_model_dir(
+            model_name, model_dir_name, model_dir, tank_url, frontend, dyn_str
+        )
 
     model_dir = os.path.join(WORKDIR, model_dir_name)
     tuned_str = "" if tuned is None else "_" + tuned
@@ -289,9 +276,7 @@ def download_model(
 
     assert os.path.exists(mlir_filename), f"MLIR not found at {mlir_filename}"
     function_name = str(np.load(os.path.join(model_dir, "function_name.npy")))
-    inputs = np.load(os.path.join(model_dir, "inputs.npz"))
-    golden_out = np.load(os.path.join(model_dir, "golden_out.npz"))
-
-    inputs_tuple = tuple([inputs[key] for key in inputs])
-    golden_out_tuple = tuple([golden_out[key] for key in golden_out])
+    # Memory mapped, the arrays are read from the page cache as needed.
+    inputs_tuple = load_arrays(model_dir, "inputs")
+    golden_out_tuple = load_arrays(model_dir, "golden_out")
     return mlir_filename, function_name, inputs_tuple, golden_out_tuple
@@ -146,7 +146,7 @@ class SharkImporter:
         if self.frontend in ["tf", "tensorflow"]:
             return [x.numpy() for x in array_tuple]
 
-    # Saves `function_name.npy`, `inputs.npz`, `golden_out.npz` and `model_name.mlir` in the directory `dir`.
+    # Saves `function_name.npy`, the `inputs` and `golden_out` arrays and `model_name.mlir` in the directory `dir`.
     def save_data(
         self,
         dir,
@@ -158,9 +158,8 @@ class SharkImporter:
         mlir_type="linalg",
     ):
         import numpy as np
+        from shark.golden_arrays import save_arrays
 
-        inputs_name = "inputs.npz"
-        outputs_name = "golden_out.npz"
         func_file_name = "function_name"
         model_name_mlir = (
             model_name + "_" + self.frontend + "_" + mlir_type + ".mlir"
@@ -173,8 +172,11 @@ class SharkImporter:
                 inputs = [x.numpy() for x in inputs]
             except AttributeError:
                 inputs = [x for x in inputs]
-        np.savez(os.path.join(dir, inputs_name), *inputs)
-        np.savez(os.path.join(dir, outputs_name), *outputs)
+        for name, arrays in [("inputs", inputs), ("golden_out", outputs)]:
+            # An archive from an earlier import would shadow the new arrays.
+            if os.path.isfile(os.path.join(dir, name + ".npz")):
+                os.remove(os.path.join(dir, name + ".npz"))
+            save_arrays(dir, name, arrays)
         np.save(os.path.join(dir, func_file_name), np.array(func_name))
         if self.frontend == "torch":
             with open(os.path.join(dir, model_name_mlir), "wb") as mlir_file:
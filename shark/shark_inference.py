@@ -57,6 +57,10 @@ class SharkInference:
         Runs the function with `function_name` within the mlir_module along
         with the given inputs, if the inputs are not given it autogenerates the
         inputs. Also, the inputs should be a numpy array.
+    call_async(function_name, inputs):
+        Same as __call__ but returns a future. Consecutive calls are
+        pipelined so that input upload and output download overlap with
+        execution.
     input_info():
         Gives the information about the inputs required by the `function_name`.
         This can be expensive as it does string matching to do so.
@@ -154,6 +158,12 @@ class SharkInference:
             function_name, inputs, send_to_host, device=self.device
         )
 
+    # Asynchronous variant of __call__; returns a concurrent.futures.Future.
+    # Successive calls are pipelined, so the inputs of the next call are
+    # uploaded while the current one executes.
+    def call_async(self, function_name: str, inputs: tuple, send_to_host=True):
+        return self.shark_runner.run_async(function_name, inputs, send_to_host)
+
     # forward function.
     def forward(self, inputs: tuple, send_to_host=True):
         return self.shark_runner.run(
@@ -122,6 +122,22 @@ class SharkRunner:
             device=device,
         )
 
+    def run_async(self, function_name, inputs: tuple, send_to_host=True):
+        """
+        Queues `function_name` on the pipelined invoker and returns a
+        concurrent.futures.Future of its results. Uploads of queued inputs
+        and downloads of finished outputs overlap with device execution.
+        """
+        if getattr(self, "pipelined_invoker", None) is None:
+            from shark.iree_utils.pipelined_invoke import PipelinedInvoker
+
+            self.pipelined_invoker = PipelinedInvoker(
+                self.iree_compilation_module, self.iree_config
+            )
+        return self.pipelined_invoker.submit(
+            function_name, inputs, send_to_host
+        )
+
     # Get all function names defined within the compiled module.
     def get_functions_in_module(self):
         return self.iree_compilation_module._vm_module.function_names
@@ -24,12 +24,152 @@ from shark.shark_runner import supported_dialects
 import logging
 from concurrent.futures import ProcessPoolExecutor
 from concurrent.futures.thread import ThreadPoolExecutor
+import concurrent.futures
+import functools
+import json
+import math
+import sys
+import os
+import threading
 import time
-import numpy as np
 
 IREE_TO_SHARK_DRIVER_MAP = {v: k for k, v in _IREE_DEVICE_MAP.items()}
 
 
+PERCENTILES = [50, 95, 99, 99.9]
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of latencies in the spirit of HdrHistogram.
+    Latencies are kept in microseconds in buckets `significant_bits` wide,
+    so every recorded value is reported within 2**-significant_bits of
+    itself (< 1% by default), however long the run.
+    """
+
+    def __init__(self, significant_bits: int = 7):
+        self.significant_bits = significant_bits
+        self.counts = {}
+        self.count = 0
+        self.sum_us = 0
+        self.min_us = None
+        self.max_us = 0
+
+    def _bucket(self, value_us: int) -> int:
+        shift = max(0, value_us.bit_length() - self.significant_bits)
+        return (value_us >> shift) << shift
+
+    def _highest_equivalent(self, bucket: int) -> int:
+        shift = max(0, bucket.bit_length() - self.significant_bits)
+        return min(bucket + (1 << shift) - 1, self.max_us)
+
+    def record(self, seconds: float):
+        value_us = max(0, int(round(seconds * 1e6)))
+        bucket = self._bucket(value_us)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.sum_us += value_us
+        self.min_us = (
+            value_us if self.min_us is None else min(self.min_us, value_us)
+        )
+        self.max_us = max(self.max_us, value_us)
+
+    def merge(self, other: "LatencyHistogram"):
+        assert self.significant_bits == other.significant_bits
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.sum_us += other.sum_us
+        if other.min_us is not None:
+            self.min_us = (
+                other.min_us
+                if self.min_us is None
+                else min(self.min_us, other.min_us)
+            )
+        self.max_us = max(self.max_us, other.max_us)
+
+    def percentile_ms(self, percentile: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(percentile / 100 * self.count))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return self._highest_equivalent(bucket) / 1000
+        return self.max_us / 1000
+
+    def summary(self) -> dict:
+        summary = {
+            "count": self.count,
+            "mean_ms": self.sum_us / self.count / 1000 if self.count else None,
+            "min_ms": None if self.min_us is None else self.min_us / 1000,
+            "max_ms": self.max_us / 1000,
+        }
+        for percentile in PERCENTILES:
+            summary[f"p{percentile:g}_ms"] = self.percentile_ms(percentile)
+        return summary
+
+    def to_dict(self) -> dict:
+        return {
+            "significant_bits": self.significant_bits,
+            "count": self.count,
+            "sum_us": self.sum_us,
+            "min_us": self.min_us,
+            "max_us": self.max_us,
+            "counts": {
+                str(bucket): count
+                for bucket, count in sorted(self.counts.items())
+            },
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> "LatencyHistogram":
+        histogram = LatencyHistogram(data["significant_bits"])
+        histogram.counts = {
+            int(bucket): count for bucket, count in data["counts"].items()
+        }
+        histogram.count = data["count"]
+        histogram.sum_us = data["sum_us"]
+        histogram.min_us = data["min_us"]
+        histogram.max_us = data["max_us"]
+        return histogram
+
+
+def get_rss_mb() -> Optional[float]:
+    # Current resident set size, None where it cannot be read.
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss / 2**20
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def get_arrival_offsets(arrival: str, qps: float, seed: int):
+    """
+    Yields the times in seconds, relative to the start, at which an open
+    loop client issues its requests: every 1/qps seconds for "fixed", or
+    with exponentially distributed gaps of mean 1/qps for "poisson".
+    """
+    rng = np.random.default_rng(seed)
+    offset = 0.0
+    i = 0
+    while True:
+        if arrival == "fixed":
+            offset = i / qps
+        else:
+            offset += rng.exponential(1 / qps)
+        yield offset
+        i += 1
+
+
 def stress_test_compiled_model(
     shark_module_path: str,
     function_name: str,
@@ -42,7 +182,25 @@ def stress_test_compiled_model(
     inference_timeout_seconds: float,
     tolerance_nulp: int,
     stress_test_index: int,
-):
+    arrival: str = "closed",
+    qps: float = 10,
+    client_threads: int = 1,
+    max_outstanding: int = 16,
+    report_interval_seconds: float = 10,
+    seed: int = 0,
+) -> dict:
+    """
+    Runs `client_threads` clients against one module on `device`.
+
+    Closed loop clients issue a request as soon as their previous one
+    completed. Open loop clients ("fixed" or "poisson" arrival) issue
+    requests at `qps` each regardless of completions, and their latency
+    counts from the scheduled arrival, so queueing is not hidden. Requests
+    arriving while `max_outstanding` are in flight are dropped.
+
+    Returns the client report: latency histogram, counts and a timeline
+    of throughput and memory use.
+    """
     logging.info(
         f"Running stress test {stress_test_index} on device {device}."
     )
@@ -61,31 +219,170 @@ def stress_test_compiled_model(
     ).result()
     input_batches = [np.repeat(arr, batch_size, axis=0) for arr in inputs]
     golden_output_batches = np.repeat(golden_out, batch_size, axis=0)
-    report_interval_seconds = 10
-    start_time = time.time()
-    previous_report_time = start_time
     first_iteration_output = None
-    for i in range(max_iterations):
-        output = module_executor.submit(
-            shark_module.forward, input_batches
-        ).result(inference_timeout_seconds)
-        if first_iteration_output is None:
-            np.testing.assert_array_almost_equal_nulp(
-                golden_output_batches, output, nulp=tolerance_nulp
-            )
-            first_iteration_output = output
-        else:
-            np.testing.assert_array_equal(output, first_iteration_output)
-        current_time = time.time()
-        if report_interval_seconds < current_time - previous_report_time:
-            logging.info(
-                f"Stress test {stress_test_index} on device "
-                f"{device} at iteration {i+1}"
-            )
-            previous_report_time = current_time
-        if max_duration_seconds < current_time - start_time:
+    # Outputs are checked in completion order on a thread of their own, so
+    # the comparisons neither count towards latencies nor delay requests
+    # queued on the module thread.
+    check_executor = ThreadPoolExecutor(1)
+
+    def infer():
+        # Runs on the module thread.
+        output = shark_module.forward(input_batches)
+        return time.perf_counter(), output
+
+    def check_output(output):
+        nonlocal first_iteration_output
+        try:
+            if first_iteration_output is None:
+                np.testing.assert_array_almost_equal_nulp(
+                    golden_output_batches, output, nulp=tolerance_nulp
+                )
+                first_iteration_output = output
+            else:
+                np.testing.assert_array_equal(output, first_iteration_output)
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+
+    histogram = LatencyHistogram()
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(max_outstanding)
+    stats = {"issued": 0, "dropped": 0}
+    errors = []
+    timeline = []
+    stop = threading.Event()
+    start_time = time.perf_counter()
+
+    def record(scheduled_time, future):
+        if arrival != "closed":
+            slots.release()
+        if future.exception() is not None:
+            errors.append(future.exception())
+            stop.set()
+            return
+        completion_time, output = future.result()
+        with lock:
+            histogram.record(completion_time - scheduled_time)
+        check_executor.submit(check_output, output)
+
+    def issue(scheduled_time):
+        with lock:
+            if stats["issued"] >= max_iterations:
+                stop.set()
+                return None
+            stats["issued"] += 1
+        future = module_executor.submit(infer)
+        future.add_done_callback(functools.partial(record, scheduled_time))
+        return future
+
+    def run_client(client_index):
+        if arrival == "closed":
+            while not stop.is_set():
+                future = issue(time.perf_counter())
+                if future is None:
+                    return
+                future.result(inference_timeout_seconds)
             return
+        offsets = get_arrival_offsets(
+            arrival,
+            qps,
+            seed + stress_test_index * client_threads + client_index,
+        )
+        last_future = None
+        for offset in offsets:
+            if stop.is_set() or offset > max_duration_seconds:
+                break
+            scheduled_time = start_time + offset
+            stop.wait(max(0.0, scheduled_time - time.perf_counter()))
+            if stop.is_set():
+                break
+            if not slots.acquire(blocking=False):
+                with lock:
+                    stats["dropped"] += 1
+                continue
+            future = issue(scheduled_time)
+            if future is None:
+                slots.release()
+                break
+            last_future = future
+        if last_future is not None:
+            # The module thread runs requests in order.
+            last_future.result(inference_timeout_seconds * max_outstanding)
+
+    def sample_timeline():
+        now = time.perf_counter()
+        with lock:
+            completed = histogram.count
+        previous = (
+            timeline[-1] if timeline else {"time_s": 0.0, "completed": 0}
+        )
+        elapsed = now - start_time
+        interval = max(elapsed - previous["time_s"], 1e-9)
+        timeline.append(
+            {
+                "time_s": elapsed,
+                "completed": completed,
+                "throughput_qps": (completed - previous["completed"])
+                / interval,
+                "rss_mb": get_rss_mb(),
+            }
+        )
+        logging.info(
+            f"Stress test {stress_test_index} on device {device}: "
+            f"{completed} requests, "
+            f"{timeline[-1]['throughput_qps']:.2f} requests/s, "
+            f"p99 {histogram.percentile_ms(99)}ms"
+        )
+
+    clients = ThreadPoolExecutor(client_threads)
+    client_futures = [
+        clients.submit(run_client, client_index)
+        for client_index in range(client_threads)
+    ]
+    deadline = start_time + max_duration_seconds
+    next_report_time = start_time + report_interval_seconds
+    while True:
+        _, not_done = concurrent.futures.wait(
+            client_futures,
+            timeout=max(
+                0.0, min(next_report_time, deadline) - time.perf_counter()
+            ),
+        )
+        if not not_done:
+            break
+        current_time = time.perf_counter()
+        if deadline <= current_time:
+            stop.set()
+            deadline = float("inf")
+        if next_report_time <= current_time:
+            sample_timeline()
+            next_report_time += report_interval_seconds
+    for future in client_futures:
+        future.result()
+    clients.shutdown()
+    module_executor.shutdown()
+    check_executor.shutdown()
+    sample_timeline()
+    if errors:
+        raise errors[0]
+
+    duration = time.perf_counter() - start_time
     logging.info(f"Stress test {stress_test_index} on device {device} done.")
+    return {
+        "index": stress_test_index,
+        "device": device,
+        "arrival": arrival,
+        "target_qps": None if arrival == "closed" else qps * client_threads,
+        "client_threads": client_threads,
+        "duration_s": duration,
+        "issued": stats["issued"],
+        "completed": histogram.count,
+        "dropped": stats["dropped"],
+        "throughput_qps": histogram.count / duration,
+        "latency": histogram.summary(),
+        "histogram": histogram.to_dict(),
+        "timeline": timeline,
+    }
 
 
 def get_device_type(device_name: str):
@@ -149,7 +446,13 @@ def stress_test(
     frontend: str = "torch",
     oversubscription_factor: int = 1,
     tolerance_nulp: int = 50000,
-):
+    arrival: str = "closed",
+    qps: float = 10,
+    client_threads: int = 1,
+    max_outstanding: int = 16,
+    report_interval_seconds: float = 10,
+    seed: int = 0,
+) -> dict:
     logging.info(f"Downloading stress test model {model_name}.")
     mlir_model, func_name, inputs, golden_out = download_model(
         model_name=model_name, dynamic=dynamic_model, frontend=frontend
@@ -195,7 +498,7 @@ def stress_test(
     with multiprocessing.Pool(
         len(device_name_shark_module_path_map) * oversubscription_factor
     ) as process_pool:
-        process_pool.starmap(
+        results = process_pool.starmap(
             stress_test_compiled_model,
             [
                 (
@@ -210,6 +513,12 @@ def stress_test(
                     inference_timeout_seconds,
                     tolerance_nulp,
                     stress_test_index,
+                    arrival,
+                    qps,
+                    client_threads,
+                    max_outstanding,
+                    report_interval_seconds,
+                    seed,
                 )
                 for stress_test_index, (device_name, module_path) in enumerate(
                     list(device_name_shark_module_path_map.items())
@@ -218,6 +527,117 @@ def stress_test(
             ],
         )
 
+    config = {
+        "model": model_name,
+        "dynamic": dynamic_model,
+        "frontend": frontend,
+        "mlir_dialect": mlir_dialect,
+        "devices": list(device_name_shark_module_path_map),
+        "batch_size": batch_size,
+        "clients_per_device": oversubscription_factor,
+        "client_threads": client_threads,
+        "arrival": arrival,
+        "qps": None if arrival == "closed" else qps,
+        "max_outstanding": max_outstanding,
+    }
+    return build_stress_report(results, config)
+
+
+def _summarize_clients(results: List[dict]) -> dict:
+    histogram = LatencyHistogram()
+    for result in results:
+        histogram.merge(LatencyHistogram.from_dict(result["histogram"]))
+    return {
+        "issued": sum(result["issued"] for result in results),
+        "completed": histogram.count,
+        "dropped": sum(result["dropped"] for result in results),
+        # Clients run concurrently, so their throughputs add up.
+        "throughput_qps": sum(result["throughput_qps"] for result in results),
+        "peak_rss_mb": max(
+            (
+                s["rss_mb"]
+                for result in results
+                for s in result["timeline"]
+                if s["rss_mb"] is not None
+            ),
+            default=None,
+        ),
+        "latency": histogram.summary(),
+        "histogram": histogram.to_dict(),
+    }
+
+
+def build_stress_report(results: List[dict], config: dict) -> dict:
+    """
+    Builds the report of a run from the reports of its clients, with
+    latency and throughput summaries overall and per device.
+    """
+    devices = sorted({result["device"] for result in results})
+    return {
+        "version": 1,
+        "time": time.time(),
+        "config": config,
+        "overall": _summarize_clients(results),
+        "devices": {
+            device: _summarize_clients(
+                [result for result in results if result["device"] == device]
+            )
+            for device in devices
+        },
+        "clients": results,
+    }
+
+
+def compare_stress_reports(
+    report: dict, baseline: dict, threshold: float = 0.1
+) -> List[str]:
+    """
+    Returns the regressions of `report` relative to `baseline`: latency
+    percentiles that grew, or throughput that fell, by more than
+    `threshold` (relative), overall and for devices in both reports.
+    """
+    regressions = []
+    scopes = [("overall", report["overall"], baseline["overall"])]
+    scopes += [
+        (device, summary, baseline["devices"][device])
+        for device, summary in report["devices"].items()
+        if device in baseline["devices"]
+    ]
+    for scope, summary, base in scopes:
+        for percentile in PERCENTILES:
+            key = f"p{percentile:g}_ms"
+            value, base_value = summary["latency"][key], base["latency"][key]
+            if value is None or not base_value:
+                continue
+            change = value / base_value - 1
+            if change > threshold:
+                regressions.append(
+                    f"{scope} {key}: {base_value:.3f} -> {value:.3f} "
+                    f"({change:+.1%})"
+                )
+        value, base_value = summary["throughput_qps"], base["throughput_qps"]
+        if base_value and value / base_value - 1 < -threshold:
+            regressions.append(
+                f"{scope} throughput_qps: {base_value:.2f} -> {value:.2f} "
+                f"({value / base_value - 1:+.1%})"
+            )
+    return regressions
+
+
+def print_stress_report(report: dict):
+    for scope, summary in [("overall", report["overall"])] + list(
+        report["devices"].items()
+    ):
+        latency = summary["latency"]
+        percentiles = ", ".join(
+            f"p{p:g} {latency[f'p{p:g}_ms']}ms" for p in PERCENTILES
+        )
+        print(
+            f"{scope}: {summary['completed']} requests, "
+            f"{summary['dropped']} dropped, "
+            f"{summary['throughput_qps']:.2f} requests/s, {percentiles}"
+        )
+
 
 if __name__ == "__main__":
     logging.basicConfig(encoding="utf-8", level=logging.INFO)
@@ -269,9 +689,69 @@ if __name__ == "__main__":
         "--oversubscription",
         type=int,
         help="Oversubscrption factor. Each device will execute the model simultaneously "
-        "this many number of times.",
+        "this many number of times, in as many client processes.",
         default=1,
     )
+    parser.add_argument(
+        "--client-threads",
+        type=int,
+        help="Number of clients threads issuing requests in each client process.",
+        default=1,
+    )
+    parser.add_argument(
+        "--arrival",
+        type=str,
+        help="Request arrival of each client thread. closed issues the next request "
+        "when the previous one completed; fixed and poisson issue --qps requests per "
+        "second regardless (open loop), at fixed or exponentially distributed intervals.",
+        default="closed",
+        choices=["closed", "fixed", "poisson"],
+    )
+    parser.add_argument(
+        "--qps",
+        type=float,
+        help="Requests per second of each open loop client thread.",
+        default=10,
+    )
+    parser.add_argument(
+        "--max-outstanding",
+        type=int,
+        help="Maximum number of requests in flight per client process with open loop "
+        "arrival. Requests arriving beyond that are dropped and counted.",
+        default=16,
+    )
+    parser.add_argument(
+        "--report-interval",
+        type=float,
+        help="Seconds between throughput and memory samples.",
+        default=10,
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed of the poisson arrivals.",
+        default=0,
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        help="Path of the JSON report to write.",
+        default=None,
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        help="JSON report of an earlier run to compare against. Exits with 1 on "
+        "regressions.",
+        default=None,
+    )
+    parser.add_argument(
+        "--regression-threshold",
+        type=float,
+        help="Relative change of a latency percentile or throughput that counts as "
+        "a regression.",
+        default=0.1,
+    )
     parser.add_argument(
         "--max-iterations",
         type=int,
@@ -299,7 +779,7 @@ if __name__ == "__main__":
     )
 
     args = parser.parse_known_args()[0]
-    stress_test(
+    report = stress_test(
         model_name=args.model,
         dynamic_model=args.dynamic,
         frontend=args.frontend,
@@ -312,4 +792,23 @@ if __name__ == "__main__":
         max_duration_seconds=args.max_duration,
         inference_timeout_seconds=args.inference_timeout,
         tolerance_nulp=args.tolerance_nulp,
+        arrival=args.arrival,
+        qps=args.qps,
+        client_threads=args.client_threads,
+        max_outstanding=args.max_outstanding,
+        report_interval_seconds=args.report_interval,
+        seed=args.seed,
     )
+    print_stress_report(report)
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare_stress_reports(
+                report, json.load(f), args.regression_threshold
+            )
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,441 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+## Parallel, resumable and verified downloads of shark_tank artifacts.
+import base64
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from tqdm.std import tqdm
+
+MANIFEST_NAME = "tank_manifest.json"
+SLICE_SIZE = 64 * 1024 * 1024
+_COPY_SIZE = 1024 * 1024
+
+# `name` is the file name the blob is saved as, `path` where it is in the
+# source. `version` identifies its contents: the md5 when known, else
+# whatever the source has.
+BlobInfo = namedtuple("BlobInfo", ["name", "path", "size", "md5", "version"])
+
+
+def file_md5(path):
+    hasher = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_COPY_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class GCSSource:
+    """
+    Blobs of a public GCS bucket. Honors STORAGE_EMULATOR_HOST, so a fake
+    GCS server can stand in for the bucket.
+    """
+
+    def __init__(self, bucket_name):
+        self.bucket_name = bucket_name
+        self.local = threading.local()
+
+    def _client(self):
+        # Every thread gets its own client and connection pool.
+        if not hasattr(self.local, "client"):
+            from google.cloud import storage
+
+            self.local.client = storage.Client.create_anonymous_client()
+        return self.local.client
+
+    def list(self, prefix):
+        bucket = self._client().bucket(self.bucket_name)
+        blobs = []
+        for blob in bucket.list_blobs(prefix=prefix):
+            if blob.name.endswith("/"):
+                continue
+            md5 = None
+            if blob.md5_hash:
+                md5 = base64.b64decode(blob.md5_hash).hex()
+            version = md5 or f"{blob.crc32c}-{blob.generation}"
+            blobs.append(
+                BlobInfo(
+                    blob.name.split("/")[-1],
+                    blob.name,
+                    blob.size,
+                    md5,
+                    version,
+                )
+            )
+        return blobs
+
+    def read_range(self, blob, start, end, file_obj):
+        # Writes bytes [start, end) of `blob` to `file_obj`.
+        client = self._client()
+        client.download_blob_to_file(
+            client.bucket(self.bucket_name).blob(blob.path),
+            file_obj,
+            start=start,
+            end=end - 1,
+        )
+
+
+class LocalSource:
+    """
+    Files of a local directory laid out like the bucket, e.g. a mirror of
+    shark_tank on a shared drive.
+    """
+
+    def list(self, prefix):
+        if os.path.isfile(prefix):
+            paths = [prefix]
+        else:
+            paths = sorted(
+                os.path.join(root, name)
+                for root, _, names in os.walk(prefix)
+                for name in names
+            )
+        blobs = []
+        for path in paths:
+            md5 = file_md5(path)
+            blobs.append(
+                BlobInfo(
+                    os.path.basename(path),
+                    path,
+                    os.path.getsize(path),
+                    md5,
+                    md5,
+                )
+            )
+        return blobs
+
+    def read_range(self, blob, start, end, file_obj):
+        with open(blob.path, "rb") as f:
+            f.seek(start)
+            while start < end:
+                chunk = f.read(min(_COPY_SIZE, end - start))
+                if not chunk:
+                    break
+                file_obj.write(chunk)
+                start += len(chunk)
+
+
+def open_source(url):
+    """
+    Returns the source of `url` and the path of `url` within it. Besides
+    gs:// URLs, file:// URLs and plain paths of local directories work.
+    """
+    url = os.fspath(url)
+    if url.startswith("gs://"):
+        bucket_name, _, path = url[len("gs://") :].partition("/")
+        return GCSSource(bucket_name), path
+    if url.startswith("file://"):
+        url = url[len("file://") :]
+    return LocalSource(), url
+
+
+class _SliceWriter:
+    # Counts the bytes written to a slice, reporting them to `bar`.
+    def __init__(self, f, size, bar):
+        self.f = f
+        self.size = size
+        self.bar = bar
+        self.written = 0
+
+    def write(self, data):
+        if self.written + len(data) > self.size:
+            raise IOError("Received more data than requested")
+        self.f.write(data)
+        self.written += len(data)
+        self.bar.update(len(data))
+        return len(data)
+
+
+class _BlobDownload:
+    """
+    Download of one blob into a preallocated .part file, in slices. The
+    slices already written are kept in a .json file next to it, so that an
+    interrupted download resumes where it left off.
+    """
+
+    def __init__(self, blob, dest, slice_size):
+        self.blob = blob
+        self.dest = dest
+        tag = hashlib.md5(blob.version.encode("utf-8")).hexdigest()[:12]
+        self.part_path = f"{dest}.{tag}.part"
+        self.state_path = f"{self.part_path}.json"
+        self.slice_size = slice_size
+        self.slices = [
+            (start, min(start + slice_size, blob.size))
+            for start in range(0, blob.size, slice_size)
+        ] or [(0, 0)]
+        self.lock = threading.Lock()
+        self.done = self._load_state()
+        if not self.done:
+            # Partial downloads of other versions of the blob are useless.
+            for path in glob.glob(glob.escape(str(dest)) + ".*.part*"):
+                os.remove(path)
+            with open(self.part_path, "wb") as f:
+                f.truncate(blob.size)
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if state.get("slice_size") != self.slice_size or (
+            not os.path.isfile(self.part_path)
+            or os.path.getsize(self.part_path) != self.blob.size
+        ):
+            return set()
+        return set(state["done"])
+
+    def slice_done(self, index):
+        # Returns True once every slice is written.
+        with self.lock:
+            self.done.add(index)
+            with open(self.state_path, "w") as f:
+                json.dump(
+                    {"slice_size": self.slice_size, "done": sorted(self.done)},
+                    f,
+                )
+            return len(self.done) == len(self.slices)
+
+    def finish(self):
+        if self.blob.md5 is not None:
+            md5 = file_md5(self.part_path)
+            if md5 != self.blob.md5:
+                os.remove(self.part_path)
+                os.remove(self.state_path)
+                raise IOError(
+                    f"Checksum mismatch for {self.blob.path}: expected "
+                    f"{self.blob.md5}, got {md5}"
+                )
+        os.replace(self.part_path, self.dest)
+        os.remove(self.state_path)
+
+
+class TankDownloader:
+    """
+    Downloads blobs with a bounded pool of threads. Blobs larger than
+    `slice_size` are split into slices fetched in parallel with range
+    requests; a slice that fails is retried up to `retries` times.
+    """
+
+    def __init__(self, num_workers=8, slice_size=SLICE_SIZE, retries=3):
+        self.num_workers = max(1, num_workers)
+        self.slice_size = slice_size
+        self.retries = retries
+
+    def _fetch_slice(self, source, download, index, bar):
+        start, end = download.slices[index]
+        for attempt in range(self.retries):
+            with open(download.part_path, "r+b") as f:
+                f.seek(start)
+                writer = _SliceWriter(f, end - start, bar)
+                try:
+                    if end > start:
+                        source.read_range(download.blob, start, end, writer)
+                    if writer.written != end - start:
+                        raise IOError(
+                            f"Short read of {download.blob.path}: got "
+                            f"{writer.written} of {end - start} bytes"
+                        )
+                    break
+                except Exception as e:
+                    bar.update(-writer.written)
+                    if attempt + 1 == self.retries:
+                        raise
+                    print(f"Retrying download of {download.blob.path}: {e}")
+        if download.slice_done(index):
+            download.finish()
+
+    def fetch(self, source, downloads):
+        """
+        Downloads `downloads`, (BlobInfo, destination path) pairs. Every
+        blob is verified against its md5, if known, before it is moved to
+        its destination. Raises RuntimeError listing the blobs that could
+        not be downloaded; the others are kept.
+        """
+        jobs = [
+            _BlobDownload(blob, dest, self.slice_size)
+            for blob, dest in downloads
+        ]
+        total = sum(job.blob.size for job in jobs)
+        resumed = sum(
+            job.slices[index][1] - job.slices[index][0]
+            for job in jobs
+            for index in job.done
+        )
+        failed = {}
+        with tqdm(
+            total=total,
+            initial=resumed,
+            unit="B",
+            unit_scale=True,
+            unit_divisor=1024,
+        ) as bar, concurrent.futures.ThreadPoolExecutor(
+            self.num_workers
+        ) as pool:
+            futures = {}
+            for job in jobs:
+                if len(job.done) == len(job.slices):
+                    # Every slice was written by an earlier attempt.
+                    futures[pool.submit(job.finish)] = job
+                    continue
+                for index in range(len(job.slices)):
+                    if index not in job.done:
+                        future = pool.submit(
+                            self._fetch_slice, source, job, index, bar
+                        )
+                        futures[future] = job
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is not None:
+                    failed[futures[future].blob.path] = future.exception()
+        if failed:
+            raise RuntimeError(
+                "Failed to download "
+                + ", ".join(f"{path} ({e})" for path, e in failed.items())
+            )
+
+
+def load_manifest(dest_dir):
+    try:
+        with open(os.path.join(dest_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_manifest(dest_dir, manifest):
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, os.path.join(dest_dir, MANIFEST_NAME))
+
+
+def _manifest_entry(path, blob):
+    stat = os.stat(path)
+    return {
+        "size": blob.size,
+        "md5": blob.md5,
+        "version": blob.version,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def _unchanged(path, entry):
+    # Whether `path` is as it was when `entry` was recorded.
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return (
+        stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]
+    )
+
+
+def manifest_is_current(dest_dir, max_age, url=None):
+    """
+    Whether `dest_dir` was synced less than `max_age` seconds ago (from
+    `url`, if given) and none of its files changed since. Does no network
+    I/O.
+    """
+    manifest = load_manifest(dest_dir)
+    if manifest is None or time.time() - manifest["checked"] > max_age:
+        return False
+    if url is not None and manifest["url"] != url:
+        return False
+    return all(
+        _unchanged(os.path.join(dest_dir, name), entry)
+        for name, entry in manifest["blobs"].items()
+    )
+
+
+def _is_current(path, blob, entry, verify):
+    if not os.path.isfile(path) or os.path.getsize(path) != blob.size:
+        return False
+    if (
+        not verify
+        and entry is not None
+        and entry["version"] == blob.version
+        and _unchanged(path, entry)
+    ):
+        return True
+    return blob.md5 is not None and file_md5(path) == blob.md5
+
+
+def sync_directory(url, dest_dir, update=True, verify=False, num_workers=8):
+    """
+    Brings `dest_dir` up to date with the blobs under `url`, downloading
+    the ones that are missing or differ from upstream, and records them in
+    the manifest of `dest_dir`. Local files are trusted if the manifest
+    says they are unchanged since they were verified, unless `verify` is
+    set. With `update` unset, only checks.
+
+    Returns the names of the blobs that were missing or outdated.
+    """
+    url = os.fspath(url)
+    dest_dir = os.fspath(dest_dir)
+    source, prefix = open_source(url)
+    if isinstance(source, GCSSource):
+        prefix = prefix.rstrip("/") + "/"
+    manifest = load_manifest(dest_dir) or {}
+    known = manifest.get("blobs", {}) if manifest.get("url") == url else {}
+
+    entries = {}
+    outdated = []
+    for blob in source.list(prefix):
+        dest = os.path.join(dest_dir, blob.name)
+        if os.path.isdir(dest):
+            continue
+        if _is_current(dest, blob, known.get(blob.name), verify):
+            entries[blob.name] = _manifest_entry(dest, blob)
+        else:
+            outdated.append((blob, dest))
+
+    if outdated and not update:
+        return [blob.name for blob, _ in outdated]
+    os.makedirs(dest_dir, exist_ok=True)
+    if outdated:
+        TankDownloader(num_workers).fetch(source, outdated)
+        for blob, dest in outdated:
+            entries[blob.name] = _manifest_entry(dest, blob)
+    save_manifest(
+        dest_dir, {"url": url, "checked": time.time(), "blobs": entries}
+    )
+    return [blob.name for blob, _ in outdated]
+
+
+def fetch_file(url, dest_path, num_workers=8):
+    """
+    Downloads the blob at `url` to `dest_path`, unless it is there already.
+    Returns False if there is no such blob.
+    """
+    url = os.fspath(url)
+    dest_path = os.fspath(dest_path)
+    source, path = open_source(url)
+    blobs = [blob for blob in source.list(path) if blob.path == path]
+    if not blobs:
+        return False
+    blob = blobs[0]
+    if not _is_current(dest_path, blob, None, verify=False):
+        dest_dir = os.path.dirname(os.path.abspath(dest_path))
+        os.makedirs(dest_dir, exist_ok=True)
+        TankDownloader(num_workers).fetch(source, [(blob, dest_path)])
+    return True
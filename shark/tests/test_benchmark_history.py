@@ -0,0 +1,145 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import json
+from datetime import datetime
+
+from shark.benchmark_history import (
+    BenchmarkHistory,
+    build_report,
+    render_html_report,
+    render_text_report,
+)
+
+FIELDS = [
+    "model",
+    "batch_size",
+    "engine",
+    "dialect",
+    "device",
+    "shape_type",
+    "data_type",
+    "iter/sec",
+    "ms/iter",
+    "iterations",
+    "datetime",
+    "host_memory_mb",
+    "device_memory_mb",
+]
+
+
+def _row(day, ms_per_iter, device_memory_mb=100.0):
+    return {
+        "model": "resnet50",
+        "batch_size": "1",
+        "engine": "shark_iree_c",
+        "dialect": "linalg",
+        "device": "cpu",
+        "shape_type": "static",
+        "data_type": "float32",
+        "iter/sec": 1000 / ms_per_iter,
+        "ms/iter": ms_per_iter,
+        "iterations": 100,
+        "datetime": f"2023-08-{day:02d} 00:00:00",
+        "host_memory_mb": "",
+        "device_memory_mb": device_memory_mb,
+    }
+
+
+def test_ingest_and_report(tmp_path):
+    csv_path = tmp_path / "bench_results.csv"
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        for day, ms in enumerate([10.0, 10.2, 9.9, 10.1, 10.0], start=1):
+            writer.writerow(_row(day, ms))
+
+    history = BenchmarkHistory(str(tmp_path / "history.db"))
+    assert history.ingest_csv(str(csv_path), revision="abc", iree_version="1")
+    assert history.ingest_csv(str(csv_path), iree_version="1") == 0
+
+    report = build_report(history.get_series())
+    assert report[0][2][0]["findings"] == []
+
+    history.add_run(
+        _row(6, 11.5, device_memory_mb=150.0),
+        revision="def",
+        iree_version="1",
+        flags="--iree-flow-enable-conv-nchw-to-nhwc-transform",
+    )
+    report = build_report(history.get_series(["resnet50"]))
+    findings = report[0][2][0]["findings"]
+    assert [f["kind"] for f in findings] == ["slowdown", "memory_growth"]
+    assert findings[0]["p_value"] < 0.01
+    assert findings[0]["changes"]["revision"] == ("abc", "def")
+    assert "flags" in findings[0]["changes"]
+
+    text = render_text_report(report)
+    assert "! slowdown ms_per_iter" in text
+    assert "<svg" in render_html_report(report)
+    history.close()
+
+
+def test_ingest_without_revision_is_unknown(tmp_path):
+    csv_path = tmp_path / "bench_results.csv"
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerow(_row(1, 10.0))
+
+    history = BenchmarkHistory(str(tmp_path / "history.db"))
+    # Historical rows are not stamped with the current checkout.
+    assert history.ingest_csv(str(csv_path)) == 1
+    history.add_run(_row(2, 10.0), revision="abc", iree_version="1")
+    [runs] = history.get_series().values()
+    assert [(r["revision"], r["iree_version"]) for r in runs] == [
+        (None, None),
+        ("abc", "1"),
+    ]
+
+    report = build_report(history.get_series())
+    assert "@unknown" not in render_text_report(report)
+    history.add_run(_row(3, 10.0))
+    report = build_report(history.get_series())
+    assert "@unknown" in render_text_report(report)
+    history.close()
+
+
+def test_ingest_stats_sidecar(tmp_path, monkeypatch):
+    from shark.parser import shark_args
+    from shark.shark_benchmark_runner import write_benchmark_stats
+
+    # The sidecar entry and the csv row, as SharkBenchmarkRunner writes
+    # them for a --statistical_benchmark shark_python run.
+    stats_path = tmp_path / "bench_results_stats.jsonl"
+    monkeypatch.setattr(shark_args, "benchmark_stats_path", str(stats_path))
+    stats = {"iterations": 120, "median_ms": 10.0, "stddev_ms": 0.25}
+    row = _row(1, 10.0)
+    row["engine"] = "shark_python"
+    row["iterations"] = stats["iterations"]
+    row["datetime"] = str(datetime.now())
+    write_benchmark_stats(row, stats)
+    csv_path = tmp_path / "bench_results.csv"
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerow(row)
+
+    history = BenchmarkHistory(str(tmp_path / "history.db"))
+    assert history.ingest_csv(str(csv_path), str(stats_path)) == 1
+    [runs] = history.get_series().values()
+    assert runs[0]["stddev_ms"] == 0.25
+    assert json.loads(runs[0]["stats"]) == stats
+    history.close()
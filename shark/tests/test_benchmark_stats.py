@@ -0,0 +1,58 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+from shark.benchmark_stats import (
+    LatencySampler,
+    mser_truncation,
+    outlier_mask,
+    summarize_latencies,
+)
+
+
+def test_warmup_and_outliers():
+    rng = np.random.default_rng(0)
+    steady = rng.normal(1e6, 1e4, size=200)
+    samples = np.concatenate([np.full(20, 5e6), steady])
+    assert 20 <= mser_truncation(samples) <= 25
+
+    steady[50] = 1e7
+    assert np.nonzero(outlier_mask(steady))[0].tolist() == [50]
+
+
+def test_sampler_stops_at_ci_target():
+    rng = np.random.default_rng(0)
+
+    def iteration():
+        return {
+            "host_to_device": 1e5,
+            "invoke": rng.normal(1e6, 5e4),
+            "device_to_host": 1e5,
+        }
+
+    sampler = LatencySampler(ci_target=0.01, min_iterations=10)
+    stats = sampler.run(iteration)
+    assert stats["converged"]
+    assert stats["iterations"] < 100
+    assert stats["ci95_rel"] <= 0.01
+    assert abs(stats["median_ms"] - 1.2) < 0.05
+    assert stats["phases"]["host_to_device"]["median_ms"] == 0.1
+
+
+def test_summarize_latencies():
+    summary = summarize_latencies(np.arange(1, 101) * 1e6)
+    assert summary["median_ms"] == 50.5
+    assert summary["p99_ms"] > summary["p90_ms"] > summary["median_ms"]
+    assert summary["n"] == 100
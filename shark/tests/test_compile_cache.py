@@ -0,0 +1,116 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+
+import pytest
+
+from shark.iree_utils.compile_cache import VmfbCache
+
+
+def test_key_covers_module_target_and_flags(tmp_path):
+    cache = VmfbCache(str(tmp_path))
+    key = cache.make_key(b"module", "llvm-cpu", "torch", ["--a"])
+    assert key == cache.make_key(b"module", "llvm-cpu", "torch", ["--a"])
+    assert key != cache.make_key(b"module2", "llvm-cpu", "torch", ["--a"])
+    assert key != cache.make_key(b"module", "vulkan", "torch", ["--a"])
+    assert key != cache.make_key(b"module", "llvm-cpu", "torch", ["--b"])
+
+    mlir_file = tmp_path / "model.mlir"
+    mlir_file.write_bytes(b"module")
+    assert key == cache.make_key(str(mlir_file), "llvm-cpu", "torch", ["--a"])
+
+    dump_flag = "--iree-hal-dump-executable-sources-to=/tmp/x"
+    assert cache.make_key(b"module", "llvm-cpu", "torch", [dump_flag]) is None
+
+
+def test_lookup_store_and_stats(tmp_path):
+    cache = VmfbCache(str(tmp_path))
+    key = cache.make_key(b"module", "llvm-cpu", "torch", [])
+    assert cache.lookup(key) is None
+    path = cache.store(key, b"vmfb")
+    assert cache.lookup(key) == path
+    with open(path, "rb") as f:
+        assert f.read() == b"vmfb"
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["entries"] == 1
+
+
+def test_lru_eviction(tmp_path):
+    cache = VmfbCache(str(tmp_path), max_size_bytes=8)
+    keys = [
+        cache.make_key(bytes([i]), "llvm-cpu", "torch", []) for i in range(3)
+    ]
+    cache.store(keys[0], b"0000")
+    cache.store(keys[1], b"1111")
+    # Make keys[0] the most recently used entry.
+    past = time.time() - 10
+    os.utime(cache._vmfb_path(keys[1]), (past, past))
+    cache.lookup(keys[0])
+    cache.store(keys[2], b"2222")
+    assert cache.lookup(keys[1]) is None
+    assert cache.lookup(keys[0]) is not None
+    assert cache.lookup(keys[2]) is not None
+    assert cache.evictions == 1
+
+
+def test_dynamo_backend_cache_miss_then_hit(tmp_path, monkeypatch):
+    pytest.importorskip("torch_mlir")
+    pytest.importorskip("iree.compiler")
+    from shark.dynamo_backend import utils as dynamo_utils
+    from shark.iree_utils import compile_cache, compile_utils
+
+    compiled = []
+
+    def compile_module_to_flatbuffer(module, *args, **kwargs):
+        # The lowered module is bytecode, not the path of an mlir file.
+        assert kwargs.get("compile_str")
+        compiled.append(module)
+        return b"vmfb"
+
+    class FakeSharkInference:
+        def __init__(self, **kwargs):
+            self.vmfb_path = None
+
+        def load_module(self, path):
+            self.vmfb_path = path
+
+    monkeypatch.setattr(
+        compile_utils,
+        "compile_module_to_flatbuffer",
+        compile_module_to_flatbuffer,
+    )
+    monkeypatch.setattr(dynamo_utils, "SharkInference", FakeSharkInference)
+    cache = VmfbCache(str(tmp_path))
+    monkeypatch.setattr(compile_cache, "get_vmfb_cache", lambda: cache)
+
+    def make_backend():
+        backend = object.__new__(dynamo_utils.SharkBackend)
+        backend.device = "cpu"
+        backend.fingerprint = "graph"
+        backend._lower_to_bytecode = lambda: b"bytecode"
+        backend.compile()
+        return backend
+
+    first = make_backend()
+    assert compiled == [b"bytecode"]
+    second = make_backend()
+    assert compiled == [b"bytecode"]
+    assert first.shark_module.vmfb_path == second.shark_module.vmfb_path
+    with open(second.shark_module.vmfb_path, "rb") as f:
+        assert f.read() == b"vmfb"
+    assert cache.stats()["hits"] == 1
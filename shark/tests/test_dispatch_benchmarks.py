@@ -0,0 +1,77 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import json
+
+from shark.iree_utils.dispatch_benchmarks import (
+    DispatchBenchmarkCache,
+    build_dispatch_report,
+    get_dispatch_hash,
+    write_dispatch_report,
+)
+
+
+def _result(dispatch, runtime_ms, cached=False):
+    return {
+        "dispatch": dispatch,
+        "hash": get_dispatch_hash(dispatch, "cpu"),
+        "runtime_ms": runtime_ms,
+        "cached": cached,
+    }
+
+
+def test_cache_roundtrip(tmp_path):
+    path = str(tmp_path / "cache.json")
+    key = get_dispatch_hash("module", "cpu")
+    assert key != get_dispatch_hash("module", "vulkan")
+
+    cache = DispatchBenchmarkCache(path)
+    assert cache.lookup(key) is None
+    cache.store(key, "forward_dispatch_0", 1.5)
+    cache.save()
+    assert DispatchBenchmarkCache(path).lookup(key) == 1.5
+
+
+def test_report_order_share_and_regressions(tmp_path):
+    results = [
+        _result("dispatch_0", 1.0),
+        _result("dispatch_1", 3.0, cached=True),
+        _result("dispatch_2", 6.0),
+    ]
+    baseline = {
+        "dispatches": [
+            {"dispatch": "dispatch_0", "runtime_ms": 1.0},
+            {"dispatch": "dispatch_2", "runtime_ms": 5.0},
+        ]
+    }
+    report = build_dispatch_report(results, baseline, 0.1)
+
+    assert [d["dispatch"] for d in report["dispatches"]] == [
+        "dispatch_2",
+        "dispatch_1",
+        "dispatch_0",
+    ]
+    assert report["total_ms"] == 10.0
+    assert report["dispatches"][0]["share"] == 0.6
+    assert report["dispatches"][1]["baseline_ms"] is None
+    assert report["regressions"] == ["dispatch_2"]
+
+    write_dispatch_report(report, str(tmp_path))
+    with open(tmp_path / "dispatch-report.json") as f:
+        assert json.load(f)["regressions"] == ["dispatch_2"]
+    with open(tmp_path / "dispatch-report.csv") as f:
+        assert len(list(csv.DictReader(f))) == 3
+    ordered = (tmp_path / "ordered-dispatches.txt").read_text().splitlines()
+    assert ordered[0] == "dispatch_2: 6.0ms"
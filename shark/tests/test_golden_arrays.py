@@ -0,0 +1,58 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import numpy as np
+
+from shark.golden_arrays import load_arrays, migrate_tank, save_arrays
+
+
+def test_load_converts_npz(tmp_path):
+    inputs = (np.arange(12, dtype=np.float32).reshape(3, 4), np.int64(7))
+    np.savez(tmp_path / "inputs.npz", *inputs)
+
+    loaded = load_arrays(str(tmp_path), "inputs")
+    assert len(loaded) == 2
+    assert isinstance(loaded[0], np.memmap)
+    assert not loaded[0].flags.writeable
+    np.testing.assert_array_equal(loaded[0], inputs[0])
+    assert loaded[1] == 7
+
+    # A newer archive, e.g. from a tank update, replaces the arrays.
+    np.savez(tmp_path / "inputs.npz", np.ones(2))
+    os.utime(tmp_path / "inputs.npz", ns=(0, 0))
+    (loaded,) = load_arrays(str(tmp_path), "inputs")
+    np.testing.assert_array_equal(loaded, np.ones(2))
+
+    save_arrays(str(tmp_path), "golden_out", [[1, 2]])
+    (golden_out,) = load_arrays(str(tmp_path), "golden_out")
+    np.testing.assert_array_equal(golden_out, [1, 2])
+
+
+def test_migrate_tank(tmp_path):
+    for model in ["resnet50_torch", "bert_tf"]:
+        (tmp_path / model).mkdir()
+        np.savez(tmp_path / model / "inputs.npz", np.zeros(3))
+        np.savez(tmp_path / model / "golden_out.npz", np.ones(3))
+    assert migrate_tank(str(tmp_path)) == 4
+    assert migrate_tank(str(tmp_path), remove_npz=True) == 0
+    assert sorted(os.listdir(tmp_path / "bert_tf")) == [
+        "golden_out.0.npy",
+        "golden_out.index.json",
+        "inputs.0.npy",
+        "inputs.index.json",
+    ]
+    (golden_out,) = load_arrays(str(tmp_path / "bert_tf"), "golden_out")
+    np.testing.assert_array_equal(golden_out, np.ones(3))
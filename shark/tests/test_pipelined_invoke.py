@@ -0,0 +1,71 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import types
+
+import numpy as np
+import pytest
+
+pytest.importorskip("iree.runtime")
+pytest.importorskip("iree.compiler")
+
+from shark.iree_utils import pipelined_invoke
+
+
+class FakeDeviceArray:
+    # Host visible memory maps to the buffer itself, device local memory is
+    # read through a host copy, like iree.runtime.DeviceArray.
+    def __init__(self, array, mappable):
+        self.buffer = np.array(array)
+        self.mappable = mappable
+
+    def _is_mappable(self):
+        return self.mappable
+
+    def to_host(self):
+        return self.buffer if self.mappable else self.buffer.copy()
+
+
+@pytest.mark.parametrize("mappable", [True, False])
+def test_pooled_buffers_feed_new_inputs(monkeypatch, mappable):
+    monkeypatch.setattr(
+        pipelined_invoke.ireert,
+        "asdevicearray",
+        lambda device, array: FakeDeviceArray(array, mappable),
+    )
+
+    def forward(x, y):
+        return FakeDeviceArray(x.to_host() + 2 * y.to_host(), True)
+
+    invoker = pipelined_invoke.PipelinedInvoker(
+        {"forward": forward}, types.SimpleNamespace(device=None)
+    )
+    try:
+        inputs = [
+            (np.full([4], i, np.float32), np.arange(4, dtype=np.float32) * i)
+            for i in range(1, 4)
+        ]
+        for x, y in inputs:
+            # One call at a time, so that the buffers of the previous call
+            # are back in the pool.
+            result = invoker.submit("forward", (x, y)).result()
+            np.testing.assert_array_equal(result, x + 2 * y)
+    finally:
+        invoker.shutdown()
+
+    pool = invoker.buffer_pool
+    if mappable:
+        assert (pool.allocated, pool.reused) == (2, 4)
+    else:
+        assert (pool.allocated, pool.reused) == (6, 0)
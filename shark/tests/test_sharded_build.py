@@ -0,0 +1,98 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+import pytest
+
+from shark.sharded_build import LayerBuild, ShardedBuilder, is_valid_vmfb
+
+
+def fake_compile(mlir_path, vmfb_path, target_backend, compile_args):
+    with open(mlir_path, "rb") as f:
+        mlir = f.read()
+    if b"broken" in mlir:
+        raise RuntimeError("compile failed")
+    with open(vmfb_path, "wb") as f:
+        f.write(b"\0\0\0\0IREE" + mlir)
+    return 0.5, 100.0
+
+
+class FakeBuilder(ShardedBuilder):
+    compile_fn = staticmethod(fake_compile)
+
+    def get_compile_args(self, build):
+        return "llvm-cpu", (build.extra_args, "auto")
+
+
+def _builds(tmp_path, mlirs, imported):
+    def import_fn(name, mlir):
+        def write(path):
+            imported.append(name)
+            with open(path, "w") as f:
+                f.write(mlir)
+
+        return write
+
+    return [
+        LayerBuild(
+            name,
+            tmp_path / f"{name}.mlir",
+            tmp_path / f"{name}.vmfb",
+            import_fn=import_fn(name, mlir),
+        )
+        for name, mlir in mlirs.items()
+    ]
+
+
+def test_build_dedup_and_resume(tmp_path):
+    mlirs = {"layer0": "func a", "layer1": "func b", "layer2": "func a"}
+    imported = []
+    builder = FakeBuilder(str(tmp_path), num_workers=2)
+    report = builder.build(_builds(tmp_path, mlirs, imported))
+
+    assert imported == ["layer0", "layer1", "layer2"]
+    assert [report[name]["status"] for name in mlirs] == [
+        "built",
+        "built",
+        "reused",
+    ]
+    assert report["layer2"]["reused_from"] == "layer0"
+    assert report["layer0"]["peak_rss_mb"] == 100.0
+    for name in mlirs:
+        assert is_valid_vmfb(tmp_path / f"{name}.vmfb")
+    with open(tmp_path / "build_report.json") as f:
+        assert json.load(f)["layer1"]["compile_s"] == 0.5
+
+    # Only the layer whose MLIR changed is compiled again.
+    (tmp_path / "layer1.mlir").write_text("func c")
+    imported.clear()
+    builder = FakeBuilder(str(tmp_path), num_workers=2)
+    report = builder.build(_builds(tmp_path, mlirs, imported))
+    assert imported == []
+    assert [report[name]["status"] for name in mlirs] == [
+        "cached",
+        "built",
+        "cached",
+    ]
+    assert (tmp_path / "layer1.vmfb").read_bytes().endswith(b"func c")
+
+
+def test_build_failure(tmp_path):
+    mlirs = {"layer0": "func broken", "layer1": "func b"}
+    builder = FakeBuilder(str(tmp_path), num_workers=1)
+    with pytest.raises(RuntimeError, match="layer0"):
+        builder.build(_builds(tmp_path, mlirs, []))
+    assert not (tmp_path / "layer0.vmfb").exists()
+    assert is_valid_vmfb(tmp_path / "layer1.vmfb")
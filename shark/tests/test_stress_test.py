@@ -29,3 +29,65 @@ def test_stress_test():
             "--max-iterations=1",
         ]
     )
+
+
+def test_latency_histogram():
+    from shark.stress_test import LatencyHistogram
+
+    histogram = LatencyHistogram()
+    for i in range(1, 1001):
+        histogram.record(i / 1000)
+    other = LatencyHistogram.from_dict(histogram.to_dict())
+    histogram.merge(other)
+
+    summary = histogram.summary()
+    assert summary["count"] == 2000
+    assert summary["min_ms"] == 1
+    assert summary["max_ms"] == 1000
+    for percentile in [50, 95, 99, 99.9]:
+        exact = percentile * 10
+        value = summary[f"p{percentile:g}_ms"]
+        assert exact <= value <= exact * (1 + 2**-7)
+
+
+def test_compare_stress_reports():
+    from shark.stress_test import LatencyHistogram, build_stress_report
+    from shark.stress_test import compare_stress_reports
+
+    def client_report(latency, throughput_qps):
+        histogram = LatencyHistogram()
+        for _ in range(100):
+            histogram.record(latency)
+        return {
+            "device": "cpu",
+            "issued": 100,
+            "dropped": 0,
+            "throughput_qps": throughput_qps,
+            "timeline": [],
+            "histogram": histogram.to_dict(),
+        }
+
+    baseline = build_stress_report([client_report(0.010, 100)], {})
+    assert compare_stress_reports(baseline, baseline) == []
+    report = build_stress_report([client_report(0.020, 50)], {})
+    regressions = compare_stress_reports(report, baseline)
+    assert len(regressions) == 10
+    assert regressions[-1].startswith("cpu throughput_qps")
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="reads /proc/self/statm"
+)
+def test_rss_is_current_not_peak(monkeypatch):
+    import numpy as np
+    from shark.stress_test import get_rss_mb
+
+    # Without psutil the current RSS comes from /proc/self/statm.
+    monkeypatch.setitem(sys.modules, "psutil", None)
+    before = get_rss_mb()
+    block = np.ones(64 * 2**20, np.uint8)
+    during = get_rss_mb()
+    del block
+    after = get_rss_mb()
+    assert during - before > 48
+    assert during - after > 48
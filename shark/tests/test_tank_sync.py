@@ -0,0 +1,98 @@
+# Copyright 2023 The Nod Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+
+from shark.tank_sync import (
+    LocalSource,
+    TankDownloader,
+    fetch_file,
+    manifest_is_current,
+    sync_directory,
+)
+
+
+class FlakySource(LocalSource):
+    # Fails every read starting past `fail_at` once.
+    def __init__(self, fail_at):
+        self.fail_at = fail_at
+        self.reads = []
+
+    def read_range(self, blob, start, end, file_obj):
+        self.reads.append(start)
+        if start >= self.fail_at:
+            self.fail_at = float("inf")
+            raise IOError("connection reset")
+        super().read_range(blob, start, end, file_obj)
+
+
+def test_sync_directory(tmp_path):
+    upstream = tmp_path / "upstream" / "resnet50_torch"
+    upstream.mkdir(parents=True)
+    (upstream / "inputs.npz").write_bytes(b"inputs")
+    (upstream / "hash.npy").write_bytes(b"1")
+    local = tmp_path / "tank" / "resnet50_torch"
+
+    assert sync_directory(upstream, local) == ["hash.npy", "inputs.npz"]
+    assert (local / "inputs.npz").read_bytes() == b"inputs"
+    assert manifest_is_current(local, 60, str(upstream))
+    assert not manifest_is_current(local, 60, str(tmp_path))
+    assert sync_directory(upstream, local) == []
+
+    (upstream / "hash.npy").write_bytes(b"2")
+    assert sync_directory(upstream, local, update=False) == ["hash.npy"]
+    assert (local / "hash.npy").read_bytes() == b"1"
+    assert sync_directory(upstream, local) == ["hash.npy"]
+    assert (local / "hash.npy").read_bytes() == b"2"
+
+    # Local changes invalidate the manifest and are verified by checksum.
+    (local / "inputs.npz").write_bytes(b"Inputs")
+    assert not manifest_is_current(local, 60)
+    assert sync_directory(upstream, local) == ["inputs.npz"]
+    assert sorted(os.listdir(local)) == [
+        "hash.npy",
+        "inputs.npz",
+        "tank_manifest.json",
+    ]
+
+
+def test_resume_and_verify(tmp_path):
+    data = bytes(range(256)) * 4
+    (tmp_path / "model.vmfb").write_bytes(data)
+    dest = tmp_path / "out" / "model.vmfb"
+    dest.parent.mkdir()
+    (blob,) = LocalSource().list(str(tmp_path / "model.vmfb"))
+
+    # A slice that keeps failing leaves the others for the next attempt.
+    source = FlakySource(fail_at=512)
+    downloader = TankDownloader(num_workers=1, slice_size=256, retries=1)
+    with pytest.raises(RuntimeError, match="connection reset"):
+        downloader.fetch(source, [(blob, str(dest))])
+    assert not dest.exists()
+    source.reads.clear()
+    downloader.fetch(source, [(blob, str(dest))])
+    assert source.reads == [512]
+    assert dest.read_bytes() == data
+    assert os.listdir(dest.parent) == ["model.vmfb"]
+
+    corrupt = blob._replace(md5="0" * 32, version="corrupt")
+    with pytest.raises(RuntimeError, match="Checksum mismatch"):
+        downloader.fetch(LocalSource(), [(corrupt, str(dest) + ".bad")])
+    assert os.listdir(dest.parent) == ["model.vmfb"]
+
+    assert fetch_file(tmp_path / "model.vmfb", tmp_path / "copy.vmfb")
+    assert (tmp_path / "copy.vmfb").read_bytes() == data
+    assert not fetch_file(tmp_path / "missing", tmp_path / "missing")